@@ -58,21 +58,39 @@ Monitor daemon status with:
     -------------- ---------------------------
 """
 
+import time
+_IMPORT_START = time.time()
+
+# smtplib and ConfigParser are imported where they are used so they stay off
+# the startup path when email is disabled or the compiled config is cached.
 import argparse
-import ConfigParser
 from jsonrpclib import Server
+import jsonrpclib
 import os
-import time
 from pprint import pprint, pformat
-import smtplib
+import Queue
+import signal
+import socket
 import sys
 import syslog
+import threading
 from ctypes import cdll, byref, create_string_buffer
 
+import ibypass_common
+from ibypass_common import load_config, open_journal, CachedServer, \
+    Dispatcher, TelemetrySubscriber
+
+IMPORT_SECONDS = time.time() - _IMPORT_START
+
 DEBUG = False   # pylint: disable=C0103
 CONFIG = {}   # pylint: disable=C0103
 SNMP = {}   # pylint: disable=C0103
 EMAIL = {}   # pylint: disable=C0103
+RELOAD = False   # pylint: disable=C0103
+
+# The config sets of each switch, as named in [eapi] and, prefixed with
+#   peer_, in [path:<name>] sections for [peer_eapi]
+CONFIG_SETS = ('starting_config', 'ok_config', 'fail_config')
 
 
 def setProcName(newname):
@@ -123,11 +141,39 @@ def parse_cmd_line():
                         default='/var/log/eos',
                         help='The path to the log to watch')
 
+    parser.add_argument('--config-cache',
+                        type=str,
+                        action='store',
+                        default=None,
+                        help='Compiled config cache file' +
+                        ' (Default: <config>.bfd.cache)')
+
+    parser.add_argument('--no-config-cache',
+                        action='store_true',
+                        default=False,
+                        help='Always parse the config file')
+
+    parser.add_argument('--profile',
+                        type=float,
+                        action='store',
+                        default=0,
+                        metavar='SECONDS',
+                        help='Open a profiling window of this many' +
+                        ' seconds at startup; SIGUSR2 opens one of this' +
+                        ' length, or 60 seconds when 0 (Default: 0)')
+
+    parser.add_argument('--profile-dir',
+                        type=str,
+                        action='store',
+                        default='/tmp',
+                        help='Where to write profiles (Default: /tmp)')
+
     args = parser.parse_args()
 
     global DEBUG
     if args.debug:
         DEBUG = True
+        ibypass_common.DEBUG = True
 
     if DEBUG:
         print "CLI Args: {0}\n".format(pformat(args))
@@ -174,6 +220,7 @@ Subject: {}
 
         if DEBUG:
             pprint(EMAIL)
+        import smtplib
         try:
             smtp_obj = smtplib.SMTP(EMAIL['mailserver'],
                                     EMAIL['mailserverport'])
@@ -201,9 +248,11 @@ def parse_config(filename):
         filename (str): The path to the config file.
 
     Returns:
-        dict: A dictionary of configuration and switch definitions.
-
+        tuple: New (settings, email) dicts for CONFIG and EMAIL.  The
+               running config is not touched, so a file which fails to
+               parse leaves it as it was.
     """
+    import ConfigParser
 
     if not filename:
         filename = "/persist/sys/hbm.conf"
@@ -216,6 +265,9 @@ def parse_config(filename):
         'password': 'arista',
         'url': '%(protocol)s://%(username)s:%(password)s@%(hostname)s:%(port)s'
                '/command-api',
+        'eapi_cache_size': '64',
+        'bfd_sources': 'log',
+        'bfd_poll_interval': '0.5',
     }
     os.path.isfile(filename)
     if not os.access(filename, os.R_OK):
@@ -225,7 +277,7 @@ def parse_config(filename):
     config = ConfigParser.SafeConfigParser(defaults)
     config.read(filename)
 
-    global EMAIL
+    email = {}
     try:
         config.options('email')
     except ConfigParser.NoSectionError, err:
@@ -234,62 +286,166 @@ def parse_config(filename):
         raise IOError(
             "Required [email] section missing from config file {0}: ({1})".
             format(filename, err))
-    EMAIL['enabled'] = config.getboolean('email', 'enabled')
-    EMAIL['starttls'] = config.getboolean('email', 'starttls')
-    EMAIL['login'] = config.getboolean('email', 'login')
-    EMAIL['mailserver'] = config.get('email', 'mailserver')
-    EMAIL['mailserverport'] = config.getint('email', 'mailserverport')
-    EMAIL['from'] = config.get('email', 'from')
-    EMAIL['subject'] = config.get('email', 'subject')
+    email['enabled'] = config.getboolean('email', 'enabled')
+    email['starttls'] = config.getboolean('email', 'starttls')
+    email['login'] = config.getboolean('email', 'login')
+    email['mailserver'] = config.get('email', 'mailserver')
+    email['mailserverport'] = config.getint('email', 'mailserverport')
+    email['from'] = config.get('email', 'from')
+    email['subject'] = config.get('email', 'subject')
     recipients = config.get('email', 'to')
-    EMAIL['to'] = []
+    email['to'] = []
     for line in recipients.split('\n'):
         for recipient in line.split(","):
             recipient = recipient.strip('\t')
-            EMAIL['to'].append(recipient)
+            email['to'].append(recipient)
     if DEBUG:
-        print "EMAIL: {0}\n".format(pformat(EMAIL))
-
-    global CONFIG
-    CONFIG['hostname'] = config.get('eapi', 'hostname')
-    CONFIG['protocol'] = config.get('eapi', 'protocol')
-    CONFIG['port'] = config.get('eapi', 'port')
-    CONFIG['username'] = config.get('eapi', 'username')
-    CONFIG['password'] = config.get('eapi', 'password')
-    CONFIG['url'] = config.get('eapi', 'url')
-    CONFIG['starting_config'] = \
+        print "EMAIL: {0}\n".format(pformat(email))
+
+    parsed = {}
+    parsed['hostname'] = config.get('eapi', 'hostname')
+    parsed['protocol'] = config.get('eapi', 'protocol')
+    parsed['port'] = config.get('eapi', 'port')
+    parsed['username'] = config.get('eapi', 'username')
+    parsed['password'] = config.get('eapi', 'password')
+    parsed['url'] = config.get('eapi', 'url')
+    parsed['starting_config'] = \
         conf_string_to_list(config.get('eapi',
                                        'starting_config'))
-    CONFIG['ok_config'] = \
+    parsed['ok_config'] = \
         conf_string_to_list(config.get('eapi',
                                        'ok_config'))
-    CONFIG['fail_config'] = \
+    parsed['fail_config'] = \
         conf_string_to_list(config.get('eapi',
                                        'fail_config'))
 
-    CONFIG['alert_holddown'] = config.getint('General', 'alert_holddown')
-    CONFIG['interface1'] = config.get('General', 'interface1')
-    CONFIG['interface2'] = config.get('General', 'interface2')
-
+    parsed['alert_holddown'] = config.getint('General', 'alert_holddown')
+    parsed['eapi_cache_size'] = config.getint('General', 'eapi_cache_size')
+    parsed['bfd_sources'] = [source.strip().lower() for source in
+                             config.get('General', 'bfd_sources').split(',')
+                             if source.strip()]
+    parsed['bfd_poll_interval'] = config.getfloat('General',
+                                                  'bfd_poll_interval')
+
+    parsed['telemetry_enabled'] = False
+    if 'telemetry' in config.sections():
+        parsed['telemetry_enabled'] = config.getboolean('telemetry',
+                                                        'enabled')
+        parsed['telemetry_hostname'] = config.get('telemetry', 'hostname')
+        parsed['telemetry_port'] = config.getint('telemetry', 'port')
+    # Kept in the form open_journal() expects
+    parsed['journal'] = {'enabled': False, 'directory': '/persist/sys/hbm'}
+    if 'journal' in config.sections():
+        parsed['journal']['enabled'] = config.getboolean('journal',
+                                                         'enabled')
+        if config.has_option('journal', 'directory'):
+            parsed['journal']['directory'] = config.get('journal',
+                                                        'directory')
     if 'peer_eapi' in config.sections():
-        CONFIG['peer_hostname'] = config.get('peer_eapi', 'hostname')
-        CONFIG['peer_protocol'] = config.get('peer_eapi', 'protocol')
-        CONFIG['peer_port'] = config.get('peer_eapi', 'port')
-        CONFIG['peer_username'] = config.get('peer_eapi', 'username')
-        CONFIG['peer_password'] = config.get('peer_eapi', 'password')
-        CONFIG['peer_url'] = config.get('peer_eapi', 'url')
-        CONFIG['peer_starting_config'] = \
+        parsed['peer_hostname'] = config.get('peer_eapi', 'hostname')
+        parsed['peer_protocol'] = config.get('peer_eapi', 'protocol')
+        parsed['peer_port'] = config.get('peer_eapi', 'port')
+        parsed['peer_username'] = config.get('peer_eapi', 'username')
+        parsed['peer_password'] = config.get('peer_eapi', 'password')
+        parsed['peer_url'] = config.get('peer_eapi', 'url')
+        parsed['peer_starting_config'] = \
             conf_string_to_list(config.get('peer_eapi',
                                            'starting_config'))
-        CONFIG['peer_ok_config'] = \
+        parsed['peer_ok_config'] = \
             conf_string_to_list(config.get('peer_eapi',
                                            'ok_config'))
-        CONFIG['peer_fail_config'] = \
+        parsed['peer_fail_config'] = \
             conf_string_to_list(config.get('peer_eapi',
                                            'fail_config'))
 
+    # The [path:<name>] sections.  A path with config sets of its own is
+    #   failed over with them, in the form of hbm's CONFIG['paths'];
+    #   options it does not set come from [eapi] and [peer_eapi].
+    parsed['paths'] = []
+    for section in config.sections():
+        if not section.startswith('path:'):
+            continue
+        path = {'name': section[len('path:'):].strip(),
+                'interface': config.get(section, 'interface'),
+                'commands': None}
+        own = [(switch, name) for switch, prefix in (('eapi', ''),
+                                                     ('peer', 'peer_'))
+               for name in CONFIG_SETS
+               if config.has_option(section, prefix + name)]
+        if own:
+            path['commands'] = {
+                'eapi': dict((name, parsed[name]) for name in CONFIG_SETS),
+                'peer': dict((name, parsed.get('peer_' + name, []))
+                             for name in CONFIG_SETS)}
+            for (switch, name) in own:
+                option = name if switch == 'eapi' else 'peer_' + name
+                path['commands'][switch][name] = conf_string_to_list(
+                    config.get(section, option))
+        parsed['paths'].append(path)
+
+    # The interface of each path, or interface1 and interface2 without any
+    parsed['interfaces'] = [entry['interface'] for entry in parsed['paths']]
+    if not parsed['interfaces']:
+        parsed['interfaces'] = [config.get('General', 'interface1'),
+                                config.get('General', 'interface2')]
+
     if DEBUG:
-        print "CONFIG: {0}\n".format(pformat(CONFIG))
+        print "CONFIG: {0}\n".format(pformat(parsed))
+    return (parsed, email)
+
+
+def compile_config(filename):
+    """Parse the config file and return the resulting settings in a form
+    suitable for the compiled config cache.
+
+    Args:
+        filename (str): The path to the config file.
+
+    Returns:
+        dict: {'config': settings for CONFIG, 'email': settings for EMAIL}
+    """
+    (parsed, email) = parse_config(filename)
+    return {'config': parsed, 'email': email}
+
+
+def request_reload(signum, frame):
+    """SIGHUP handler: ask the main loop to re-read the config file"""
+    global RELOAD  # pylint: disable=C0103
+    RELOAD = True
+
+
+def reload_config(filename, cache_file=None):
+    """Re-read the config file on SIGHUP, updating CONFIG and EMAIL in place
+    so new command sets and alert settings apply without a restart.
+
+    Args:
+        filename (str): The path to the config file.
+        cache_file (str): The path to the compiled config cache.
+
+    Returns:
+        list: Names of the settings which changed
+    """
+    try:
+        (compiled, _, _) = load_config(filename, compile_config,
+                                       cache_file=cache_file,
+                                       required=('config', 'email'))
+    except Exception as err:
+        log("Config reload failed, keeping running config: {}".format(err),
+            error=True)
+        return []
+
+    # Replace the settings rather than update them, so any removed from
+    #   the file are dropped
+    before = dict(CONFIG)
+    for (settings, values) in ((CONFIG, compiled['config']),
+                               (EMAIL, compiled['email'])):
+        settings.clear()
+        settings.update(values)
+    changes = [key for key in sorted(set(before) | set(CONFIG))
+               if before.get(key) != CONFIG.get(key)]
+    log("Config reloaded, changed: {}".format(', '.join(changes) or 'none'),
+        subject="BFD config reloaded")
+    return changes
 
 
 def conf_string_to_list(list_as_string):
@@ -330,124 +486,620 @@ def get_peer(interface, routes):
     return peer
 
 
-def main():
-    """Ensure the selected interface is up and that there is a BGP peer
-       connected via that interface.  Once the interface and peer are up
-       monitor syslog for any BGP BFD peer changes.  Upon a change in the
-       peer, shutdown the selected interface to prevent automatic recovery
+def get_bfd_peers(response):
+    """Summarize the BFD peer table
+
+    Args:
+        response (list): eAPI response to 'show bfd peers'
+
+    Returns:
+        dict: peer address -> session status ('up', 'down', 'init', ...).
+              A peer is 'up' if any of its sessions is up.
     """
+    peers = {}
+    for vrf in response[0].get('vrfs', {}).values():
+        for family in ('ipv4Neighbors', 'ipv6Neighbors'):
+            for peer, info in vrf.get(family, {}).items():
+                statuses = [stats.get('status', 'down') for stats in
+                            info.get('peerStats', {}).values()]
+                if 'up' in statuses:
+                    peers[peer] = 'up'
+                elif statuses:
+                    peers[peer] = statuses[0]
+                else:
+                    peers[peer] = 'down'
+    return peers
 
-    setProcName('bfd_int_sync')
 
-    args = parse_cmd_line()
-    parse_config(args.config)
-    switch = Server(CONFIG['url'])
-    peer_switch = Server(CONFIG['peer_url'])
-    interfaces = []
-    interfaces.append(CONFIG['interface1'])
-    interfaces.append(CONFIG['interface2'])
-    log("Checking interfaces {} and {}".format(CONFIG['interface1'],
-                                               CONFIG['interface2']),
-        subject='BFD starting')
+class BfdPeerPoller(object):
+    """Detect BFD state changes by polling the BFD peer table, independent of
+    syslog message wording or rate-limiting.
+
+    All monitored peers are fetched with one 'show bfd peers' per interval.
+    The previous snapshot is kept as one status code per monitored peer, so
+    each poll is a single pass which emits only the peers that changed.  A
+    monitored peer missing from the table is treated as down.
+    """
 
-    switch.runCmds(1, CONFIG['starting_config'])
-    if CONFIG['peer_url']:
-        peer_switch.runCmds(1, CONFIG['peer_starting_config'])
+    STATUSES = ('unknown', 'up', 'down', 'init', 'adminDown')
+
+    def __init__(self, switch, peers, interval=0.5):
+        """
+        Args:
+            switch (obj): JSONrpc Switch object
+            peers (list): BFD peer addresses to monitor
+            interval (float): Seconds between polls
+        """
+        self.switch = switch
+        self.peers = tuple(peers)
+        self.interval = interval
+        self.index = dict((peer, pos) for pos, peer in enumerate(self.peers))
+        self.snapshot = bytearray(len(self.peers))
+        self.polls = 0
+        self._callbacks = []
+        self._stopped = threading.Event()
+        self._failing = False
+
+    def add_callback(self, callback):
+        """Call callback(event) for each changed peer"""
+        self._callbacks.append(callback)
+
+    def _code(self, status):
+        """Map a status string to its snapshot code"""
+        status = status.lower()
+        for code, name in enumerate(self.STATUSES):
+            if name.lower() == status:
+                return code
+        return 0
+
+    def poll(self):
+        """Fetch the peer table once and report changed peers
+
+        Returns:
+            list: An event dict for each changed peer, as passed to the
+                  callbacks: {'type', 'peer', 'status', 'previous', 'source'}
+        """
+        table = get_bfd_peers(self.switch.runCmds(1, ['show bfd peers']))
+        first = self.polls == 0
+        self.polls += 1
+        changes = []
+        for peer, pos in self.index.items():
+            code = self._code(table.get(peer, 'down'))
+            previous = self.snapshot[pos]
+            if code == previous:
+                continue
+            self.snapshot[pos] = code
+            if first:
+                continue
+            changes.append({'type': 'bfd',
+                            'peer': peer,
+                            'status': self.STATUSES[code],
+                            'previous': self.STATUSES[previous],
+                            'source': 'poll'})
+        for event in changes:
+            for callback in self._callbacks:
+                callback(event)
+        return changes
+
+    def start(self):
+        """Poll in a background thread"""
+        thread = threading.Thread(target=self.run, name='bfd-poll')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """Stop polling"""
+        self._stopped.set()
+
+    def run(self):
+        """Poll until stopped.  eAPI errors are logged once and retried."""
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+                if self._failing:
+                    self._failing = False
+                    log("BFD peer polling resumed", level='NOTICE')
+            except (socket.error, jsonrpclib.jsonrpc.ProtocolError,
+                    KeyError, IndexError) as err:
+                if not self._failing:
+                    self._failing = True
+                    log("BFD peer polling failed: {}".format(err),
+                        level='WARNING')
+            self._stopped.wait(self.interval)
+
+
+class BfdWatcher(object):
+    """Take a pair of monitored interfaces from startup through BFD failure
+    detection.
+
+    The watcher pushes starting_config, waits for a monitored link to come
+    up and for BGP routes to identify each peer, pushes ok_config, then
+    watches every enabled source (syslog, BFD peer table polling, telemetry)
+    for a peer going down.  The first Down pushes fail_config.
+
+    Work is done in short non-blocking steps so the watcher can share an
+    event loop with other detectors.  step() returns how long the caller may
+    wait before stepping again; wake is set when an event arrives sooner.
+    """
 
-    link_up = False
-    while link_up is not True:
-        for interface in interfaces:
-            response = switch.runCmds(1, ['show interfaces {} '
-                                          'status'.format(interface)])
-            interface_stat = response[0]['interfaceStatuses'][interface]
+    RETRY_INTERVAL = 5
+    LOG_INTERVAL = 0.05
+    IDLE_INTERVAL = 1
+    MAX_LINES = 1000
+    # Poll this many times faster while heartbeats report a path degraded
+    URGENT_FACTOR = 5
+
+    def __init__(self, switch, interfaces, dispatcher, logfile='/var/log/eos',
+                 sources=('log',), poll_interval=0.5, telemetry=None,
+                 alert_holddown=0, alerts=None, wake=None, engine=None,
+                 journal=None, paths=None):
+        """
+        Args:
+            switch (obj): JSONrpc Switch object for the local switch
+            interfaces (list): The monitored interfaces
+            dispatcher (Dispatcher): Applies config sets to both switches
+            logfile (str): The path to the log to watch
+            sources (list): Enabled detection sources: 'log' and/or 'poll'
+            poll_interval (float): Seconds between BFD peer table polls
+            telemetry (TelemetrySubscriber): Optional streaming state source
+            alert_holddown (int): Seconds to keep reporting a failure
+            alerts (AlertQueue): Also send notifications with a subject here
+            wake (threading.Event): Set when an event needs prompt handling
+            engine (DecisionEngine): Receives BFD state per interface and
+                                     reports heartbeat degradation
+            journal (EventJournal): Records each BFD failure found
+            paths (list): The CONFIG['paths'] entries of the monitored
+                          interfaces, whose own config sets apply when
+                          their interface fails
+        """
+        self.switch = switch
+        self.interfaces = list(interfaces)
+        self.peers = [None] * len(self.interfaces)
+        self.dispatcher = dispatcher
+        self.logfile = logfile
+        self.sources = list(sources)
+        self.poll_interval = poll_interval
+        self.telemetry = telemetry
+        self.alert_holddown = alert_holddown
+        self.alerts = alerts
+        self.wake = wake or threading.Event()
+        self.engine = engine
+        self.journal = journal
+        self.paths = dict((path['interface'], path) for path in paths or ())
+
+        self.state = 'starting'
+        self.failed = None
+        self.poller = None
+        self._events = Queue.Queue()
+        self._next_check = 0
+        self._done_at = None
+        self._current = None
+        self._inode = None
+        self._restarted = False
+
+        if telemetry is not None:
+            telemetry.add_callback(self._on_event)
+
+    def notify(self, msg, level='INFO', subject=''):
+        """Log a message, also queuing it as an alert if it has a subject"""
+        log(msg, level=level, subject=subject)
+        if self.alerts is not None and subject:
+            self.alerts.send(msg, subject=subject)
+
+    def _on_event(self, event):
+        """Collect BFD Down events from telemetry and the poller, and
+        recheck links when telemetry reports an interface change
+        """
+        if event['type'] == 'interface' and self.state == 'link':
+            self._next_check = 0
+            self.wake.set()
+        if event['type'] == 'bfd' and self.engine is not None:
+            for peer, interface in zip(self.peers, self.interfaces):
+                if peer == event.get('peer'):
+                    self.engine.record(
+                        interface, 'bfd',
+                        event.get('status', '').lower() == 'down',
+                        event.get('source', 'telemetry'))
+        if event['type'] == 'bfd' and \
+                event.get('status', '').lower() == 'down' and \
+                event.get('previous', 'up') == 'up':
+            event.setdefault('source', 'telemetry')
+            self._events.put(event)
+            self.wake.set()
+
+    def step(self, now=None):
+        """Do any work which is due
+
+        Returns:
+            float: Seconds until the watcher next needs to run
+        """
+        if now is None:
+            now = ibypass_common.CLOCK.time()
+
+        if self.state == 'starting':
+            self.dispatcher.apply('starting_config')
+            self.state = 'link'
+
+        if self.state == 'link':
+            if now < self._next_check:
+                return self._next_check - now
+            if not self._link_up():
+                self._next_check = now + self.RETRY_INTERVAL
+                return self.RETRY_INTERVAL
+            self.state = 'routes'
+            self._next_check = 0
+
+        if self.state == 'routes':
+            if now < self._next_check:
+                return self._next_check - now
+            if not self._find_peers():
+                self._next_check = now + self.RETRY_INTERVAL
+                return self.RETRY_INTERVAL
+            self._arm()
+            self.state = 'watching'
+
+        if self.state == 'watching':
+            self._set_urgency()
+            match = self._next_failure()
+            if match is None:
+                if self._current is not None:
+                    return self.LOG_INTERVAL
+                return self.IDLE_INTERVAL
+            self._fail(*match)
+            self._done_at = now + self.alert_holddown
+            self.state = 'failed'
+
+        if self.state == 'failed':
+            if now < self._done_at:
+                return self._done_at - now
+            self.stop()
+            self.state = 'done'
+
+        return self.IDLE_INTERVAL
+
+    def _link_up(self):
+        """Check whether any monitored interface is up, preferring the
+        telemetry view of the interface when available
+        """
+        link_up = False
+        for interface in self.interfaces:
+            interface_stat = None
+            if self.telemetry:
+                interface_stat = self.telemetry.interface_status(interface)
+            if interface_stat is None:
+                response = self.switch.runCmds(1, ['show interfaces {} '
+                                                   'status'.format(interface)])
+                interface_stat = response[0]['interfaceStatuses'][interface]
             if interface_stat['linkStatus'] != 'connected':
                 log("Interface is shutdown.  Please 'no shutdown' interface {}"
                     " to continue.".format(interface), level='WARNING')
+            elif interface_stat['lineProtocolStatus'] == 'up':
+                link_up = True
+                log("Interface {} is up".format(interface), level='DEBUG')
             else:
-                if interface_stat['lineProtocolStatus'] == 'up':
-                    link_up = True
-                    log("Interface {} is up".format(interface), level='DEBUG')
-                else:
-                    log("Interface Protocol is not up.  Please check interface"
-                        " {} to continue.".format(interface), level='WARNING')
-            if link_up is not True:
-                log("Waiting for interface {} to come up...".format(interface),
-                    level='WARNING')
-                time.sleep(5)
-
-    peer1 = None
-    peer2 = None
-    while peer1 is None or peer2 is None:
-        routes = switch.runCmds(1, ['show ip route'])
-        peer1 = get_peer(interfaces[0], routes)
-        peer2 = get_peer(interfaces[1], routes)
-        if peer1 is None or peer2 is None:
-            log("Waiting for routes to come up on interfaces {} and {}.".
-                format(interfaces[0], interfaces[1]), level='WARNING')
-            time.sleep(5)
-
-    switch.runCmds(1, CONFIG['ok_config'])
-    if CONFIG['peer_url']:
-        peer_switch.runCmds(1, CONFIG['peer_ok_config'])
-
-    log("Watching interface " + interfaces[0] + " (peer: " + peer1 + ") and "
-        "interface " + interfaces[1] + " (peer: " + peer2 + ")",
-        subject="BFD Running")
-
-    current = open(args.logfile, 'r')
-    curr_inode = os.fstat(current.fileno()).st_ino
-    current.seek(0, 2)  # Go to the end of the file
-
-    running = True
-    while running is True:
-        line = None
-        while True:
-            line = current.readline()
+                log("Interface Protocol is not up.  Please check interface"
+                    " {} to continue.".format(interface), level='WARNING')
+            if link_up:
+                break
+            log("Waiting for interface {} to come up...".format(interface),
+                level='WARNING')
+        return link_up
+
+    def _find_peers(self):
+        """Look up the BGP peer on each monitored interface"""
+        routes = self.switch.runCmds(1, ['show ip route'])
+        self.peers = [get_peer(interface, routes)
+                      for interface in self.interfaces]
+        if None in self.peers:
+            log("Waiting for routes to come up on interfaces {}.".format(
+                ' and '.join(self.interfaces)), level='WARNING')
+            return False
+        return True
+
+    def _arm(self):
+        """Apply ok_config and start every enabled detection source"""
+        if self._restarted:
+            self._restarted = False
+        else:
+            self.dispatcher.apply('ok_config')
+        self.notify("Watching " + ' and '.join(
+            "interface {} (peer: {})".format(interface, peer)
+            for interface, peer in zip(self.interfaces, self.peers)) +
+            " using " + ', '.join(self.sources), subject="BFD Running")
+
+        if 'poll' in self.sources:
+            self.poller = BfdPeerPoller(self.switch, self.peers,
+                                        interval=self.poll_interval)
+            self.poller.add_callback(self._on_event)
+            self.poller.start()
+
+        if 'log' in self.sources:
+            self._current = open(self.logfile, 'r')
+            self._inode = os.fstat(self._current.fileno()).st_ino
+            self._current.seek(0, 2)  # Go to the end of the file
+
+    def use_switch(self, switch):
+        """Talk to the local switch over a new eAPI session, e.g. after its
+        URL changed
+        """
+        self.switch = switch
+        if self.poller is not None:
+            self.poller.switch = switch
+
+    def _set_urgency(self):
+        """Poll the BFD peer table faster while heartbeats show a monitored
+        path losing probes or running slow
+        """
+        if self.poller is None or self.engine is None:
+            return
+        interval = self.poll_interval
+        for interface in self.interfaces:
+            if self.engine.degraded(interface):
+                interval = self.poll_interval / self.URGENT_FACTOR
+        if interval != self.poller.interval:
+            log("BFD peer poll interval now {}s".format(interval),
+                level='DEBUG')
+            self.poller.interval = interval
+
+    def _match(self, line):
+        """Return the (peer, interface) a BFD state change line refers to"""
+        for peer, interface in zip(self.peers, self.interfaces):
+            if peer in line:
+                return (peer, interface)
+        return None
+
+    def _next_failure(self):
+        """Return (line, peer, interface, source) for the first reported
+        BFD Down, or None
+        """
+        try:
+            event = self._events.get_nowait()
+        except Queue.Empty:
+            event = None
+        if event is not None:
+            line = "{}: BFD peer {} {}".format(event['source'], event['peer'],
+                                               event['status'])
+            match = self._match(line)
+            if match:
+                return (line,) + match + (event['source'],)
+
+        if self._current is None:
+            return None
+        with ibypass_common.TIMINGS.timed('log read'):
+            return self._read_log()
+
+    def _read_log(self):
+        """Return (line, peer, interface, 'log') for the first BFD Down in
+        up to MAX_LINES new lines of the log, or None
+        """
+        for _ in xrange(self.MAX_LINES):
+            line = self._current.readline()
             if line == "":
-                continue
+                self._check_rotation()
+                return None
             # Look for lines like:
             # Rib: %BGP-BFD-STATE-CHANGE: peer 192.0.3.1 (AS 10000) Up to Down
             if 'BGP-BFD-STATE-CHANGE' not in line:
                 continue
-            if peer1 in line:
-                running = False
-                peer = peer1
-                interface = interfaces[0]
-            if peer2 in line:
-                running = False
-                peer = peer2
-                interface = interfaces[1]
-            if running is False:
-                log(line, level='DEBUG')
-                log("BFD State Change for peer {}, "
-                    "(interface {})".format(peer, interface),
-                    level='DEBUG')
-                switch.runCmds(1, CONFIG['fail_config'])
-                if CONFIG['peer_url']:
-                    peer_switch.runCmds(1, CONFIG['peer_fail_config'])
-                log("...WARNING: BFD triggered an automated shutdown of "
+            with ibypass_common.TIMINGS.timed('log match'):
+                match = self._match(line)
+            if match:
+                return (line,) + match + ('log',)
+        return None
+
+    def _check_rotation(self):
+        """Reopen the log if it was rotated, or read it from the start if
+        it was truncated in place (logrotate's copytruncate)
+        """
+        try:
+            if os.stat(self.logfile).st_ino != self._inode:
+                newfile = open(self.logfile, 'r')
+                self._current.close()
+                self._current = newfile
+                # Don't seek here or we could miss logs written between the
+                #   last run and us opening the new file.
+                self._inode = os.fstat(self._current.fileno()).st_ino
+            elif os.fstat(self._current.fileno()).st_size < \
+                    self._current.tell():
+                self._current.seek(0)
+        except (IOError, OSError):
+            pass
+
+    def _fail(self, line, peer, interface, source='log'):
+        """Apply fail_config and report the failure"""
+        self.failed = (peer, interface)
+        if self.journal is not None:
+            self.journal.bfd(interface, peer, source)
+        if self.engine is not None:
+            self.engine.record(interface, 'bfd', 1.0, source='watcher')
+        log(line, level='DEBUG')
+        log("BFD State Change for peer {}, "
+            "(interface {})".format(peer, interface),
+            level='DEBUG')
+        path = self.paths.get(interface)
+        if path is not None:
+            self.dispatcher.apply('fail_config', path=path['name'],
+                                  commands=path['commands'])
+        else:
+            self.dispatcher.apply('fail_config')
+        self.notify("...WARNING: BFD triggered an automated shutdown of "
                     "interface {}".format(interface), level='WARNING',
                     subject="BFD Failed")
 
-                if CONFIG['alert_holddown'] > 0:
-                    # Send alerts on a regular interval until manually stopped.
-                    log("BFD triggered automatic shutdown of {}.".
+        if self.alert_holddown > 0:
+            # Send alerts on a regular interval until manually stopped.
+            self.notify("BFD triggered automatic shutdown of {}.".
                         format(interface),
                         subject="BFD Failed")
-                    time.sleep(CONFIG['alert_holddown'])
-                break
 
+    def recheck(self):
+        """Report the monitored BFD peers' current state to the engine.
+        Once the watcher has failed it no longer follows its sources, so a
+        path failed on a BFD Down learns here that its peer is up again.
+        """
+        if self.engine is None:
+            return
         try:
-            if os.stat(args.logfile).st_ino != curr_inode:
-                newfile = open(args.logfile, 'r')
-                current.close()
-                current = newfile
-                # Don't seek here or we could miss logs written between the
-                #   last run and us opening the new file.
-                curr_inode = os.fstat(current.fileno()).st_ino
-                continue
-        except IOError:
-            pass
+            table = get_bfd_peers(self.switch.runCmds(1, ['show bfd peers']))
+        except (socket.error, jsonrpclib.jsonrpc.ProtocolError,
+                KeyError, IndexError) as err:
+            log("BFD peer recheck failed: {}".format(err), level='DEBUG')
+            return
+        for peer, interface in zip(self.peers, self.interfaces):
+            if peer in table:
+                self.engine.record(interface, 'bfd', table[peer] != 'up',
+                                   source='recheck')
+
+    def stop(self):
+        """Stop background sources and close the log"""
+        if self.poller is not None:
+            self.poller.stop()
+            self.poller = None
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+
+    def restart(self):
+        """Watch again once the monitored paths have recovered.  Whoever
+        restored the paths is responsible for ok_config.
+        """
+        self.stop()
+        while not self._events.empty():
+            self._events.get_nowait()
+        self.state = 'link'
+        self.failed = None
+        self._next_check = 0
+        self._restarted = True
+        self.wake.set()
+
+    def watch(self, interfaces, paths=None):
+        """Follow a reloaded list of monitored interfaces, looking up their
+        BFD peers again if it changed.  A failed watcher keeps its failure
+        and picks up the new interfaces on restart().
+
+        Args:
+            interfaces (list): The monitored interfaces
+            paths (list): The CONFIG['paths'] entries of the interfaces
+
+        Returns:
+            bool: True if the monitored interfaces changed
+        """
+        self.paths = dict((path['interface'], path) for path in paths or ())
+        interfaces = list(interfaces)
+        if interfaces == self.interfaces:
+            return False
+        log("Now checking interfaces {}".format(', '.join(interfaces)))
+        self.interfaces = interfaces
+        self.peers = [None] * len(interfaces)
+        if self.state == 'watching':
+            self.restart()
+        elif self.state in ('link', 'routes'):
+            self._next_check = 0
+            self.wake.set()
+        return True
+
+
+def dispatch_config(switch, peer_switch):
+    """Arrange the config sets from CONFIG for a Dispatcher
+
+    Args:
+        switch (obj): JSONrpc Switch object for the local switch
+        peer_switch (obj): JSONrpc Switch object for the peer switch
+
+    Returns:
+        dict: 'eapi' and, if configured, 'peer' sections
+    """
+    config = {'eapi': {'switch': switch,
+                       'starting_config': CONFIG['starting_config'],
+                       'ok_config': CONFIG['ok_config'],
+                       'fail_config': CONFIG['fail_config']}}
+    if CONFIG.get('peer_url'):
+        config['peer'] = {'switch': peer_switch,
+                          'starting_config': CONFIG['peer_starting_config'],
+                          'ok_config': CONFIG['peer_ok_config'],
+                          'fail_config': CONFIG['peer_fail_config']}
+    return config
+
+
+def main():
+    """Ensure the selected interface is up and that there is a BGP peer
+       connected via that interface.  Once the interface and peer are up
+       monitor syslog for any BGP BFD peer changes.  Upon a change in the
+       peer, shutdown the selected interface to prevent automatic recovery
+    """
+
+    setProcName('bfd_int_sync')
+
+    args = parse_cmd_line()
+    cache_file = None
+    if not args.no_config_cache:
+        cache_file = args.config_cache or '{}.bfd.cache'.format(args.config)
+    (compiled, source, parse_seconds) = load_config(
+        args.config, compile_config, cache_file=cache_file,
+        required=('config', 'email'))
+    CONFIG.update(compiled['config'])
+    EMAIL.update(compiled['email'])
+    switch = CachedServer(Server(CONFIG['url']),
+                          max_entries=CONFIG['eapi_cache_size'])
+    peer_switch = None
+    if CONFIG.get('peer_url'):
+        peer_switch = CachedServer(Server(CONFIG['peer_url']),
+                                   max_entries=CONFIG['eapi_cache_size'])
+    log("Checking interfaces {} (startup cost: imports {:.3f}s, "
+        "config {:.3f}s ({}))".format(', '.join(CONFIG['interfaces']),
+                                      IMPORT_SECONDS, parse_seconds, source),
+        subject='BFD starting')
+
+    # Optionally follow interface and BFD state from streaming telemetry
+    telemetry = None
+    if CONFIG['telemetry_enabled']:
+        telemetry = TelemetrySubscriber(CONFIG['telemetry_hostname'],
+                                        CONFIG['telemetry_port'])
+        telemetry.start()
+
+    dispatcher = Dispatcher(dispatch_config(switch, peer_switch))
+    dispatcher.journal = open_journal(CONFIG, 'bfd_int_sync', ())
+    watcher = BfdWatcher(switch,
+                         CONFIG['interfaces'],
+                         dispatcher,
+                         logfile=args.logfile,
+                         sources=CONFIG['bfd_sources'],
+                         poll_interval=CONFIG['bfd_poll_interval'],
+                         telemetry=telemetry,
+                         alert_holddown=CONFIG['alert_holddown'],
+                         journal=dispatcher.journal,
+                         paths=CONFIG['paths'])
+
+    signal.signal(signal.SIGHUP, request_reload)
+    signal.siginterrupt(signal.SIGHUP, False)
+    profiler = ibypass_common.install_diagnostics('bfd_int_sync', args)
+
+    global RELOAD  # pylint: disable=C0103
+    while watcher.state != 'done':
+        profiler.tick()
+        if RELOAD:
+            RELOAD = False
+            changes = reload_config(args.config, cache_file=cache_file)
+            if 'url' in changes:
+                switch = CachedServer(Server(CONFIG['url']),
+                                      max_entries=CONFIG['eapi_cache_size'])
+                watcher.use_switch(switch)
+            if 'peer_url' in changes:
+                # None once [peer_eapi] is removed
+                peer_switch = None
+                if CONFIG.get('peer_url'):
+                    peer_switch = CachedServer(
+                        Server(CONFIG['peer_url']),
+                        max_entries=CONFIG['eapi_cache_size'])
+            dispatcher.config = dispatch_config(switch, peer_switch)
+            dispatcher.journal = open_journal(CONFIG, 'bfd_int_sync', (),
+                                              dispatcher.journal)
+            watcher.journal = dispatcher.journal
+            watcher.alert_holddown = CONFIG['alert_holddown']
+            watcher.watch(CONFIG['interfaces'], paths=CONFIG['paths'])
+        ibypass_common.CLOCK.wait(watcher.wake, watcher.step())
+        watcher.wake.clear()
 
 if __name__ == "__main__":
     try:
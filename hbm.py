@@ -158,26 +158,64 @@
       turned back on.
 """
 
+import time
+_IMPORT_START = time.time()
+
+# Modules only needed by optional or infrequent features (smtplib for email,
+# ConfigParser when the compiled config cache is stale) are imported where
+# they are used to keep them off the startup path.
 import argparse
-import ConfigParser
+import array
+import collections
 import json
 from jsonrpclib import Server
 import jsonrpclib
+import math
+import mmap
 import os
 from pprint import pformat
+import Queue
 import re
-import smtplib
+import signal
 import socket
+import struct
 import subprocess
-import sys
 import syslog
-import time
+import threading
 import traceback
 
 from ctypes import cdll, byref, create_string_buffer
 
+import ibypass_common
+from ibypass_common import load_config, CachedServer, TelemetrySubscriber, \
+    Dispatcher, open_journal, install_diagnostics
+
+IMPORT_SECONDS = time.time() - _IMPORT_START
+
 DEBUG = False          # pylint: disable=C0103
 MAIL = None            # pylint: disable=C0103
+RELOAD = False         # pylint: disable=C0103
+
+# Seconds a SIGHUP reload may spend reaching new eAPI endpoints and
+# discovering new probe addresses before the running config is kept
+RELOAD_TIMEOUT = 30
+
+REQUIRED_CONFIG = ('email', 'eapi', 'interval', 'alert_holddown', 'timeout',
+                   'alert_threshold', 'failure_threshold', 'startup_timeout',
+                   'eapi_cache_size', 'telemetry', 'paths', 'recording',
+                   'journal')
+
+# The config sets a [path:<name>] section may give for its own path.  Sets
+#   for the peer switch are prefixed with 'peer_'.
+CONFIG_SETS = ('starting_config', 'ok_config', 'fail_config',
+               'shutdown_config')
+
+# Weight of each failure signal in a path's health score, see DecisionEngine.
+#   A path fails when the weighted sum reaches fail_score.
+SIGNAL_WEIGHTS = {'bfd': 1.0, 'interface': 1.0, 'probe': 1.0, 'rtt': 0.5}
+
+# Marks an unused slot in typed RTT storage
+NAN = float('nan')
 
 
 def setProcName(newname):
@@ -206,20 +244,12 @@ def log(msg, level='INFO', error=False, email=False, subject=''):
 
     """
 
-    if DEBUG:
-        print "{0} ({1}) {2}".format(os.path.basename(sys.argv[0]), level, msg)
-
-    if error:
-        level = "ERR"
-        print "ERROR: {0} ({1}) {2}".format(os.path.basename(sys.argv[0]),
-                                            level, msg)
-
-    priority = ''.join(["syslog.LOG_", level])
-    syslog.syslog(eval(priority), msg)
+    ibypass_common.log(msg, level=level, error=error)
 
     if email:
         if MAIL and MAIL.config['enabled']:
-            MAIL.send(msg, subject=subject)
+            with ibypass_common.TIMINGS.timed('alert'):
+                MAIL.send(msg, subject=subject)
 
 
 class mail(object):
@@ -253,6 +283,8 @@ Subject: {}
                 ','.join(self.config['to']),
                 self.config['subject'] + subject, msg)
 
+            import smtplib
+
             try:
                 smtp_obj = smtplib.SMTP(self.config['mailserver'],
                                         self.config['mailserverport'])
@@ -274,6 +306,70 @@ Subject: {}
                 log("Warning: unable to send email", level='WARNING')
 
 
+class AlertQueue(object):
+    """Send email alerts from a background thread so a slow or unreachable
+    mail server never delays detection or failover.  Alerts beyond maxsize
+    are dropped and counted.
+    """
+
+    def __init__(self, mailer, maxsize=100):
+        """
+        Args:
+            mailer (mail): Sends each queued alert
+            maxsize (int): Maximum number of pending alerts
+        """
+        self.mailer = mailer
+        self.dropped = 0
+        self._queue = Queue.Queue(maxsize)
+        self._thread = None
+
+    @property
+    def config(self):
+        """The email settings of the underlying mailer"""
+        return self.mailer.config
+
+    @config.setter
+    def config(self, value):
+        self.mailer.config = value
+
+    def send(self, msg, subject=''):
+        """Queue an alert for delivery"""
+        try:
+            self._queue.put_nowait((msg, subject))
+        except Queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        """Deliver alerts in a background thread"""
+        self._thread = threading.Thread(target=self.run, name='alerts')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        """Deliver pending alerts, waiting up to timeout seconds"""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put((None, None), timeout=timeout)
+        except Queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def run(self):
+        """Send queued alerts until stopped"""
+        while True:
+            (msg, subject) = self._queue.get()
+            if msg is None:
+                return
+            try:
+                with ibypass_common.TIMINGS.timed('smtp'):
+                    self.mailer.send(msg, subject=subject)
+            except Exception as err:
+                log('Warning: unable to send email: {}'.format(err),
+                    level='WARNING')
+
+
 def parse_cmd_line():
     """Parse the command line options and return an args dict.
 
@@ -304,11 +400,53 @@ def parse_cmd_line():
                         default='/var/log/eos',
                         help='The path to the log to watch')
 
+    parser.add_argument('--config-cache',
+                        type=str,
+                        action='store',
+                        default=None,
+                        help='Compiled config cache file' +
+                        ' (Default: <config>.hbm.cache)')
+
+    parser.add_argument('--no-config-cache',
+                        action='store_true',
+                        default=False,
+                        help='Always parse the config file')
+
+    parser.add_argument('--status-file',
+                        type=str,
+                        action='store',
+                        default='/var/run/hbm.status',
+                        help='Where to write the state of each path' +
+                        ' (Default: /var/run/hbm.status)')
+
+    parser.add_argument('--approve-file',
+                        type=str,
+                        action='store',
+                        default='/var/run/hbm.approve',
+                        help='Interfaces listed in this file are approved' +
+                        ' to recover (Default: /var/run/hbm.approve)')
+
+    parser.add_argument('--profile',
+                        type=float,
+                        action='store',
+                        default=0,
+                        metavar='SECONDS',
+                        help='Open a profiling window of this many' +
+                        ' seconds at startup; SIGUSR2 opens one of this' +
+                        ' length, or 60 seconds when 0 (Default: 0)')
+
+    parser.add_argument('--profile-dir',
+                        type=str,
+                        action='store',
+                        default='/tmp',
+                        help='Where to write profiles (Default: /tmp)')
+
     args = parser.parse_args()
 
     global DEBUG  # pylint: disable=C0103
     if args.debug:
         DEBUG = True
+        ibypass_common.DEBUG = True
 
     if DEBUG:
         print "CLI Args: {0}\n".format(pformat(args))
@@ -325,6 +463,7 @@ def parse_config(filename):
     Returns:
         dict: A dictionary of configuration and switch definitions.
     """
+    import ConfigParser
 
     if not filename:
         filename = "/persist/sys/hbm.conf"
@@ -345,7 +484,22 @@ def parse_config(filename):
         'interval': '5',
         'timeout': '5',
         'alert_threshold': '4',
-        'failure_threshold': '8'
+        'failure_threshold': '8',
+        'startup_timeout': '600',
+        'eapi_cache_size': '64',
+        'bfd_sources': 'log',
+        'bfd_poll_interval': '0.5',
+        'signal_weights': '',
+        'fail_score': '1.0',
+        'probe_window': '5',
+        'alert_statistic': 'avg',
+        'failure_statistic': 'avg',
+        'quantile_window': '300',
+        'failed_probe_interval': '30',
+        'recovery': 'auto',
+        'batch': 'no',
+        'rtt_history': '32',
+        'starting_config': ''
     }
 
     config = ConfigParser.SafeConfigParser(defaults)
@@ -380,6 +534,9 @@ def parse_config(filename):
     CONFIG['eapi']['port'] = config.get('eapi', 'port')
     CONFIG['eapi']['username'] = config.get('eapi', 'username')
     CONFIG['eapi']['password'] = config.get('eapi', 'password')
+    CONFIG['eapi']['starting_config'] = \
+        conf_string_to_list(config.get('eapi',
+                                       'starting_config'))
     CONFIG['eapi']['ok_config'] = \
         conf_string_to_list(config.get('eapi',
                                        'ok_config'))
@@ -398,6 +555,9 @@ def parse_config(filename):
         CONFIG['peer']['port'] = config.get('peer_eapi', 'port')
         CONFIG['peer']['username'] = config.get('peer_eapi', 'username')
         CONFIG['peer']['password'] = config.get('peer_eapi', 'password')
+        CONFIG['peer']['starting_config'] = \
+            conf_string_to_list(config.get('peer_eapi',
+                                           'starting_config'))
         CONFIG['peer']['ok_config'] = \
             conf_string_to_list(config.get('peer_eapi',
                                            'ok_config'))
@@ -409,20 +569,118 @@ def parse_config(filename):
                                            'shutdown_config'))
         CONFIG['peer']['url'] = config.get('peer_eapi', 'url')
 
+    CONFIG['telemetry'] = {'enabled': False}
+    if 'telemetry' in config.sections():
+        CONFIG['telemetry']['enabled'] = config.getboolean('telemetry',
+                                                           'enabled')
+        CONFIG['telemetry']['hostname'] = config.get('telemetry', 'hostname')
+        CONFIG['telemetry']['port'] = config.getint('telemetry', 'port')
+
+    CONFIG['adaptive'] = {'enabled': False}
+    if 'adaptive' in config.sections():
+        CONFIG['adaptive']['enabled'] = config.getboolean('adaptive',
+                                                          'enabled')
+        for key in ('alpha', 'warn_deviation', 'fail_deviation',
+                    'warn_floor', 'fail_floor'):
+            CONFIG['adaptive'][key] = config.getfloat('adaptive', key)
+        if not 0 < CONFIG['adaptive']['alpha'] <= 1:
+            raise IOError("[adaptive] alpha must be between 0 and 1 in {0}".
+                          format(filename))
+        CONFIG['adaptive']['baseline_file'] = ''
+        if config.has_option('adaptive', 'baseline_file'):
+            CONFIG['adaptive']['baseline_file'] = config.get('adaptive',
+                                                             'baseline_file')
+
+    CONFIG['dampening'] = {'enabled': False}
+    if 'dampening' in config.sections():
+        CONFIG['dampening']['enabled'] = config.getboolean('dampening',
+                                                           'enabled')
+        for key in ('half_life', 'suppress', 'reuse', 'penalty',
+                    'max_suppress'):
+            CONFIG['dampening'][key] = config.getfloat('dampening', key)
+        if CONFIG['dampening']['reuse'] >= CONFIG['dampening']['suppress']:
+            raise IOError("[dampening] reuse must be lower than suppress in "
+                          "{0}".format(filename))
+
+    CONFIG['recording'] = {'enabled': False, 'directory': '/var/run/hbm',
+                           'records': 17280}
+    if 'recording' in config.sections():
+        CONFIG['recording']['enabled'] = config.getboolean('recording',
+                                                           'enabled')
+        if config.has_option('recording', 'directory'):
+            CONFIG['recording']['directory'] = config.get('recording',
+                                                          'directory')
+        if config.has_option('recording', 'records'):
+            CONFIG['recording']['records'] = config.getint('recording',
+                                                           'records')
+        if CONFIG['recording']['records'] < 1:
+            raise IOError("[recording] records must be at least 1 in {0}".
+                          format(filename))
+
+    CONFIG['journal'] = {'enabled': False, 'directory': '/persist/sys/hbm'}
+    if 'journal' in config.sections():
+        CONFIG['journal']['enabled'] = config.getboolean('journal',
+                                                         'enabled')
+        if config.has_option('journal', 'directory'):
+            CONFIG['journal']['directory'] = config.get('journal',
+                                                        'directory')
+
     CONFIG['interval'] = config.getint('General', 'interval')
     CONFIG['alert_holddown'] = config.getint('General', 'alert_holddown')
     CONFIG['timeout'] = config.getint('General', 'timeout')
+    CONFIG['startup_timeout'] = config.getint('General', 'startup_timeout')
+    CONFIG['eapi_cache_size'] = config.getint('General', 'eapi_cache_size')
+    CONFIG['bfd_sources'] = [source.strip().lower() for source in
+                             config.get('General', 'bfd_sources').split(',')
+                             if source.strip()]
+    CONFIG['bfd_poll_interval'] = config.getfloat('General',
+                                                  'bfd_poll_interval')
     CONFIG['alert_threshold'] = config.getfloat('General', 'alert_threshold')
     CONFIG['failure_threshold'] = config.getfloat('General',
                                                   'failure_threshold')
-    CONFIG['interface1'] = config.get('General', 'interface1')
-    CONFIG['interface2'] = config.get('General', 'interface2')
-    if 'probe_dst_address1' in config.items('General'):
-        CONFIG['probe_dst_address1'] = config.get('General',
-                                                  'probe_dst_address1')
-    if 'probe_dst_address2' in config.items('General'):
-        CONFIG['probe_dst_address2'] = config.get('General',
-                                                  'probe_dst_address2')
+    CONFIG['signal_weights'] = dict(SIGNAL_WEIGHTS)
+    for item in conf_string_to_list(config.get('General', 'signal_weights')):
+        (name, _, weight) = item.partition(':')
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name not in SIGNAL_WEIGHTS:
+            raise IOError("Unknown signal '{0}' in signal_weights in {1}".
+                          format(name, filename))
+        CONFIG['signal_weights'][name] = float(weight)
+    CONFIG['fail_score'] = config.getfloat('General', 'fail_score')
+    CONFIG['probe_window'] = config.getint('General', 'probe_window')
+    for key in ('alert_statistic', 'failure_statistic'):
+        CONFIG[key] = config.get('General', key).strip().lower()
+        if CONFIG[key] != 'avg' and \
+                CONFIG[key] not in RttQuantiles.STATISTICS:
+            raise IOError("{0} must be avg, p50, p95 or p99 in {1}".format(
+                key, filename))
+    CONFIG['quantile_window'] = config.getfloat('General', 'quantile_window')
+    CONFIG['failed_probe_interval'] = config.getfloat(
+        'General', 'failed_probe_interval')
+    CONFIG['recovery'] = config.get('General', 'recovery').strip().lower()
+    if CONFIG['recovery'] not in ('auto', 'approve'):
+        raise IOError("recovery must be auto or approve in {0}".format(
+            filename))
+    CONFIG['batch'] = config.getboolean('General', 'batch')
+    CONFIG['rtt_history'] = config.getint('General', 'rtt_history')
+    CONFIG['paths'] = parse_paths(filename, CONFIG)
+    if not CONFIG['paths']:
+        # No [path:<name>] sections: the two paths of interface1 and
+        #   interface2 share the [eapi] and [peer_eapi] config sets
+        for index in ('1', '2'):
+            interface = config.get('General', 'interface' + index)
+            address = ''
+            if config.has_option('General', 'probe_dst_address' + index):
+                address = config.get('General', 'probe_dst_address' + index)
+            CONFIG['paths'].append({
+                'name': interface,
+                'interface': interface,
+                'probe_dst_address': address,
+                'alert_threshold': CONFIG['alert_threshold'],
+                'failure_threshold': CONFIG['failure_threshold'],
+                'commands': None})
 
     if DEBUG:
         print "CONFIG: {0}\n".format(pformat(CONFIG))
@@ -430,6 +688,71 @@ def parse_config(filename):
     return CONFIG
 
 
+def parse_paths(filename, CONFIG):
+    """Read the [path:<name>] sections of the config file.  Options not
+    given in a section default to the [General] thresholds and the [eapi]
+    and [peer_eapi] config sets.
+
+    Args:
+        filename (str): The path to the config file.
+        CONFIG (dict): The settings parsed so far
+
+    Returns:
+        list: A dict per path with its name, interface, probe_dst_address
+              ('' to discover it), alert_threshold, failure_threshold and
+              commands: the path's own config sets per switch, as
+              {'eapi': {set: commands}, 'peer': {...}}, or None if it uses
+              the shared sets
+    """
+    import ConfigParser
+
+    # Read without the [General] defaults so an option missing from a
+    #   section is not mistaken for one set in it
+    config = ConfigParser.SafeConfigParser()
+    config.read(filename)
+
+    paths = []
+    interfaces = set()
+    for section in config.sections():
+        if not section.startswith('path:'):
+            continue
+        path = {'name': section[len('path:'):].strip()}
+        if not config.has_option(section, 'interface'):
+            raise IOError("[{0}] has no interface in {1}".format(section,
+                                                                 filename))
+        path['interface'] = config.get(section, 'interface')
+        if path['interface'] in interfaces:
+            raise IOError("Interface {0} is in more than one [path:] section "
+                          "in {1}".format(path['interface'], filename))
+        interfaces.add(path['interface'])
+        path['probe_dst_address'] = ''
+        if config.has_option(section, 'probe_dst_address'):
+            path['probe_dst_address'] = config.get(section,
+                                                   'probe_dst_address')
+        for key in ('alert_threshold', 'failure_threshold'):
+            path[key] = CONFIG[key]
+            if config.has_option(section, key):
+                path[key] = config.getfloat(section, key)
+
+        path['commands'] = None
+        own = [(switch, name) for switch, prefix in (('eapi', ''),
+                                                     ('peer', 'peer_'))
+               for name in CONFIG_SETS
+               if config.has_option(section, prefix + name)]
+        if own:
+            path['commands'] = {}
+            for switch in ('eapi', 'peer'):
+                path['commands'][switch] = dict(
+                    (name, (CONFIG.get(switch) or {}).get(name, []))
+                    for name in CONFIG_SETS)
+            for (switch, name) in own:
+                option = name if switch == 'eapi' else 'peer_' + name
+                path['commands'][switch][name] = conf_string_to_list(
+                    config.get(section, option))
+        paths.append(path)
+    return paths
+
+
 def conf_string_to_list(list_as_string):
     """Given a 'list' as returned from ConfigParser, split it, trim it,
     then return a real list object.
@@ -447,28 +770,6 @@ def conf_string_to_list(list_as_string):
     return list_from_string
 
 
-def run_cmds(eapi, cmds):
-    """Returns the output of eapi_client.runCmds()
-
-    Args:
-        eapi (obj): JSONrpc Switch object
-        cmds (list): List of commands to execute on a switch
-
-    Returns:
-        list: JSONrpc response
-    """
-
-    if DEBUG:
-        print "Executing commands: {}".format(pformat(cmds))
-
-    try:
-        eapi.runCmds(1, cmds)
-    except jsonrpclib.jsonrpc.ProtocolError as err:
-        log("Command Error: {}. Attempted commands: {}.".format(
-            err[0][1], json.loads(jsonrpclib.history.request)['params'][1]),
-            error=True)
-
-
 def intfStatus(eapi, intf):
     """Returns interface status of the given intf
 
@@ -515,36 +816,1263 @@ def check_path(dst_address):
     return (retcode, pmin, pavg, pmax, pmdev)
 
 
-def wait_for_eapi(eapi):
+def call_with_backoff(func, args=(), retry_on=(socket.error,), deadline=None,
+                      initial_delay=0.1, max_delay=2.0, description=''):
+    """Call func(*args), retrying with exponential backoff on the given
+    exceptions until it succeeds or the deadline passes.
+
+    Args:
+        func (callable): The function to call
+        args (tuple): Positional arguments for func
+        retry_on (tuple): Exception classes which trigger a retry
+        deadline (float): Absolute CLOCK.time() after which the last error is
+                          re-raised instead of retrying. (Default: None, retry
+                          forever)
+        initial_delay (float): Seconds to wait after the first failure
+        max_delay (float): Upper bound on the delay between attempts
+        description (str): What we are waiting for, used in log messages
+
+    Returns:
+        The return value of func
+    """
+    delay = initial_delay
+    attempts = 0
+    while True:
+        try:
+            return func(*args)
+        except retry_on as err:
+            attempts += 1
+            now = ibypass_common.CLOCK.time()
+            if deadline is not None and now >= deadline:
+                log('Gave up waiting for {} after {} attempts: {}'.format(
+                    description, attempts, err), level='WARNING')
+                raise
+            if attempts == 1:
+                log('Waiting for {}...'.format(description))
+            else:
+                log('Still waiting for {} ({})'.format(description, err),
+                    level='DEBUG')
+            if deadline is not None:
+                delay = min(delay, deadline - now)
+            ibypass_common.CLOCK.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+
+def wait_for_eapi(eapi, deadline=None):
     """Continuously test whether eAPI is enabled on a switch before continuing
 
     Args:
         eapi (obj): JSONrpc Switch object
+        deadline (float): Absolute CLOCK.time() at which to stop waiting and
+                          raise the last socket error. (Default: None)
+    """
+    call_with_backoff(eapi.runCmds, args=(1, ['enable']), deadline=deadline,
+                      description='eAPI to be enabled')
+
+
+class DecisionEngine(object):
+    """Combine the failure signals seen for each monitored path into one
+    health score.
+
+    Each signal has a level from 0 (healthy) to 1 (failed) per path:
+
+        bfd        1 while a BFD peer on the path is reported down
+        interface  1 while the interface is reported down
+        probe      the fraction of max_fail_count heartbeat failures seen
+        rtt        the fraction of max_warn_count degraded heartbeats seen
+
+    The score is the weighted sum of the levels and the path fails when it
+    reaches the threshold.  With the default weights a BFD Down or a link
+    down fails the path at once instead of waiting out the heartbeat
+    counters, while heartbeat degradation brings a failure forward by
+    counting towards the score.
+    """
+
+    def __init__(self, weights=None, threshold=1.0):
+        """
+        Args:
+            weights (dict): Weight per signal name, see SIGNAL_WEIGHTS
+            threshold (float): Score at which a path fails
+        """
+        self.weights = dict(SIGNAL_WEIGHTS)
+        self.weights.update(weights or {})
+        self.threshold = threshold
+        self.signals = {}
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add_callback(self, callback):
+        """Call callback(path) when a signal change fails a path"""
+        self._callbacks.append(callback)
+
+    def record(self, path, signal, level, source=''):
+        """Set the level of one signal on a path
+
+        Args:
+            path (str): The monitored interface
+            signal (str): A key of SIGNAL_WEIGHTS
+            level (float): 0 (healthy) to 1 (failed)
+            source (str): What reported the signal, for logging
+        """
+        level = min(max(float(level), 0.0), 1.0)
+        with self._lock:
+            signals = self.signals.setdefault(path, {})
+            if signals.get(signal, 0.0) == level:
+                return
+            before = self._score(signals) >= self.threshold
+            signals[signal] = level
+            after = self._score(signals) >= self.threshold
+        if signal in ('bfd', 'interface'):
+            log('{} signal on {} is now {} ({})'.format(
+                signal, path, level, source or 'unknown'), level='DEBUG')
+        if after and not before:
+            for callback in self._callbacks:
+                callback(path)
+
+    def _score(self, signals):
+        return sum(self.weights.get(signal, 0.0) * level
+                   for signal, level in signals.items())
+
+    def score(self, path):
+        """Return the weighted health score of a path"""
+        with self._lock:
+            return self._score(self.signals.get(path, {}))
+
+    def failed(self, path):
+        """Return the signals behind a path's failure, or None if the path
+        is healthy
+        """
+        with self._lock:
+            signals = self.signals.get(path, {})
+            if self._score(signals) < self.threshold:
+                return None
+            return sorted(signal for signal, level in signals.items()
+                          if level > 0 and self.weights.get(signal))
+
+    def clear(self, path):
+        """Forget the heartbeat signals of a path which recovered.  Its
+        BFD and interface signals stay until their sources report them up.
+        """
+        with self._lock:
+            signals = self.signals.get(path, {})
+            for name in ('probe', 'rtt'):
+                signals.pop(name, None)
+
+    def faults(self, path):
+        """Return the signals other than the heartbeats which still report
+        a fault on a path.  A failed path does not recover while there are
+        any, however good its heartbeats.
+        """
+        with self._lock:
+            signals = self.signals.get(path, {})
+            return sorted(signal for signal, level in signals.items()
+                          if signal not in ('probe', 'rtt') and level > 0 and
+                          self.weights.get(signal))
+
+    def failed_paths(self):
+        """Return the paths whose score has reached the threshold"""
+        with self._lock:
+            return [path for path, signals in self.signals.items()
+                    if self._score(signals) >= self.threshold]
+
+    def degraded(self, path):
+        """Return True if heartbeats on a path are failing or slow, so
+        other detectors should watch it more closely
+        """
+        with self._lock:
+            signals = self.signals.get(path, {})
+            return signals.get('probe', 0) > 0 or signals.get('rtt', 0) > 0
+
+
+class ProbeWindow(object):
+    """The outcomes of the last size heartbeats of a path, in a ring buffer.
+
+    The ring is the path's slot in the outcome storage of its PathTable, so
+    the windows of every path sit in one block of memory which
+    BatchEvaluator can update for all paths at once.  push() returns the
+    outcome it overwrote so the caller can keep running "k of the last n"
+    counts in O(1) per probe and constant memory.
+    """
+
+    GOOD, WARN, FAIL, EMPTY = range(4)
+    COUNTERS = {GOOD: 'good_count', WARN: 'warn_count', FAIL: 'fail_count'}
+
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        """
+        Args:
+            table (PathTable): The table holding the window
+            row (int): The path's row in the table
+        """
+        self.table = table
+        self.row = row
+
+    @property
+    def size(self):
+        """Number of recent outcomes kept"""
+        return self.table.columns['window_size'][self.row]
+
+    @property
+    def start(self):
+        """Index of the window's first slot in the table's outcomes"""
+        return self.row * self.table.width
+
+    @property
+    def ring(self):
+        """A copy of the window's slots"""
+        return self.table.outcomes[self.start:self.start + self.size]
+
+    def push(self, outcome):
+        """Record an outcome, returning the one it replaced"""
+        positions = self.table.columns['window_pos']
+        index = self.start + positions[self.row]
+        evicted = self.table.outcomes[index]
+        self.table.outcomes[index] = outcome
+        positions[self.row] = (positions[self.row] + 1) % self.size
+        return evicted
+
+    def clear(self, outcome):
+        """Forget every recorded occurrence of an outcome"""
+        outcomes = self.table.outcomes
+        for index in xrange(self.start, self.start + self.size):
+            if outcomes[index] == outcome:
+                outcomes[index] = self.EMPTY
+
+    def outcomes(self):
+        """Return the recorded outcomes, oldest first"""
+        (ring, pos) = (self.ring, self.table.columns['window_pos'][self.row])
+        ordered = ring[pos:] + ring[:pos]
+        return [value for value in ordered if value != self.EMPTY]
+
+    def count(self, outcome):
+        """Return how many of the recorded outcomes match"""
+        return self.ring.count(chr(outcome))
+
+    def resize(self, size):
+        """Keep the last size outcomes"""
+        size = max(int(size), 1)
+        outcomes = self.outcomes()[-size:]
+        self.table.widen(size)
+        self.table.outcomes[self.start:self.start + self.table.width] = \
+            bytearray([self.EMPTY]) * self.table.width
+        self.table.columns['window_size'][self.row] = size
+        self.table.columns['window_pos'][self.row] = 0
+        for outcome in outcomes:
+            self.push(outcome)
+
+
+class RttBaseline(object):
+    """Exponentially weighted mean and variance of a path's heartbeat RTT.
+
+    Warn and fail thresholds are the baseline plus a number of standard
+    deviations, kept between an absolute floor and the configured fixed
+    thresholds as ceilings.  Each sample costs O(1).
+    """
+
+    # Samples needed before the adaptive thresholds are used
+    MIN_SAMPLES = 20
+
+    __slots__ = ('alpha', 'warn_deviation', 'fail_deviation', 'warn_floor',
+                 'fail_floor', 'mean', 'var', 'samples')
+    # The standard deviation is taken as at least this fraction of the mean,
+    #   so a very steady path does not warn on every small variation
+    MIN_RELATIVE_STD = 0.1
+
+    def __init__(self, alpha=0.05, warn_deviation=3.0, fail_deviation=6.0,
+                 warn_floor=2.0, fail_floor=4.0):
+        """
+        Args:
+            alpha (float): Weight of each new sample, 0 < alpha <= 1
+            warn_deviation (float): Standard deviations above the mean at
+                                    which a heartbeat is degraded
+            fail_deviation (float): Standard deviations above the mean at
+                                    which a heartbeat fails
+            warn_floor (float): Lowest warn threshold in ms
+            fail_floor (float): Lowest fail threshold in ms
+        """
+        self.alpha = alpha
+        self.warn_deviation = warn_deviation
+        self.fail_deviation = fail_deviation
+        self.warn_floor = warn_floor
+        self.fail_floor = fail_floor
+        self.mean = 0.0
+        self.var = 0.0
+        self.samples = 0
+
+    def update(self, rtt):
+        """Add an RTT sample in ms"""
+        if self.samples == 0:
+            self.mean = rtt
+        else:
+            diff = rtt - self.mean
+            incr = self.alpha * diff
+            self.mean += incr
+            self.var = (1 - self.alpha) * (self.var + diff * incr)
+        self.samples += 1
+
+    def thresholds(self, warn_ceiling, fail_ceiling):
+        """Return the (warn, fail) thresholds in ms.  The ceilings are
+        returned unchanged until the baseline has MIN_SAMPLES samples.
+        """
+        if self.samples < self.MIN_SAMPLES:
+            return (warn_ceiling, fail_ceiling)
+        std = max(self.var ** 0.5, self.MIN_RELATIVE_STD * self.mean)
+        warn = max(self.mean + self.warn_deviation * std, self.warn_floor)
+        fail = max(self.mean + self.fail_deviation * std, self.fail_floor)
+        return (min(warn, warn_ceiling), min(fail, fail_ceiling))
+
+    def state(self):
+        """Return the learned baseline as a dict"""
+        return {'mean': self.mean, 'var': self.var, 'samples': self.samples}
+
+    def restore(self, state):
+        """Continue from a baseline returned by state()"""
+        self.mean = float(state['mean'])
+        self.var = float(state['var'])
+        self.samples = int(state['samples'])
+
+
+class P2Quantile(object):
+    """Estimate one quantile of a stream in constant memory with the P-square
+    algorithm (Jain and Chlamtac, 1985).
+
+    Five markers track the minimum, the quantile, the maximum and two
+    points in between; each sample moves them in O(1).  Until five samples
+    have been seen the exact quantile of those samples is returned.
+    """
+
+    __slots__ = ('p', 'count', 'heights', 'positions', 'desired',
+                 'increments')
+
+    def __init__(self, p):
+        """
+        Args:
+            p (float): The quantile to estimate, e.g. 0.95
+        """
+        self.p = p
+        self.count = 0
+        self.heights = array.array('d', [0.0] * 5)
+        self.positions = array.array('d', [0.0, 1.0, 2.0, 3.0, 4.0])
+        self.desired = array.array('d', [0.0, 2 * p, 4 * p, 2 + 2 * p, 4.0])
+        self.increments = (0.0, p / 2, p, (1 + p) / 2, 1.0)
+
+    def add(self, value):
+        """Add a sample"""
+        (heights, positions) = (self.heights, self.positions)
+        if self.count < 5:
+            heights[self.count] = value
+            self.count += 1
+            if self.count == 5:
+                self.heights = heights = array.array('d', sorted(heights))
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+        for index in xrange(cell + 1, 5):
+            positions[index] += 1
+        for index in xrange(5):
+            self.desired[index] += self.increments[index]
+
+        for index in (1, 2, 3):
+            offset = self.desired[index] - positions[index]
+            if (offset >= 1 and
+                    positions[index + 1] - positions[index] > 1) or \
+                    (offset <= -1 and
+                     positions[index - 1] - positions[index] < -1):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(index, step)
+                if not heights[index - 1] < height < heights[index + 1]:
+                    height = heights[index] + step * (
+                        heights[index + step] - heights[index]) / (
+                        positions[index + step] - positions[index])
+                heights[index] = height
+                positions[index] += step
+        self.count += 1
+
+    def _parabolic(self, index, step):
+        (heights, positions) = (self.heights, self.positions)
+        return heights[index] + step / (
+            positions[index + 1] - positions[index - 1]) * (
+            (positions[index] - positions[index - 1] + step) *
+            (heights[index + 1] - heights[index]) /
+            (positions[index + 1] - positions[index]) +
+            (positions[index + 1] - positions[index] - step) *
+            (heights[index] - heights[index - 1]) /
+            (positions[index] - positions[index - 1]))
+
+    def value(self):
+        """Return the current estimate, or None before the first sample"""
+        if self.count == 0:
+            return None
+        if self.count < 5:
+            seen = sorted(self.heights[:self.count])
+            return seen[int(round(self.p * (self.count - 1)))]
+        return self.heights[2]
+
+
+class RttQuantiles(object):
+    """p50, p95 and p99 heartbeat RTT over a recent time window.
+
+    Samples go to a P2Quantile per quantile for the current window.  When
+    the window ends it becomes the previous window and a new one starts;
+    estimates come from the current window once it has MIN_SAMPLES samples
+    and from the previous one before that.  Memory is a few hundred bytes
+    per path whatever the probe rate or uptime.
+    """
+
+    STATISTICS = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
+    MIN_SAMPLES = 5
+
+    __slots__ = ('window', 'current', 'previous', 'started')
+
+    def __init__(self, window=300):
+        """
+        Args:
+            window (float): Seconds of samples each estimate covers
+        """
+        self.window = window
+        self.current = self._sketches()
+        self.previous = None
+        self.started = None
+
+    def _sketches(self):
+        return dict((name, P2Quantile(p))
+                    for name, p in self.STATISTICS.items())
+
+    def add(self, rtt, now=None):
+        """Add an RTT sample in ms"""
+        if now is None:
+            now = ibypass_common.CLOCK.time()
+        if self.started is None:
+            self.started = now
+        elif now - self.started >= self.window:
+            self.previous = self.current
+            self.current = self._sketches()
+            self.started = now
+        for sketch in self.current.values():
+            sketch.add(rtt)
+
+    def get(self, name):
+        """Return the named statistic, e.g. 'p95', or None without samples
+        """
+        sketch = self.current[name]
+        if sketch.count < self.MIN_SAMPLES and self.previous is not None:
+            sketch = self.previous[name]
+        return sketch.value()
+
+
+class BaselineStore(object):
+    """Save the RTT baselines of every path to a file so a restarted monitor
+    does not have to learn them again
+    """
+
+    SAVE_INTERVAL = 300
+
+    def __init__(self, filename):
+        """
+        Args:
+            filename (str): The path to the baseline file
+        """
+        self.filename = filename
+        self.saved = {}
+        self._next_save = 0
+
+    @staticmethod
+    def key(device):
+        """Baselines are kept per interface and probe address"""
+        return '{}/{}'.format(device.interface, device.probe_dst_address)
+
+    def load(self):
+        """Read the baseline file.  A missing or unreadable file is not an
+        error; the baselines are learned again.
+        """
+        try:
+            with open(self.filename) as fileh:
+                self.saved = json.load(fileh)
+        except (IOError, OSError, ValueError) as err:
+            log('No RTT baselines loaded from {}: {}'.format(
+                self.filename, err), level='DEBUG')
+            self.saved = {}
+        return self
+
+    def restore(self, devices):
+        """Give each adaptive path without samples its saved baseline"""
+        for device in devices:
+            state = self.saved.get(self.key(device))
+            if device.baseline is None or device.baseline.samples or \
+                    not state:
+                continue
+            try:
+                device.baseline.restore(state)
+            except (KeyError, TypeError, ValueError):
+                continue
+            log('Restored RTT baseline for {}: mean {:.2f} ms over {} '
+                'samples'.format(device.interface, device.baseline.mean,
+                                 device.baseline.samples))
+
+    def save(self, devices, now=None, force=False):
+        """Atomically write the baselines if SAVE_INTERVAL has passed since
+        the last save.  Failure to write the file is not fatal.
+        """
+        if now is None:
+            now = ibypass_common.CLOCK.time()
+        if now < self._next_save and not force:
+            return False
+        learned = [device for device in devices
+                   if device.baseline is not None and device.baseline.samples]
+        if not learned:
+            return False
+        self._next_save = now + self.SAVE_INTERVAL
+        for device in learned:
+            self.saved[self.key(device)] = device.baseline.state()
+        tmp_file = '{}.{}'.format(self.filename, os.getpid())
+        try:
+            fdesc = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                            0600)
+            with os.fdopen(fdesc, 'w') as fileh:
+                json.dump(self.saved, fileh)
+            os.rename(tmp_file, self.filename)
+        except (IOError, OSError) as err:
+            log('Unable to write RTT baselines {}: {}'.format(
+                self.filename, err), level='DEBUG')
+            try:
+                os.unlink(tmp_file)
+            except OSError:
+                pass
+            return False
+        return True
+
+
+class RttRecorder(object):
+    """Record every heartbeat of a path in a fixed-size ring file which is
+    mapped into memory.
+
+    The file holds a header and capacity records of (timestamp, RTT in ms,
+    ping return code, PathTable state).  A lost reply has a NaN RTT.  Each
+    record is packed straight into the mapping, so recording allocates
+    nothing and costs no system call.  The kernel writes the pages back to
+    the file, so the history survives a restart of the monitor and can be
+    read by hbm_history.py while the monitor runs.
     """
-    eapi_enabled = False
-    while not eapi_enabled:
+
+    MAGIC = 'HBMRTT01'
+    # magic, record size, capacity, records written since the file was
+    #   created.  The count is updated after each record.
+    HEADER = struct.Struct('<8sIIQ')
+    HEADER_SIZE = 64
+    WRITTEN = struct.Struct('<Q')
+    WRITTEN_OFFSET = 16
+    RECORD = struct.Struct('<dfbB2x')
+
+    __slots__ = ('filename', 'capacity', 'written', '_map')
+
+    def __init__(self, filename, capacity=17280):
+        """Open the ring file, creating or resetting it if it does not hold
+        a ring of this capacity
+
+        Args:
+            filename (str): The path to the ring file
+            capacity (int): Number of records kept
+        """
+        self.filename = filename
+        self.capacity = max(int(capacity), 1)
+        size = self.HEADER_SIZE + self.capacity * self.RECORD.size
+        fdesc = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            reset = os.fstat(fdesc).st_size != size
+            if reset:
+                os.ftruncate(fdesc, size)
+            self._map = mmap.mmap(fdesc, size)
+        finally:
+            os.close(fdesc)
+        (magic, record_size, capacity, written) = \
+            self.HEADER.unpack_from(self._map, 0)
+        if reset or magic != self.MAGIC or \
+                record_size != self.RECORD.size or capacity != self.capacity:
+            written = 0
+            self._map[:size] = '\0' * size
+            self.HEADER.pack_into(self._map, 0, self.MAGIC, self.RECORD.size,
+                                  self.capacity, 0)
+        self.written = written
+
+    def record(self, timestamp, rtt, retcode, state):
+        """Add one heartbeat, replacing the oldest once the ring is full
+
+        Args:
+            timestamp (float): time.time() of the heartbeat
+            rtt (float): The RTT in ms, None if no reply was received
+            retcode (int): The ping return code
+            state (int): The path's PathTable state
+        """
+        offset = self.HEADER_SIZE + \
+            (self.written % self.capacity) * self.RECORD.size
+        self.RECORD.pack_into(self._map, offset, timestamp,
+                              NAN if rtt is None else rtt,
+                              max(min(retcode, 127), -128), state)
+        self.written += 1
+        self.WRITTEN.pack_into(self._map, self.WRITTEN_OFFSET, self.written)
+
+    def close(self):
+        """Unmap the file"""
+        self._map.close()
+
+    @classmethod
+    def read(cls, filename, start=None, end=None):
+        """Return the records of a ring file, oldest first, without
+        disturbing the monitor writing it.  The oldest record of a full
+        ring is left out as the monitor may be overwriting it.
+
+        Args:
+            filename (str): The path to the ring file
+            start (float): Skip records before this time
+            end (float): Skip records after this time
+
+        Returns:
+            list: (timestamp, rtt, retcode, state) tuples
+        """
+        with open(filename, 'rb') as fileh:
+            data = mmap.mmap(fileh.fileno(), 0, access=mmap.ACCESS_READ)
         try:
-            eapi.runCmds(1, ['enable'])
-            eapi_enabled = True
-        except socket.error:
-            log('Waiting for eAPI to be enabled...')
-            time.sleep(1)
+            (magic, record_size, capacity, written) = \
+                cls.HEADER.unpack_from(data, 0)
+            if magic != cls.MAGIC or record_size != cls.RECORD.size:
+                raise IOError('{} is not an RTT ring file'.format(filename))
+            oldest = max(written - capacity, 0)
+            records = [cls.RECORD.unpack_from(
+                data, cls.HEADER_SIZE + (index % capacity) * cls.RECORD.size)
+                       for index in xrange(oldest, written)]
+            (now_written,) = cls.WRITTEN.unpack_from(data,
+                                                     cls.WRITTEN_OFFSET)
+        finally:
+            data.close()
+        # Drop the oldest records if the monitor overwrote them while they
+        #   were read, or may be writing the next one over them
+        records = records[max(now_written + 1 - capacity - oldest, 0):]
+        return [record for record in records
+                if (start is None or record[0] >= start) and
+                (end is None or record[0] <= end)]
+
+
+class FlapDamper(object):
+    """Route-flap style dampening of a path's ok_config.
+
+    Each failure, and each recovery from one, adds a penalty which halves
+    every half_life seconds.  Once the penalty reaches suppress, returning
+    to Up does not re-apply ok_config until the penalty has decayed below
+    reuse, so a bouncing path stays bypassed instead of churning both
+    switches.  The penalty is capped so a path is never suppressed for more
+    than max_suppress seconds after its last transition.
+    """
+
+    __slots__ = ('half_life', 'suppress', 'reuse', 'increment',
+                 'max_suppress', 'penalty', 'flaps', 'is_suppressed',
+                 '_updated', '_down')
+
+    def __init__(self, half_life=900, suppress=2000, reuse=750,
+                 penalty=500, max_suppress=3600):
+        """
+        Args:
+            half_life (float): Seconds for the penalty to halve
+            suppress (float): Penalty at which ok_config is suppressed
+            reuse (float): Penalty below which ok_config is allowed again
+            penalty (float): Penalty added per failure or recovery
+            max_suppress (float): Longest suppression in seconds
+        """
+        self.half_life = half_life
+        self.suppress = suppress
+        self.reuse = reuse
+        self.increment = penalty
+        self.max_suppress = max_suppress
+        self.penalty = 0.0
+        self.flaps = 0
+        self.is_suppressed = False
+        self._updated = None
+        self._down = False
+
+    def _decay(self, now):
+        if now is None:
+            now = ibypass_common.CLOCK.time()
+        if self._updated is not None and now > self._updated:
+            self.penalty *= 0.5 ** (float(now - self._updated) /
+                                    self.half_life)
+        self._updated = now
+        if self.is_suppressed and self.penalty < self.reuse:
+            self.is_suppressed = False
+
+    def _charge(self, now):
+        self._decay(now)
+        ceiling = self.reuse * 2 ** (float(self.max_suppress) /
+                                     self.half_life)
+        self.penalty = min(self.penalty + self.increment, ceiling)
+        if self.penalty >= self.suppress:
+            self.is_suppressed = True
+
+    def flap(self, now=None):
+        """Add the penalty for one failure"""
+        self._charge(now)
+        self.flaps += 1
+        self._down = True
+
+    def recover(self, now=None):
+        """Add the penalty for a recovery from a failure.  Coming up for
+        the first time, or from Warn, is not a flap and adds nothing.
+        """
+        if self._down:
+            self._charge(now)
+            self._down = False
+
+    def suppressed(self, now=None):
+        """Return True while ok_config must not be applied"""
+        self._decay(now)
+        return self.is_suppressed
+
+    def reuse_in(self, now=None):
+        """Return the seconds until ok_config is allowed again"""
+        if not self.suppressed(now):
+            return 0
+        return self.half_life * math.log(self.penalty / self.reuse, 2)
+
+
+class PathTable(object):
+    """Heartbeat state and counters for many paths, stored column-wise.
+
+    Each path is a row.  Its state and counters are kept in compact arrays
+    rather than on the Heartbeat, and the transitions are data in
+    TRANSITIONS rather than code, so one tick() evaluates every path in a
+    single pass.  The owning Heartbeat's callbacks (on_up, on_warn, on_fail)
+    and any table callbacks run only on a state change.
+
+    Heartbeat exposes its row as ordinary attributes (state, good_count,
+    ...), so a path can be moved between tables, e.g. from the private table
+    each Heartbeat starts with to the table shared by a monitor.  The
+    outcomes behind the counters are kept in the same way, width slots per
+    row in one bytearray, see ProbeWindow, as are the RTTs of the last
+    history replies of each path, in one array of doubles.
+    """
+
+    NOT_STARTED, STARTUP, UP, WARN, FAILED = range(5)
+    NAMES = ('not started', 'starting up', 'up', 'warn', 'failed')
+
+    COLUMNS = {
+        # name: (array typecode, initial value)
+        'state': ('b', NOT_STARTED),
+        'good_count': ('l', 0),
+        'warn_count': ('l', 0),
+        'fail_count': ('l', 0),
+        'min_good_count': ('l', 3),
+        'max_warn_count': ('l', 3),
+        'max_fail_count': ('l', 3),
+        # ok_config was suppressed by dampening and is still to be applied
+        'ok_pending': ('b', 0),
+        # An operator approved recovery from Failed, see Heartbeat.approve
+        'approved': ('b', 0),
+        # RTT in ms at which a heartbeat is degraded or failed
+        'warn_threshold': ('d', 4.0),
+        'fail_threshold': ('d', 8.0),
+        # The path's ProbeWindow: its size and the slot to write next
+        'window_size': ('l', 5),
+        'window_pos': ('l', 0),
+        # The slot in the path's RTT history to write next
+        'rtt_pos': ('l', 0),
+    }
+
+    # Initial slots per row in outcomes, grown to fit the largest window
+    WIDTH = 8
+    # RTTs kept per row, see resize_history()
+    HISTORY = 32
+
+    # Per state, in priority order: (condition, next state, columns reset,
+    #   log message, email subject, Heartbeat callback).  The counters are
+    #   outcomes within the path's ProbeWindow.  'fail' is met when
+    #   fail_count reaches max_fail_count or the path's DecisionEngine fails
+    #   it, 'warn' when warn_count reaches max_warn_count and 'good' when
+    #   good_count reaches min_good_count.  'recovered' is 'good' with no
+    #   BFD or interface fault left in the DecisionEngine, plus operator
+    #   approval if the path requires it.  A state with no condition met
+    #   moves to its default in DEFAULT.
+    TRANSITIONS = {
+        NOT_STARTED: (
+            ('good', UP, (), "Device came up.  Setting state STARTUP --> UP",
+             "Heartbeats up", 'on_up'),
+        ),
+        STARTUP: (
+            ('good', UP, (), "Device came up.  Setting state STARTUP --> UP",
+             "Heartbeats up", 'on_up'),
+        ),
+        UP: (
+            ('fail', FAILED, ('good_count',),
+             "Device {reason}.  Setting state --> DOWN",
+             "Heartbeats down", 'on_fail'),
+            ('warn', WARN, ('good_count',),
+             "Device reached max_warn_count.  Setting state --> WARN",
+             "Heartbeats down", 'on_warn'),
+        ),
+        WARN: (
+            ('fail', FAILED, ('good_count',),
+             "Device {reason}.  Setting state --> DOWN",
+             "Heartbeats down", 'on_fail'),
+            ('good', UP, ('warn_count',),
+             "Device came up.  Setting state WARN --> UP",
+             "Heartbeats up", 'on_up'),
+        ),
+        FAILED: (
+            ('recovered', UP, ('fail_count', 'warn_count', 'approved'),
+             "Device came up.  Setting state FAILED --> UP",
+             "Heartbeats up", 'on_up'),
+        ),
+    }
+    DEFAULT = {NOT_STARTED: STARTUP}
+
+    def __init__(self):
+        self.columns = {}
+        for name, (typecode, _) in self.COLUMNS.items():
+            self.columns[name] = array.array(typecode)
+        self.width = self.WIDTH
+        self.outcomes = bytearray()
+        self.history = self.HISTORY
+        self.rtts = array.array('d')
+        self.devices = []
+        # Records each state change, see EventJournal
+        self.journal = None
+        self._free = []
+        self._callbacks = []
+
+    def __len__(self):
+        return len(self.devices) - len(self._free)
+
+    def add_callback(self, callback):
+        """Call callback(device, old, new) when a path changes state"""
+        self._callbacks.append(callback)
+
+    def add(self, device):
+        """Allocate a row for device, reusing a released row if possible
+
+        Returns:
+            int: The row number
+        """
+        if self._free:
+            row = self._free.pop()
+            self.devices[row] = device
+            for name, (_, initial) in self.COLUMNS.items():
+                self.columns[name][row] = initial
+            self.outcomes[row * self.width:(row + 1) * self.width] = \
+                bytearray([ProbeWindow.EMPTY]) * self.width
+            self.rtts[row * self.history:(row + 1) * self.history] = \
+                array.array('d', [NAN]) * self.history
+        else:
+            row = len(self.devices)
+            self.devices.append(device)
+            for name, (_, initial) in self.COLUMNS.items():
+                self.columns[name].append(initial)
+            self.outcomes.extend(bytearray([ProbeWindow.EMPTY]) * self.width)
+            self.rtts.extend(array.array('d', [NAN]) * self.history)
+        return row
+
+    def release(self, row):
+        """Free a row for reuse"""
+        self.devices[row] = None
+        self._free.append(row)
+
+    def widen(self, width):
+        """Make room for windows of up to width outcomes in every row"""
+        if width <= self.width:
+            return
+        padding = bytearray([ProbeWindow.EMPTY]) * (width - self.width)
+        outcomes = bytearray()
+        for start in xrange(0, len(self.outcomes), self.width):
+            outcomes += self.outcomes[start:start + self.width] + padding
+        (self.outcomes, self.width) = (outcomes, width)
+
+    def resize_history(self, size):
+        """Keep the RTTs of the last size replies of each row, 0 for none
+        """
+        size = max(int(size), 0)
+        if size == self.history:
+            return
+        rows = [self.rtt_history(row)[-size:] if size else []
+                for row in xrange(len(self.devices))]
+        self.history = size
+        self.rtts = array.array('d', [NAN]) * (size * len(rows))
+        positions = self.columns['rtt_pos']
+        for row, rtts in enumerate(rows):
+            positions[row] = 0
+            for rtt in rtts:
+                self.add_rtt(row, rtt)
+
+    def add_rtt(self, row, rtt):
+        """Add the RTT in ms of a reply to a row's history"""
+        if not self.history:
+            return
+        positions = self.columns['rtt_pos']
+        self.rtts[row * self.history + positions[row]] = rtt
+        positions[row] = (positions[row] + 1) % self.history
+
+    def rtt_history(self, row):
+        """Return the RTTs in a row's history, oldest first"""
+        start = row * self.history
+        (ring, pos) = (self.rtts[start:start + self.history],
+                       self.columns['rtt_pos'][row])
+        # Unused slots hold NaN, which is not equal to itself
+        return [rtt for rtt in ring[pos:] + ring[:pos] if rtt == rtt]
+
+    def adopt(self, device):
+        """Move device, with its state, counters, window and RTT history,
+        into this table
+        """
+        if device.table is self:
+            return
+        row = self.add(device)
+        for name in self.COLUMNS:
+            self.columns[name][row] = device.table.columns[name][device.row]
+        window = device.window
+        self.widen(window.size)
+        self.outcomes[row * self.width:row * self.width + window.size] = \
+            window.ring
+        for rtt in device.table.rtt_history(device.row):
+            self.add_rtt(row, rtt)
+        device.table.release(device.row)
+        (device.table, device.row) = (self, row)
+
+    def tick(self, rows=None):
+        """Evaluate the transitions of the given rows, default all, and run
+        the callbacks of each path which changed state
+
+        Returns:
+            list: (device, old state, new state) for each change
+        """
+        columns = self.columns
+        (state, good, warn, fail) = (columns['state'], columns['good_count'],
+                                     columns['warn_count'],
+                                     columns['fail_count'])
+        (min_good, max_warn, max_fail) = (columns['min_good_count'],
+                                          columns['max_warn_count'],
+                                          columns['max_fail_count'])
+        (ok_pending, approved) = (columns['ok_pending'], columns['approved'])
+        if rows is None:
+            rows = xrange(len(self.devices))
+
+        edges = []
+        for row in rows:
+            device = self.devices[row]
+            if device is None:
+                continue
+            current = state[row]
+            met = {'good': good[row] >= min_good[row],
+                   'warn': warn[row] >= max_warn[row]}
+            reason = None
+            if fail[row] >= max_fail[row] or device.engine is not None:
+                reason = device.failing()
+            met['fail'] = reason is not None
+            # A path failed on BFD or its interface stays failed until the
+            #   source reports it up again
+            faults = []
+            if current == self.FAILED and met['good'] and \
+                    device.engine is not None:
+                faults = device.engine.faults(device.interface)
+            met['recovered'] = met['good'] and not faults and (
+                approved[row] or not device.require_approval)
+            if faults:
+                device.hold_recovery(faults)
+            elif current == self.FAILED and met['good'] and \
+                    not met['recovered']:
+                device.await_approval()
+
+            for transition in self.TRANSITIONS[current]:
+                if met[transition[0]]:
+                    device.reset_counts(transition[2])
+                    state[row] = transition[1]
+                    edges.append((row, current, transition, reason))
+                    break
+            else:
+                state[row] = self.DEFAULT.get(current, current)
+                if ok_pending[row] and current == self.UP:
+                    device.reuse()
+
+        changes = []
+        for (row, old, transition, reason) in edges:
+            device = self.devices[row]
+            (condition, new, _, message, subject, callback) = transition
+            log(message.format(reason=reason), email=True, subject=subject)
+            if self.journal is not None:
+                self.journal.transition(device.name, old, new,
+                                        reason or condition)
+            getattr(device, callback)()
+            changes.append((device, old, new))
+            for table_callback in self._callbacks:
+                table_callback(device, old, new)
+        return changes
+
+
+class BatchEvaluator(object):
+    """Evaluate a round of heartbeats for every path of a PathTable at once.
+
+    With NumPy the results of all paths go into arrays, and the threshold
+    comparisons, window and counter updates, decision engine levels and
+    transition conditions are computed with vectorized operations on
+    zero-copy views of the table's columns.  Python code then only runs for
+    the paths with something to do: a failed or degraded heartbeat to log,
+    an engine level which changed, a transition condition which is met or
+    a heartbeat to record with RttRecorder.
+
+    Paths with per-path RTT state (adaptive thresholds or quantile
+    statistics) are evaluated one at a time by Heartbeat.evaluate(), as is
+    every path when NumPy is not installed; the results are the same.
+    """
+
+    def __init__(self, table, vectorize=True):
+        """
+        Args:
+            table (PathTable): The paths to evaluate
+            vectorize (bool): Use NumPy if it is installed
+        """
+        self.table = table
+        self.numpy = None
+        if vectorize:
+            try:
+                import numpy
+                self.numpy = numpy
+            except ImportError:
+                pass
+        self.engine = None
+        self.individual = bytearray()
+        self.recorded = bytearray()
+        self.paths = {}
+        self.levels = {}
+
+    def refresh(self):
+        """Note which paths must be evaluated one at a time and which
+        engine the others share.  Called again whenever rows are added.
+        """
+        devices = self.table.devices
+        self.engine = None
+        for device in devices:
+            if device is not None and device.engine is not None:
+                self.engine = device.engine
+                break
+        self.individual = bytearray(len(devices))
+        self.recorded = bytearray(len(devices))
+        self.paths = {}
+        for row, device in enumerate(devices):
+            if device is None:
+                continue
+            self.recorded[row] = device.recorder is not None
+            self.paths.setdefault(device.interface, []).append(row)
+            if device.baseline is not None or \
+                    device.rtt_quantiles is not None or \
+                    device.engine not in (None, self.engine):
+                self.individual[row] = 1
+        # Engine levels last reported per row; NaN reports them again
+        self.levels = {}
+        for signal_name in ('probe', 'rtt'):
+            self.levels[signal_name] = self.numpy.empty(len(devices))
+            self.levels[signal_name].fill(self.numpy.nan)
+
+    def column(self, name):
+        """Return a NumPy view of a table column"""
+        column = self.table.columns[name]
+        return self.numpy.frombuffer(column, dtype=column.typecode)
+
+    def probe(self, devices):
+        """Send a heartbeat on each device's path and evaluate the results
+        together
+
+        Args:
+            devices (list): Heartbeats in this evaluator's table
+        """
+        results = []
+        for device in devices:
+            with ibypass_common.TIMINGS.timed('probe'):
+                results.append(check_path(device.probe_dst_address))
+        with ibypass_common.TIMINGS.timed('stats'):
+            self.record([device.row for device in devices],
+                        [result[0] for result in results],
+                        [result[2] for result in results])
+
+    def record(self, rows, retcodes, rtts):
+        """Evaluate one heartbeat result for each of the given paths
+
+        Args:
+            rows (list): Table rows, each at most once
+            retcodes (list): The ping return code for each row
+            rtts (list): The average RTT in ms for each row, None without a
+                         reply
+        """
+        numpy = self.numpy
+        devices = self.table.devices
+        if numpy is None:
+            for (row, retcode, rtt) in zip(rows, retcodes, rtts):
+                devices[row].evaluate(retcode, rtt)
+            return
+        if not len(rows):
+            return
+        if len(self.individual) != len(devices):
+            self.refresh()
+
+        rows = numpy.asarray(rows, dtype=numpy.intp)
+        individual = numpy.frombuffer(self.individual,
+                                      dtype=numpy.uint8)[rows] != 0
+        for index in numpy.flatnonzero(individual):
+            devices[rows[index]].evaluate(retcodes[index], rtts[index])
+        batch = numpy.flatnonzero(~individual)
+        if not len(batch):
+            return
+        rows = rows[batch]
+        retcodes = numpy.asarray(retcodes)[batch]
+        rtts = numpy.array(rtts, dtype=float)[batch]
+
+        # Thresholds; a lost reply (NaN RTT) fails on its return code
+        (warn_threshold, fail_threshold) = (self.column('warn_threshold'),
+                                            self.column('fail_threshold'))
+        with numpy.errstate(invalid='ignore'):
+            failed = (retcodes != 0) | (rtts > fail_threshold[rows])
+            degraded = ~failed & (rtts > warn_threshold[rows])
+        outcomes = numpy.empty(len(rows), dtype=numpy.uint8)
+        outcomes.fill(ProbeWindow.GOOD)
+        outcomes[degraded] = ProbeWindow.WARN
+        outcomes[failed] = ProbeWindow.FAIL
+
+        # Windows and the counters of the outcomes added and replaced
+        table = self.table
+        ring = numpy.frombuffer(table.outcomes, dtype=numpy.uint8)
+        (size, pos) = (self.column('window_size'), self.column('window_pos'))
+        slots = rows * table.width + pos[rows]
+        evicted = ring[slots]
+        ring[slots] = outcomes
+        pos[rows] = (pos[rows] + 1) % size[rows]
+        if table.history:
+            replied = rows[retcodes == 0]
+            history = numpy.frombuffer(table.rtts, dtype='d')
+            rtt_pos = self.column('rtt_pos')
+            history[replied * table.history + rtt_pos[replied]] = \
+                rtts[retcodes == 0]
+            rtt_pos[replied] = (rtt_pos[replied] + 1) % table.history
+        recorded = numpy.flatnonzero(
+            numpy.frombuffer(self.recorded, dtype=numpy.uint8)[rows])
+        if len(recorded):
+            (now, state) = (ibypass_common.CLOCK.time(), self.column('state'))
+            for index in recorded:
+                devices[rows[index]].recorder.record(
+                    now, rtts[index], int(retcodes[index]),
+                    state[rows[index]])
+        for (outcome, name) in ProbeWindow.COUNTERS.items():
+            counts = self.column(name)
+            counts[rows] = numpy.maximum(
+                counts[rows] + (outcomes == outcome) - (evicted == outcome),
+                0)
+
+        (fail_count, warn_count) = (self.column('fail_count'),
+                                    self.column('warn_count'))
+        for index in numpy.flatnonzero(failed):
+            (row, device) = (rows[index], devices[rows[index]])
+            log("Device check failed {} of the last {} times ({}, {} {}/{})."
+                .format(fail_count[row], size[row], retcodes[index],
+                        device.fail_statistic,
+                        None if retcodes[index] else rtts[index],
+                        fail_threshold[row]),
+                level='WARNING')
+        for index in numpy.flatnonzero(degraded):
+            row = rows[index]
+            log("Device check degraded {} of the last {} times.".format(
+                warn_count[row], size[row]),
+                email=True, subject='Heartbeats degraded',
+                level='WARNING')
+
+        if self.engine is not None:
+            self.report(rows, 'probe', fail_count,
+                        self.column('max_fail_count'))
+            self.report(rows, 'rtt', warn_count,
+                        self.column('max_warn_count'))
+
+    def report(self, rows, signal_name, counts, limits):
+        """Pass the engine the signal levels which changed since they were
+        last reported
+        """
+        levels = counts[rows] / limits[rows].astype(float)
+        reported = self.levels[signal_name]
+        changed = self.numpy.flatnonzero(levels != reported[rows])
+        reported[rows] = levels
+        for index in changed:
+            self.engine.record(self.table.devices[rows[index]].interface,
+                               signal_name, levels[index])
+
+    def tick(self, rows=None):
+        """Find the paths whose transition conditions are met and evaluate
+        only those with PathTable.tick()
+
+        Args:
+            rows (list): Table rows to consider, default all
+
+        Returns:
+            list: (device, old state, new state) for each change
+        """
+        numpy = self.numpy
+        table = self.table
+        if numpy is None or not len(table.devices):
+            return table.tick(rows)
+        if len(self.individual) != len(table.devices):
+            self.refresh()
+        if rows is None:
+            rows = numpy.arange(len(table.devices))
+        rows = numpy.asarray(rows, dtype=numpy.intp)
+
+        current = self.column('state')[rows]
+        met = {
+            'good': self.column('good_count')[rows] >=
+            self.column('min_good_count')[rows],
+            'warn': self.column('warn_count')[rows] >=
+            self.column('max_warn_count')[rows],
+            'fail': self.column('fail_count')[rows] >=
+            self.column('max_fail_count')[rows],
+        }
+        # Approval, when required, is checked by PathTable.tick()
+        met['recovered'] = met['good']
+        selected = (current == PathTable.UP) & \
+            (self.column('ok_pending')[rows] != 0)
+        for (state, transitions) in table.TRANSITIONS.items():
+            in_state = current == state
+            if state in table.DEFAULT:
+                selected |= in_state
+                continue
+            for transition in transitions:
+                selected |= in_state & met[transition[0]]
+
+        # Paths the decision engine fails regardless of their counters
+        if self.engine is not None:
+            failed = self.engine.failed_paths()
+            if failed:
+                wanted = numpy.zeros(len(table.devices), dtype=bool)
+                for path in failed:
+                    wanted[self.paths.get(path, [])] = True
+                selected |= wanted[rows]
+        changes = table.tick(rows[selected].tolist())
+        # on_up() cleared the heartbeat signals of a recovered path from the
+        #   engine, so report them again
+        for (device, _, new) in changes:
+            if new == PathTable.UP:
+                for reported in self.levels.values():
+                    reported[device.row] = numpy.nan
+        return changes
 
 
 class State(object):
     """The methods of this class are a template for the required states of a
-    device
+    device.  Transitions between states are defined in
+    PathTable.TRANSITIONS.
     """
-    def run(self):
+    def run(self, heartbeat=None):
         """Override this to define actions to run in this state
         """
         assert 0, "run not implemented"
 
-    def next(self, heartbeat):
-        """Override this to define the next state based on some analysis
-        """
-        assert 0, "next not implemented"
-
 
 class StateMachine(object):
     """This sets the initial state and maintains state during execution
@@ -554,127 +2082,78 @@ class StateMachine(object):
         self.currentState.run()
 
     # Template method:
-    def runAll(self, devices):
-        """For each device, passed, run next() to get the next state, then
-        run the run() method for that state
+    def runAll(self, devices, evaluator=None):
+        """Evaluate the transitions of every device in one pass per
+        PathTable, then run the run() method of each device's state
+
+        Args:
+            devices (list): The Heartbeats to evaluate
+            evaluator (BatchEvaluator): Evaluates the transitions of its
+                                        table, if given
         """
-        for device in devices:
-            if DEBUG:
-                print "Run State @ call: " + str(device.state)
-            self.currentState = self.currentState.next(device)
-            self.currentState.run()
+        with ibypass_common.TIMINGS.timed('evaluate'):
+            tables = collections.OrderedDict()
+            for device in devices:
+                if DEBUG:
+                    print "Run State @ call: " + str(device.state)
+                tables.setdefault(id(device.table),
+                                  (device.table, []))[1].append(device.row)
+            for (table, rows) in tables.values():
+                if evaluator is not None and evaluator.table is table:
+                    evaluator.tick(rows)
+                else:
+                    table.tick(rows)
+            for device in devices:
+                self.currentState = self.STATES[device.table.columns['state'][
+                    device.row]]
+                self.currentState.run(device)
 
 
 class Startup(State):
     """Define the Startup state.  In this state eAPI is being verified
-    and initial heartbeats are generated.
+    and initial heartbeats are generated.  Continue in the Startup state
+    until the minimum good heartbeats pass.
     """
-    def run(self):
+    def run(self, heartbeat=None):
         if DEBUG:
             print "Starting up"
 
-    def next(self, heartbeat):
-        """Continue in the Startup state until the minimum good heartbeats
-        pass
-        """
-        if heartbeat.good_count == heartbeat.min_good_count:
-            heartbeat.state = "up"
-            log("Device came up.  Setting state STARTUP --> UP",
-                email=True,
-                subject="Heartbeats up")
-            heartbeat.on_up()
-            return Status.up
-        heartbeat.state = "starting up"
-        return Status.startup
-
 
 class Up(State):
     """Define the Up state.  Heartbeats are passing and we are monitoring
-    then path.
+    then path.  Too many heartbeat failures within the probe window cause
+    the state to go down.  Too many heartbeats beyond the warning threshold
+    within the window cause the state to go to warn.
     """
-    def run(self):
+    def run(self, heartbeat=None):
         if DEBUG:
             print "Up"
 
-    def next(self, heartbeat):
-        """Too many consecutive heartbeat failures cause the state to go down.
-        Too many consecutive heartbeats beyond the warning threshold cause the
-        state to go to warn.
-        """
-        if heartbeat.fail_count == heartbeat.max_fail_count:
-            heartbeat.state = "failed"
-            heartbeat.good_count = 0
-            log("Device reached max_fail_count.  Setting state --> DOWN",
-                email=True,
-                subject="Heartbeats down")
-            heartbeat.on_fail()
-            return Status.failed
-        elif heartbeat.warn_count == heartbeat.max_warn_count:
-            heartbeat.state = "warn"
-            heartbeat.good_count = 0
-            log("Device reached max_warn_count.  Setting state --> WARN",
-                email=True,
-                subject="Heartbeats down")
-            heartbeat.on_warn()
-            return Status.warn
-        return Status.up
-
 
 class Failed(State):
-    """Define the Failed state
+    """Define the Failed state.  The path is probed at a reduced rate.  Once
+    there are sufficient successful heartbeats within the window, and an
+    operator approved it if the path requires approval, transition to Up.
     """
-    def run(self):
-        """Exit on failure.  Enforces manual intervention to recover.
+    def run(self, heartbeat=None):
+        """Keep monitoring and repeat the failure alert every
+        alert_holddown seconds
         """
         if DEBUG:
             print "Failed"
-        exit()
-
-    def next(self, heartbeat):
-        """IF allowed to auto-recover, once there are sufficient consecutive
-        successful heartbeats, transition to Up.
-        """
-        if heartbeat.good_count == heartbeat.min_good_count:
-            heartbeat.state = "up"
-            heartbeat.fail_count = 0
-            heartbeat.warn_count = 0
-            log("Device came up.  Setting state FAILED --> UP",
-                email=True,
-                subject="Heartbeats up")
-            heartbeat.on_up()
-            return Status.up
-        return Status.failed
+        if heartbeat is not None:
+            heartbeat.remind()
 
 
 class Warn(State):
-    """Define the Warn state.  Send alerts but keep running.
+    """Define the Warn state.  Send alerts but keep running.  If heartbeats
+    fail repeatedly, transition to Down.  If heartbeat latency improves,
+    go back to Up.
     """
-    def run(self):
+    def run(self, heartbeat=None):
         if DEBUG:
             print "Warning"
 
-    def next(self, heartbeat):
-        """If heartbeats fail consecutively, transition to Down.  If heartbeat
-        latency improves, go back to Up.
-        """
-        if heartbeat.fail_count == heartbeat.max_fail_count:
-            heartbeat.state = "failed"
-            heartbeat.good_count = 0
-            log("Device reached max_fail_count.  Setting state --> DOWN",
-                email=True,
-                subject="Heartbeats down")
-            heartbeat.on_fail()
-            return Status.failed
-        elif heartbeat.good_count == heartbeat.min_good_count:
-            heartbeat.warn_count = 0
-            heartbeat.state = "up"
-            log("Device came up.  Setting state WARN --> UP",
-                email=True,
-                subject="Heartbeats up")
-            heartbeat.on_up()
-            return Status.up
-        return Status.warn
-
 
 class Status(StateMachine):
     """Define the valid states and initial state
@@ -686,35 +2165,96 @@ Status.startup = Startup()
 Status.up = Up()
 Status.failed = Failed()
 Status.warn = Warn()
+# Indexed by PathTable state
+Status.STATES = (Status.startup, Status.startup, Status.up, Status.warn,
+                 Status.failed)
+
+
+def _row_attribute(name):
+    """Return a property which stores a Heartbeat attribute in its
+    PathTable row
+    """
+    def fget(self):
+        return self.table.columns[name][self.row]
+
+    def fset(self, value):
+        self.table.columns[name][self.row] = value
+    return property(fget, fset)
 
 
 class Heartbeat(object):
-    """State machine to monitor devices
+    """State machine to monitor devices.  The state, counters and RTT
+    history are stored in a PathTable row.  The remaining attributes are
+    slots, and the switch and config set settings are references to the
+    parsed config shared by every path, so a path costs a few hundred bytes.
     """
 
-    def __init__(self, probe_dst_address, interface='', timeout=1):
+    __slots__ = ('probe_dst_address', 'interface', 'timeout', 'name',
+                 'table', 'row', 'baseline', 'damper', 'warn_statistic',
+                 'fail_statistic', 'rtt_quantiles', 'eapi', 'peer',
+                 'commands', 'pause_seconds', 'alert_holddown',
+                 'failed_probe_interval', 'require_approval', '_next_probe',
+                 '_next_alert', '_awaiting_approval', '_held', 'dispatcher',
+                 'engine', 'recorder')
+
+    good_count = _row_attribute('good_count')
+    warn_count = _row_attribute('warn_count')
+    fail_count = _row_attribute('fail_count')
+    min_good_count = _row_attribute('min_good_count')
+    max_warn_count = _row_attribute('max_warn_count')
+    max_fail_count = _row_attribute('max_fail_count')
+    approved = _row_attribute('approved')
+    warn_threshold = _row_attribute('warn_threshold')
+    fail_threshold = _row_attribute('fail_threshold')
+
+    def __init__(self, probe_dst_address, interface='', timeout=1,
+                 table=None):
         """Set initial state
 
         Args:
             probe_dst_address (str): IP address to use as the ping destination
             interface (str): Linux interface name on which to send probes
             timeout (int): Ping timeout setting
+            table (PathTable): Where to keep the state, by default a new
+                               table of one path
         """
 
         self.probe_dst_address = probe_dst_address
         self.interface = interface
         self.timeout = timeout
 
+        # The [path:<name>] section name, or the interface
+        self.name = interface
+
+        if table is None:
+            table = PathTable()
+        self.table = table
+        self.row = table.add(self)
+
         self.state = 'not started'
-        self.status = None
 
         # Number of ms at which to consider heartbeat a warn or fail
         self.warn_threshold = 4
         self.fail_threshold = 8
 
-        # eAPI config from the INI file
+        # Learned RTT, see RttBaseline.  None uses the thresholds above.
+        self.baseline = None
+
+        # Holds back ok_config while the path flaps, see FlapDamper.  None
+        #   disables dampening.
+        self.damper = None
+
+        # The RTT statistic compared with each threshold: 'avg' for each
+        #   heartbeat's own RTT, or a quantile from rtt_quantiles
+        self.warn_statistic = 'avg'
+        self.fail_statistic = 'avg'
+        self.rtt_quantiles = None
+
+        # eAPI config from the INI file, and the path's own config sets if
+        #   it has any, see Dispatcher.apply
         self.eapi = {}
         self.peer = {}
+        self.commands = None
 
         self.good_count = 0
         self.warn_count = 0
@@ -725,42 +2265,337 @@ class Heartbeat(object):
 
         self.pause_seconds = 10
 
-        self.alert_holddown = 0  # 0 = exit on failure
+        # Seconds between repeated alerts while failed, 0 = alert once
+        self.alert_holddown = 0
+
+        # While failed, probe every failed_probe_interval seconds and
+        #   recover only once approve() is called if require_approval
+        self.failed_probe_interval = 30
+        self.require_approval = False
+        self._next_probe = 0
+        self._next_alert = None
+        self._awaiting_approval = False
+        # The faults last reported as keeping the path failed, see
+        #   hold_recovery()
+        self._held = None
+
+        # Shared with other paths and detectors, see Dispatcher
+        self.dispatcher = None
+
+        # Combines heartbeats with BFD and interface state, see
+        #   DecisionEngine.  None uses the heartbeat counters alone.
+        self.engine = None
+
+        # Keeps every heartbeat in a ring file, see RttRecorder.  None
+        #   records nothing.
+        self.recorder = None
 
     def __str__(self):
         return self.state
 
+    @property
+    def state(self):
+        """The name of the current state"""
+        return PathTable.NAMES[self.table.columns['state'][self.row]]
+
+    @state.setter
+    def state(self, name):
+        self.table.columns['state'][self.row] = PathTable.NAMES.index(name)
+
+    @property
+    def window(self):
+        """The outcomes of the recent heartbeats behind the counters"""
+        return ProbeWindow(self.table, self.row)
+
     def do_health_check(self):
         """Generate a heartbeat. If successful, compare latency with
         configured thresholds. Increment status counters on the object.
         """
-        (retcode, pmin, pavg, pmax, pmdev) = check_path(self.probe_dst_address)
+        with ibypass_common.TIMINGS.timed('probe'):
+            (retcode, pmin, pavg, pmax, pmdev) = \
+                check_path(self.probe_dst_address)
         log('Received echo reply min/agv/max/mdev '
             '{}/{}/{}/{} ms'.format(pmin,
                                     pavg,
                                     pmax,
                                     pmdev),
             level='DEBUG')
+        with ibypass_common.TIMINGS.timed('stats'):
+            self.evaluate(retcode, pavg)
+
+    def evaluate(self, retcode, pavg):
+        """Classify one heartbeat result against the thresholds and update
+        the window, counters, RTT statistics and decision engine
 
-        if retcode is not 0 or pavg > self.fail_threshold:
-            self.fail_count += 1
-            log("Device check failed {} times ({}, {}/{}).".
-                format(self.fail_count, retcode, pavg, self.fail_threshold),
+        Args:
+            retcode (int): The ping return code, 0 if a reply was received
+            pavg (float): The average RTT in ms, None without a reply
+        """
+        (warn_threshold, fail_threshold) = self.thresholds()
+        if retcode == 0 and self.rtt_quantiles is not None:
+            self.rtt_quantiles.add(pavg)
+        fail_rtt = self.statistic(self.fail_statistic, pavg)
+        if retcode is not 0 or fail_rtt > fail_threshold:
+            self.record(ProbeWindow.FAIL)
+            log("Device check failed {} of the last {} times ({}, {} {}/{})."
+                .format(self.fail_count, self.window.size, retcode,
+                        self.fail_statistic, fail_rtt, fail_threshold),
                 level='WARNING')
-        elif pavg > self.warn_threshold:
-            self.warn_count += 1
-            log("Device check degraded {} times.".format(self.warn_count),
+        elif self.statistic(self.warn_statistic, pavg) > warn_threshold:
+            self.record(ProbeWindow.WARN)
+            log("Device check degraded {} of the last {} times.".format(
+                self.warn_count, self.window.size),
                 email=True, subject='Heartbeats degraded',
                 level='WARNING')
         else:
-            self.good_count += 1
+            self.record(ProbeWindow.GOOD)
+
+        if retcode == 0:
+            self.table.add_rtt(self.row, pavg)
+        if self.recorder is not None:
+            self.recorder.record(ibypass_common.CLOCK.time(),
+                                 pavg if retcode == 0 else None, retcode,
+                                 self.table.columns['state'][self.row])
+
+        # Learn from every reply which did not fail, so the baseline
+        # follows slow changes such as time of day load
+        if self.baseline is not None and retcode == 0 and \
+                pavg <= fail_threshold:
+            self.baseline.update(pavg)
+
+        if self.engine is not None:
+            self.engine.record(self.interface, 'probe',
+                               float(self.fail_count) / self.max_fail_count)
+            self.engine.record(self.interface, 'rtt',
+                               float(self.warn_count) / self.max_warn_count)
+
+    def statistic(self, name, rtt):
+        """Return the RTT statistic a threshold applies to
+
+        Args:
+            name (str): 'avg' or a key of RttQuantiles.STATISTICS
+            rtt (float): This heartbeat's RTT in ms, returned for 'avg' or
+                         while no quantile is available
+        """
+        if name == 'avg' or self.rtt_quantiles is None:
+            return rtt
+        value = self.rtt_quantiles.get(name)
+        return rtt if value is None else value
+
+    def thresholds(self):
+        """Return the (warn, fail) RTT thresholds in ms, adapted to the
+        path's baseline if it has one
+        """
+        if self.baseline is None:
+            return (self.warn_threshold, self.fail_threshold)
+        return self.baseline.thresholds(self.warn_threshold,
+                                        self.fail_threshold)
+
+    def record(self, outcome):
+        """Add a heartbeat outcome to the window, updating the counters for
+        the outcome added and the one it replaced
+
+        Args:
+            outcome (int): ProbeWindow.GOOD, WARN or FAIL
+        """
+        evicted = self.window.push(outcome)
+        if evicted in ProbeWindow.COUNTERS:
+            name = ProbeWindow.COUNTERS[evicted]
+            setattr(self, name, max(getattr(self, name) - 1, 0))
+        name = ProbeWindow.COUNTERS[outcome]
+        setattr(self, name, getattr(self, name) + 1)
+
+    def reset_counts(self, names):
+        """Zero counters and forget the outcomes behind them, so the next
+        transition needs fresh heartbeats
+
+        Args:
+            names (list): Counter names, e.g. ['good_count']
+        """
+        outcomes = dict((name, outcome) for outcome, name in
+                        ProbeWindow.COUNTERS.items())
+        for name in names:
+            if name in outcomes:
+                self.window.clear(outcomes[name])
+            setattr(self, name, 0)
+
+    def resize_window(self, size):
+        """Keep the last size outcomes, at least enough for every
+        threshold, and recount
+        """
+        size = max(size, self.min_good_count, self.max_warn_count,
+                   self.max_fail_count)
+        window = self.window
+        if size == window.size:
+            return
+        window.resize(size)
+        for outcome, name in ProbeWindow.COUNTERS.items():
+            setattr(self, name, window.count(outcome))
+
+    def rtts(self):
+        """Return the RTTs in ms of the path's recent replies, oldest first
+        """
+        return self.table.rtt_history(self.row)
+
+    def summary(self, now=None):
+        """Return a one line summary of the path for status output"""
+        (warn_threshold, fail_threshold) = self.thresholds()
+        line = ('{} {} {} good {}/{} warn {} fail {} thresholds '
+                '{:.1f}/{:.1f}ms'.format(
+                    self.interface if self.name == self.interface else
+                    '{} ({})'.format(self.interface, self.name),
+                    self.probe_dst_address, self.state,
+                    self.good_count, self.window.size, self.warn_count,
+                    self.fail_count, warn_threshold, fail_threshold))
+        rtts = self.rtts()
+        if rtts:
+            line += ' rtt avg {:.1f}ms'.format(sum(rtts) / len(rtts))
+        if self.state == 'failed' and self.engine is not None:
+            faults = self.engine.faults(self.interface)
+            if faults:
+                line += ' held by {}'.format(','.join(faults))
+        if self.state == 'failed' and self.require_approval:
+            line += ' approved' if self.approved else ' awaiting approval'
+        if self.damper is not None:
+            line += ' penalty {:.0f}'.format(self.damper.penalty)
+            if self.damper.suppressed(now):
+                line += ' suppressed reuse in {:.0f}s'.format(
+                    self.damper.reuse_in(now))
+        return line
+
+    def failing(self):
+        """Return why the path should fail, or None if it is healthy
+        """
+        if self.fail_count >= self.max_fail_count:
+            return 'reached max_fail_count'
+        if self.engine is not None:
+            signals = self.engine.failed(self.interface)
+            if signals:
+                return 'failed on {} (score {:.2f})'.format(
+                    ', '.join(signals), self.engine.score(self.interface))
+        return None
+
+    def dispatch(self, name):
+        """Apply a config set to the local and peer switch
+
+        Args:
+            name (str): The config set, e.g. 'ok_config'
+        """
+        if self.dispatcher is None:
+            self.dispatcher = Dispatcher({'eapi': self.eapi,
+                                          'peer': self.peer})
+        self.dispatcher.apply(name, path=self.name, commands=self.commands)
+
+    def holding_shared_sets(self):
+        """Return the other paths which share this path's config sets and
+        are not up, or are up with ok_config held back by dampening.  While
+        there are any, the shared ok_config would undo their bypass.
+        """
+        if self.commands:
+            return []
+        return [device.name for device in self.table.devices
+                if device is not None and device is not self and
+                not device.commands and
+                device.dispatcher is self.dispatcher and
+                (device.state not in ('up', 'warn') or
+                 device.table.columns['ok_pending'][device.row])]
+
+    def apply_ok_config(self):
+        """Apply ok_config unless another path sharing it still needs its
+        bypass.  The last of them to recover applies it.
+        """
+        holding = self.holding_shared_sets()
+        if holding:
+            log('{} is up; holding back the ok_config it shares with {} '
+                'until all are up'.format(self.interface,
+                                          ', '.join(holding)),
+                level='WARNING')
+            return
+        self.dispatch('ok_config')
 
     def on_up(self):
-        """Perform actions on transition to up
+        """Perform actions on transition to up.  While the path is dampened
+        ok_config is held back until reuse().
+        """
+        self._next_alert = None
+        self._awaiting_approval = False
+        self._held = None
+        if self.engine is not None:
+            self.engine.clear(self.interface)
+        if self.damper is not None:
+            self.damper.recover()
+        if self.damper is not None and self.damper.suppressed():
+            self.table.columns['ok_pending'][self.row] = 1
+            log('{} is flapping (penalty {:.0f}); not applying ok_config '
+                'for {:.0f}s'.format(self.interface, self.damper.penalty,
+                                     self.damper.reuse_in()),
+                email=True, subject='Heartbeats dampened', level='WARNING')
+            return
+        self.apply_ok_config()
+
+    def probe_due(self, now=None):
+        """Return True if the path should be probed this tick.  Failed paths
+        are probed every failed_probe_interval seconds.
+        """
+        if self.state != 'failed':
+            return True
+        if now is None:
+            now = ibypass_common.CLOCK.time()
+        if now < self._next_probe:
+            return False
+        self._next_probe = now + self.failed_probe_interval
+        return True
+
+    def remind(self, now=None):
+        """Repeat the failure alert every alert_holddown seconds"""
+        if self.alert_holddown <= 0 or self._next_alert is None:
+            return
+        if now is None:
+            now = ibypass_common.CLOCK.time()
+        if now < self._next_alert:
+            return
+        self._next_alert = now + self.alert_holddown
+        log("Heartbeat monitor triggered automatic shutdown of path {} on "
+            "{}.".format(self.name, self.interface),
+            email=True,
+            subject="Heartbeats triggered shutdown")
+
+    def approve(self):
+        """Allow a failed path which requires approval to recover"""
+        if self.state == 'failed' and not self.approved:
+            log('Recovery of {} approved by operator'.format(self.interface))
+            self.approved = 1
+
+    def hold_recovery(self, faults):
+        """Report once that a failed path passes heartbeats again but is
+        kept failed by the faults other signals still report
         """
-        run_cmds(self.eapi['switch'], self.eapi['ok_config'])
-        if self.peer['ok_config']:
-            run_cmds(self.peer['switch'], self.peer['ok_config'])
+        if faults == self._held:
+            return
+        self._held = faults
+        log("{} is passing heartbeats again; keeping it failed while it is "
+            "still down on {}".format(self.interface, ', '.join(faults)),
+            level='WARNING')
+
+    def await_approval(self):
+        """Report once that a failed path is healthy but needs approval"""
+        if self._awaiting_approval:
+            return
+        self._awaiting_approval = True
+        log("{} is passing heartbeats again; run 'hbm_service approve {}' "
+            "to restore it".format(self.interface, self.interface),
+            email=True, subject='Heartbeats recovered, approval required')
+
+    def reuse(self):
+        """Apply ok_config held back by dampening once the path has been
+        stable long enough
+        """
+        if self.damper is not None and self.damper.suppressed():
+            return
+        self.table.columns['ok_pending'][self.row] = 0
+        log('{} is stable again; applying ok_config'.format(self.interface),
+            email=True, subject='Heartbeats up')
+        self.apply_ok_config()
 
     def on_warn(self):
         """Perform actions on transition to warn
@@ -772,26 +2607,23 @@ class Heartbeat(object):
         """
         log('Disabling the monitored path due to multiple failures',
             level='CRIT')
-        run_cmds(self.eapi['switch'], self.eapi['fail_config'])
-        if self.peer['fail_config']:
-            run_cmds(self.peer['switch'], self.peer['fail_config'])
-
-        while self.alert_holddown > 0:
-            # Send alerts on a regular interval until manually stopped.
-            log("Heartbeat monitor triggered automatic shutdown of {}"
-                " and {}.".format(self.interface1, self.interface2),
-                email=True,
-                subject="Heartbeats triggered shutdown")
-            time.sleep(self.alert_holddown)
+        self.table.columns['ok_pending'][self.row] = 0
+        if self.damper is not None:
+            self.damper.flap()
+        self.dispatch('fail_config')
+
+        # Alert now and then every alert_holddown seconds until recovery
+        self._next_alert = 0
+        self._next_probe = ibypass_common.CLOCK.time() + \
+            self.failed_probe_interval
+        self.remind()
 
     def on_shutdown(self):
         """Perform actions on transition to fail
         """
         log('Disabling the monitor process.',
             level='CRIT')
-        run_cmds(self.eapi['switch'], self.eapi['shutdown_config'])
-        if self.peer['shutdown_config']:
-            run_cmds(self.peer['switch'], self.peer['shutdown_config'])
+        self.dispatch('shutdown_config')
 
 
 def get_peer_addr(CONFIG, interface):
@@ -807,8 +2639,6 @@ def get_peer_addr(CONFIG, interface):
     """
     # better done with a module like netaddr or ipaddr but attempting to
     # avoid installing additional modules
-    import subprocess
-
     output = CONFIG['eapi']['switch'].runCmds(1, ['show ip interface %s' %
                                                   interface])[0]
     mask_len = \
@@ -836,6 +2666,484 @@ def get_peer_addr(CONFIG, interface):
     return '.'.join(['.'.join(local_addr.split('.')[0:3]), str(peer_oct)])
 
 
+def _join(threads):
+    """Wait for threads without blocking KeyboardInterrupt (a bare join()
+    is uninterruptible in python 2)
+    """
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.1)
+
+
+def startup(CONFIG, deadline=None):
+    """Bring up the local and peer eAPI sessions and discover any missing
+    probe destination addresses concurrently.
+
+    Address discovery needs the local switch, so each interface lookup starts
+    as soon as local eAPI responds, while the peer switch is polled in
+    parallel.  Time-to-armed is therefore bounded by the slowest dependency
+    rather than the sum of all of them.
+
+    Args:
+        CONFIG (dict): Parsed settings from the config file.  Discovered
+                       addresses are stored in the probe_dst_address of
+                       each path.
+        deadline (float): Absolute CLOCK.time() by which startup must finish
+
+    Returns:
+        dict: Seconds spent in each startup phase, plus 'total'
+    """
+    start = ibypass_common.CLOCK.time()
+    timings = {}
+    errors = []
+    lock = threading.Lock()
+
+    def phase(name, func, *args):
+        """Run and time one startup phase, recording any failure"""
+        begin = ibypass_common.CLOCK.time()
+        try:
+            func(*args)
+        except Exception as err:
+            with lock:
+                errors.append((name, err))
+            return False
+        finally:
+            with lock:
+                timings[name] = ibypass_common.CLOCK.time() - begin
+        return True
+
+    def discover(path):
+        """Find the peer address of one path, retrying until ready"""
+        interface = path['interface']
+        path['probe_dst_address'] = call_with_backoff(
+            get_peer_addr, args=(CONFIG, interface),
+            retry_on=(socket.error, jsonrpclib.jsonrpc.ProtocolError),
+            deadline=deadline,
+            description='address on {}'.format(interface))
+        with lock:
+            CONFIG.setdefault('discovered', {})[interface] = \
+                path['probe_dst_address']
+
+    def local():
+        """Local eAPI, then address discovery for each interface"""
+        if not phase('local eAPI', wait_for_eapi, CONFIG['eapi']['switch'],
+                     deadline):
+            return
+        log('Local eAPI is enabled...', level='DEBUG')
+        lookups = []
+        for path in CONFIG['paths']:
+            if path['probe_dst_address']:
+                continue
+            lookups.append(threading.Thread(
+                target=phase,
+                args=('address {}'.format(path['interface']), discover,
+                      path)))
+        for thread in lookups:
+            thread.daemon = True
+            thread.start()
+        _join(lookups)
+
+    def peer():
+        """Peer eAPI"""
+        if phase('peer eAPI', wait_for_eapi, CONFIG['peer']['switch'],
+                 deadline):
+            log('Peer eAPI is enabled...', level='DEBUG')
+
+    threads = [threading.Thread(target=local)]
+    if CONFIG.get('peer', {}).get('switch'):
+        threads.append(threading.Thread(target=peer))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    _join(threads)
+
+    timings['total'] = ibypass_common.CLOCK.time() - start
+    log('Startup timing: {}'.format(', '.join(
+        '{} {:.3f}s'.format(name, timings[name])
+        for name in sorted(timings))))
+
+    if errors:
+        (name, err) = errors[0]
+        raise RuntimeError('Startup failed in phase {}: {}'.format(name, err))
+
+    return timings
+
+
+def configure_device(device, CONFIG, path=None):
+    """Apply settings from the config to a Heartbeat without touching its
+    state or counters
+
+    Args:
+        device (Heartbeat): The path to configure
+        CONFIG (dict): Parsed settings from the config file
+        path (dict): The path's entry in CONFIG['paths'], if any
+    """
+    if path is None:
+        path = {'alert_threshold': CONFIG['alert_threshold'],
+                'failure_threshold': CONFIG['failure_threshold'],
+                'commands': None}
+    device.eapi = CONFIG['eapi']
+    device.peer = CONFIG['peer']
+    device.commands = path['commands']
+    device.timeout = CONFIG['timeout']
+    device.warn_threshold = path['alert_threshold']
+    device.fail_threshold = path['failure_threshold']
+    device.alert_holddown = CONFIG['alert_holddown']
+    device.failed_probe_interval = CONFIG['failed_probe_interval']
+    device.require_approval = CONFIG['recovery'] == 'approve'
+    device.resize_window(CONFIG['probe_window'])
+    device.warn_statistic = CONFIG.get('alert_statistic', 'avg')
+    device.fail_statistic = CONFIG.get('failure_statistic', 'avg')
+    if device.warn_statistic == 'avg' and device.fail_statistic == 'avg':
+        device.rtt_quantiles = None
+    elif device.rtt_quantiles is None:
+        device.rtt_quantiles = RttQuantiles(CONFIG['quantile_window'])
+    else:
+        device.rtt_quantiles.window = CONFIG['quantile_window']
+    dampening = CONFIG.get('dampening', {})
+    if not dampening.get('enabled'):
+        device.damper = None
+    else:
+        if device.damper is None:
+            device.damper = FlapDamper()
+        device.damper.half_life = dampening['half_life']
+        device.damper.suppress = dampening['suppress']
+        device.damper.reuse = dampening['reuse']
+        device.damper.increment = dampening['penalty']
+        device.damper.max_suppress = dampening['max_suppress']
+    adaptive = CONFIG.get('adaptive', {})
+    if not adaptive.get('enabled'):
+        device.baseline = None
+    else:
+        if device.baseline is None:
+            device.baseline = RttBaseline()
+        for key in ('alpha', 'warn_deviation', 'fail_deviation',
+                    'warn_floor', 'fail_floor'):
+            setattr(device.baseline, key, adaptive[key])
+    recording = CONFIG.get('recording', {})
+    filename = None
+    if recording.get('enabled'):
+        filename = recording_file(recording['directory'], device.name)
+    if device.recorder is not None and \
+            (device.recorder.filename != filename or
+             device.recorder.capacity != recording['records']):
+        device.recorder.close()
+        device.recorder = None
+    if filename is not None and device.recorder is None:
+        try:
+            if not os.path.isdir(recording['directory']):
+                os.makedirs(recording['directory'])
+            device.recorder = RttRecorder(filename, recording['records'])
+        except EnvironmentError as err:
+            log('Unable to record heartbeats of {} in {}: {}'.format(
+                device.name, filename, err), level='WARNING')
+
+
+def recording_file(directory, name):
+    """Return the RttRecorder file of the path with the given name"""
+    return os.path.join(directory, '{}.rtt'.format(name.replace('/', '_')))
+
+
+def build_devices(CONFIG, devices=(), dispatcher=None, engine=None):
+    """Return a configured Heartbeat for each monitored path.
+
+    Existing devices on the same interface are updated in place so their
+    state and counters survive a config reload.  All devices share one
+    PathTable, one Dispatcher and one DecisionEngine.
+
+    Args:
+        CONFIG (dict): Parsed settings from the config file
+        devices (list): Heartbeats currently being monitored
+        dispatcher (Dispatcher): Applies config sets for every path.  By
+                                 default the existing devices' dispatcher or
+                                 a new one.
+        engine (DecisionEngine): Correlates the signals for every path.  By
+                                 default the existing devices' engine or a
+                                 new one.
+
+    Returns:
+        list: The Heartbeats to monitor
+    """
+    table = None
+    for device in devices:
+        dispatcher = dispatcher or device.dispatcher
+        engine = engine or device.engine
+        if table is None:
+            table = device.table
+    if table is None:
+        table = PathTable()
+    table.resize_history(CONFIG['rtt_history'])
+    if dispatcher is None:
+        dispatcher = Dispatcher(CONFIG)
+    dispatcher.config = CONFIG
+    if engine is None:
+        engine = DecisionEngine()
+    engine.weights = dict(CONFIG['signal_weights'])
+    engine.threshold = CONFIG['fail_score']
+
+    unused = list(devices)
+    result = []
+    for path in CONFIG['paths']:
+        (interface, address) = (path['interface'], path['probe_dst_address'])
+        device = None
+        for candidate in unused:
+            if candidate.interface == interface:
+                device = candidate
+                unused.remove(candidate)
+                break
+        if device is None:
+            device = Heartbeat(address, interface=interface, table=table)
+            if devices:
+                log('Monitoring new path {} on {} ({})'.format(
+                    path['name'], interface, address))
+        elif device.probe_dst_address != address:
+            log('Probe address for {} changed from {} to {}'.format(
+                interface, device.probe_dst_address, address))
+            device.probe_dst_address = address
+        device.name = path['name']
+        configure_device(device, CONFIG, path)
+        device.dispatcher = dispatcher
+        device.engine = engine
+        table.adopt(device)
+        result.append(device)
+
+    for device in unused:
+        log('Stopped monitoring path on {} ({}) in state {}'.format(
+            device.interface, device.probe_dst_address, device.state))
+        if device.recorder is not None:
+            device.recorder.close()
+            device.recorder = None
+        PathTable().adopt(device)
+    return result
+
+
+def config_changes(old, new):
+    """List the settings which differ between two parsed configs.  eAPI
+    session objects and discovered addresses are ignored.
+
+    Args:
+        old (dict): The running config
+        new (dict): The newly parsed config
+
+    Returns:
+        list: Names of changed settings, as 'key' or 'section.key'
+    """
+    changes = []
+    for key in sorted(set(old) | set(new)):
+        if key == 'discovered':
+            continue
+        (before, after) = (old.get(key), new.get(key))
+        if key == 'paths':
+            before = dict((path['name'], path) for path in before or [])
+            after = dict((path['name'], path) for path in after or [])
+            for name in sorted(set(before) | set(after)):
+                if before.get(name) != after.get(name):
+                    changes.append('path:{}'.format(name))
+        elif isinstance(before, dict) and isinstance(after, dict):
+            for subkey in sorted(set(before) | set(after)):
+                if subkey == 'switch':
+                    continue
+                if before.get(subkey) != after.get(subkey):
+                    changes.append('{}.{}'.format(key, subkey))
+        elif before != after:
+            changes.append(key)
+    return changes
+
+
+def record_signal(device, event, source='telemetry'):
+    """Pass an interface or BFD state change on a monitored path to the
+    device's decision engine
+
+    Args:
+        device (Heartbeat): The path the event refers to
+        event (dict): A telemetry or BFD poller event
+        source (str): Where the event came from, when not in the event
+    """
+    if device.engine is None:
+        return
+    source = event.get('source', source)
+    if event.get('type') == 'interface':
+        down = event.get('lineProtocolStatus', 'up') != 'up'
+        device.engine.record(device.interface, 'interface', down, source)
+    elif event.get('type') == 'bfd':
+        down = event.get('status', '').lower() == 'down'
+        device.engine.record(device.interface, 'bfd', down, source)
+
+
+def batch_evaluator(CONFIG, devices):
+    """Return a BatchEvaluator for the devices' table if batch evaluation
+    is enabled, otherwise None.  Call again after the devices are rebuilt.
+
+    Args:
+        CONFIG (dict): Parsed settings from the config file
+        devices (list): Heartbeats sharing one PathTable
+    """
+    if not CONFIG['batch'] or not devices:
+        return None
+    evaluator = BatchEvaluator(devices[0].table)
+    if evaluator.numpy is None:
+        log('NumPy is not installed; evaluating heartbeats one path at a '
+            'time', level='WARNING')
+    else:
+        evaluator.refresh()
+    return evaluator
+
+
+def probe_devices(devices, evaluator=None, now=None):
+    """Send a heartbeat on every path due one and evaluate the results
+
+    Args:
+        devices (list): The Heartbeats being monitored
+        evaluator (BatchEvaluator): Evaluates the results together, if
+                                    given
+    """
+    due = [device for device in devices if device.probe_due(now)]
+    if evaluator is None:
+        for device in due:
+            device.do_health_check()
+    else:
+        evaluator.probe(due)
+
+
+def read_approvals(filename, devices):
+    """Approve recovery of the paths listed in filename, one interface or
+    'all' per line, then remove the file
+
+    Args:
+        filename (str): The approval file, e.g. /var/run/hbm.approve
+        devices (list): The Heartbeats being monitored
+    """
+    if not os.path.exists(filename):
+        return
+    try:
+        with open(filename) as fileh:
+            names = set(line.strip() for line in fileh if line.strip())
+        os.unlink(filename)
+    except (IOError, OSError) as err:
+        log('Unable to read approvals from {}: {}'.format(filename, err),
+            level='WARNING')
+        return
+    for device in devices:
+        if 'all' in names or device.interface in names:
+            device.approve()
+
+
+def write_status(filename, devices, now=None):
+    """Atomically replace filename with one status line per path.  Failure
+    to write the file is not fatal.
+
+    Args:
+        filename (str): The status file, e.g. /var/run/hbm.status
+        devices (list): The Heartbeats being monitored
+    """
+    if now is None:
+        now = ibypass_common.CLOCK.time()
+    tmp_file = '{}.{}'.format(filename, os.getpid())
+    try:
+        with open(tmp_file, 'w') as fileh:
+            fileh.write('# {}\n'.format(time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.localtime(now))))
+            for device in devices:
+                fileh.write(device.summary(now) + '\n')
+            for line in ibypass_common.TIMINGS.summary():
+                fileh.write('# {}\n'.format(line))
+        os.rename(tmp_file, filename)
+    except (IOError, OSError) as err:
+        log('Unable to write status file {}: {}'.format(filename, err),
+            level='DEBUG')
+
+
+def open_baselines(CONFIG, config_file, devices):
+    """Load the saved RTT baselines and restore them to the devices
+
+    Args:
+        CONFIG (dict): Parsed settings from the config file
+        config_file (str): The config file path; by default the baselines
+                           are kept next to it
+        devices (list): The Heartbeats being monitored
+
+    Returns:
+        BaselineStore: Where to save the baselines as they are learned
+    """
+    filename = CONFIG.get('adaptive', {}).get('baseline_file') or \
+        '{}.hbm.baseline'.format(config_file)
+    baselines = BaselineStore(filename).load()
+    baselines.restore(devices)
+    return baselines
+
+
+def request_reload(signum, frame):
+    """SIGHUP handler: ask the main loop to re-read the config file"""
+    global RELOAD  # pylint: disable=C0103
+    RELOAD = True
+
+
+def reload_config(filename, CONFIG, devices, cache_file=None):
+    """Re-read the config file and apply any changes to the running monitor.
+
+    eAPI sessions whose URL did not change are reused and addresses
+    discovered for unchanged interfaces are kept.  If the new config cannot
+    be parsed or brought up, the running config stays in effect.
+
+    Args:
+        filename (str): The path to the config file
+        CONFIG (dict): The running config
+        devices (list): Heartbeats currently being monitored
+        cache_file (str): The path to the compiled config cache
+
+    Returns:
+        tuple: (CONFIG, devices) now in effect
+    """
+    try:
+        (new, _, _) = load_config(filename, parse_config,
+                                  cache_file=cache_file,
+                                  required=REQUIRED_CONFIG)
+    except Exception as err:
+        log('Config reload failed, keeping running config: {}'.format(err),
+            error=True)
+        return (CONFIG, devices)
+
+    new['discovered'] = {}
+    for path in new['paths']:
+        interface = path['interface']
+        address = CONFIG.get('discovered', {}).get(interface)
+        if not path['probe_dst_address'] and address:
+            path['probe_dst_address'] = address
+            new['discovered'][interface] = address
+
+    changes = config_changes(CONFIG, new)
+    if not changes:
+        log('Config reloaded, no changes')
+        return (CONFIG, devices)
+
+    for section in ('eapi', 'peer'):
+        (before, after) = (CONFIG.get(section) or {}, new.get(section))
+        if not after or not after.get('url'):
+            continue
+        if before.get('switch') and before.get('url') == after['url']:
+            after['switch'] = before['switch']
+            # Interface addresses may have changed along with the config
+            after['switch'].invalidate()
+            after['switch'].max_entries = new['eapi_cache_size']
+        else:
+            after['switch'] = CachedServer(
+                Server(after['url']), max_entries=new['eapi_cache_size'])
+
+    try:
+        startup(new, deadline=ibypass_common.CLOCK.time() + RELOAD_TIMEOUT)
+    except RuntimeError as err:
+        log('Config reload failed, keeping running config: {}'.format(err),
+            error=True)
+        return (CONFIG, devices)
+
+    if MAIL:
+        MAIL.config = new['email']
+    devices = build_devices(new, devices)
+    log('Config reloaded, applied changes to: {}'.format(', '.join(changes)),
+        email=True, subject='Heartbeats config reloaded')
+    return (new, devices)
+
+
 def main():
     """Main function"""
 
@@ -846,65 +3154,101 @@ def main():
     if not DEBUG:
         syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_INFO))
 
-    CONFIG = parse_config(args.config)
+    cache_file = None
+    if not args.no_config_cache:
+        cache_file = args.config_cache or '{}.hbm.cache'.format(args.config)
+    (CONFIG, source, parse_seconds) = load_config(
+        args.config, parse_config, cache_file=cache_file,
+        required=REQUIRED_CONFIG)
+    log('Startup cost: imports {:.3f}s, config {:.3f}s ({})'.format(
+        IMPORT_SECONDS, parse_seconds, source))
 
     global MAIL
-    MAIL = mail(CONFIG['email'])
+    MAIL = AlertQueue(mail(CONFIG['email'])).start()
 
     # Check cmd line options
     if CONFIG['timeout'] < CONFIG['interval']:
         log('Timeout must be higher than the heartbeat interval.', error=True)
 
     # configure eAPI
-    CONFIG['eapi']['switch'] = Server(CONFIG['eapi']['url'])
-    wait_for_eapi(CONFIG['eapi']['switch'])
-    log('Local eAPI is enabled...', level='DEBUG')
-
-    if CONFIG['peer']['url']:
-        CONFIG['peer']['switch'] = Server(CONFIG['peer']['url'])
-        wait_for_eapi(CONFIG['peer']['switch'])
-        log('Peer eAPI is enabled...', level='DEBUG')
+    CONFIG['eapi']['switch'] = CachedServer(
+        Server(CONFIG['eapi']['url']), max_entries=CONFIG['eapi_cache_size'])
+    if CONFIG.get('peer', {}).get('url'):
+        CONFIG['peer']['switch'] = CachedServer(
+            Server(CONFIG['peer']['url']),
+            max_entries=CONFIG['eapi_cache_size'])
 
     log('Testing path on startup...', email=True,
         subject='Heartbeats starting')
 
-    # Determine peer addresses if not pre-configured
-    if not CONFIG.get('probe_dst_address1'):
-        CONFIG['probe_dst_address1'] = get_peer_addr(CONFIG,
-                                                     CONFIG['interface1'])
-    if not CONFIG.get('probe_dst_address2'):
-        CONFIG['probe_dst_address2'] = get_peer_addr(CONFIG,
-                                                     CONFIG['interface2'])
-
-    # setup to monitor both the A-side and B-side paths..
-    devices = []
-    devices.append(Heartbeat(CONFIG['probe_dst_address1'],
-                             interface=CONFIG['interface1'],
-                             timeout=CONFIG['timeout']))
-    devices.append(Heartbeat(CONFIG['probe_dst_address2'],
-                             interface=CONFIG['interface2'],
-                             timeout=CONFIG['timeout']))
-    for device in devices:
-        device.eapi = CONFIG['eapi']
-        device.peer = CONFIG['peer']
-        device.warn_threshold = CONFIG['alert_threshold']
-        device.fail_threshold = CONFIG['failure_threshold']
-        device.alert_holddown = CONFIG['alert_holddown']
-        device.interface1 = CONFIG['interface1']
-        device.interface2 = CONFIG['interface2']
-        device.status = Status()
-    # Starting up the link
+    # Wait for eAPI and determine peer addresses if not pre-configured
+    deadline = None
+    if CONFIG['startup_timeout'] > 0:
+        deadline = ibypass_common.CLOCK.time() + CONFIG['startup_timeout']
+    startup(CONFIG, deadline=deadline)
+
+    # setup to monitor every path, sharing one table, dispatcher and eAPI
+    # session per switch
+    devices = build_devices(CONFIG)
+    status = Status()
 
+    # Wake the main loop early when telemetry reports a monitored interface
+    # or BFD peer changed, rather than waiting out the probe interval.
+    wake = threading.Event()
+
+    def on_telemetry(event):
+        """Feed monitored path changes to the decision engine and run the
+        next health check now
+        """
+        for device in devices:
+            if event.get('name') == device.interface or \
+                    event.get('peer') == device.probe_dst_address:
+                log('Telemetry: {} changed: {}'.format(
+                    device.interface, event), level='DEBUG')
+                record_signal(device, event)
+                wake.set()
+
+    if CONFIG['telemetry']['enabled']:
+        telemetry = TelemetrySubscriber(CONFIG['telemetry']['hostname'],
+                                        CONFIG['telemetry']['port'])
+        telemetry.add_callback(on_telemetry)
+        telemetry.start()
+
+    signal.signal(signal.SIGHUP, request_reload)
+    signal.siginterrupt(signal.SIGHUP, False)
+    profiler = install_diagnostics('hbm', args)
+
+    baselines = open_baselines(CONFIG, args.config, devices)
+    journal = open_journal(CONFIG, 'hbm', devices)
+    evaluator = batch_evaluator(CONFIG, devices)
+
+    global RELOAD  # pylint: disable=C0103
     while True:
 
         try:
-            for device in devices:
-                device.do_health_check()
-                device.status.runAll([device])
-            time.sleep(CONFIG['interval'])
+            profiler.tick()
+            if RELOAD:
+                RELOAD = False
+                (CONFIG, devices) = reload_config(args.config, CONFIG,
+                                                  devices,
+                                                  cache_file=cache_file)
+                baselines.restore(devices)
+                journal = open_journal(CONFIG, 'hbm', devices, journal)
+                evaluator = batch_evaluator(CONFIG, devices)
+            read_approvals(args.approve_file, devices)
+            probe_devices(devices, evaluator)
+            baselines.save(devices)
+            status.runAll(devices, evaluator)
+            write_status(args.status_file, devices)
+            ibypass_common.CLOCK.wait(wake, CONFIG['interval'])
+            wake.clear()
         except KeyboardInterrupt:
             log('Exiting main loop by user interrupt (^C)',
                 email=True, subject='Heartbeats manually cancelled')
+            baselines.save(devices, force=True)
+            raise
+        except SystemExit:
+            baselines.save(devices, force=True)
             raise
 
     for device in devices:
@@ -920,3 +3264,6 @@ if __name__ == '__main__':
     except Exception, e:
         log('Heartbeat monitor failed: %s (%s)' %
             (e, traceback.format_exc()), error=True)
+    finally:
+        if MAIL:
+            MAIL.stop()
@@ -0,0 +1,1005 @@
+#!/usr/bin/env python
+# pylint: disable=broad-except, invalid-name
+#
+# Copyright (c) 2016, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#  - Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#  - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#  - Neither the name of Arista Networks nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""Read the heartbeat history and event journal recorded by hbm.py,
+bfd_int_sync.py and ibypassd.py.
+
+With a [recording] section enabled, every heartbeat of each path is kept in
+a ring file named <path>.rtt in the recording directory (see RttRecorder in
+hbm.py).  With a [journal] section enabled, state transitions, config
+pushes and BFD failures are appended to <monitor>.jnl in the journal
+directory (see EventJournal).  The files are read without stopping or
+signalling the monitors.
+
+Export the last hour of every path as CSV:
+
+    bash# /usr/bin/hbm_history.py export --start=-1h
+
+or one path between two times as JSON:
+
+    bash# /usr/bin/hbm_history.py export --path segment-a \\
+              --start 2016-05-01T08:00 --end 2016-05-01T09:00 --format json
+
+Show what happened to a path around 03:12:
+
+    bash# /usr/bin/hbm_history.py events --path segment-a \\
+              --start 2016-05-01T03:00 --end 2016-05-01T03:30
+
+Replay the recorded heartbeats of every path against candidate thresholds
+(needs NumPy):
+
+    bash# /usr/bin/hbm_history.py analyze --thresholds 13/15 \\
+              --thresholds 10/20
+
+Run a day of generated heartbeats through the monitor with the thresholds
+and windows of its config, the paths' RTT rising to 30 ms for a minute
+after an hour, and show the state changes, config pushes and how long each
+failure took to detect:
+
+    bash# /usr/bin/hbm_history.py replay --synthetic 86400 \\
+              --fault 3600:60:30
+
+or replay the recorded heartbeats of the last day with other thresholds:
+
+    bash# /usr/bin/hbm_history.py replay --start=-1d --thresholds 10/20
+
+Times are seconds since the epoch, local ISO 8601 times or an offset from
+now such as -90s, -15m, -1h or -2d, written as --start=-1h.
+"""
+
+import argparse
+import collections
+import csv
+import datetime
+import glob
+import itertools
+import json
+import math
+import os
+import random
+import re
+import sys
+import time
+
+import hbm
+from hbm import RttRecorder, PathTable, ProbeWindow, Status, build_devices, \
+    parse_config, probe_devices, recording_file
+import ibypass_common
+from ibypass_common import EventJournal, VirtualClock
+
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+PERCENTILES = (50, 90, 95, 99, 99.9)
+
+FIELDS = ('path', 'timestamp', 'time', 'rtt', 'retcode', 'state')
+
+EVENT_FIELDS = ('timestamp', 'time', 'journal', 'path', 'event', 'state',
+                'result', 'detail')
+
+
+def parse_time(value, now=None):
+    """Return a time argument as seconds since the epoch
+
+    Args:
+        value (str): Seconds since the epoch, a local ISO 8601 time or an
+                     offset from now such as -15m
+
+    Returns:
+        float: The time, or None if value is None
+    """
+    if value is None:
+        return None
+    if now is None:
+        now = time.time()
+    value = value.strip()
+    match = re.match(r'^-(\d+(?:\.\d+)?)([smhd])$', value)
+    if match:
+        return now - float(match.group(1)) * UNITS[match.group(2)]
+    if value == 'now':
+        return now
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            parsed = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return time.mktime(parsed.timetuple())
+    raise ValueError('Unrecognised time {!r}'.format(value))
+
+
+def ring_files(directory, paths=None):
+    """Return {path name: ring file} for the given paths, default every
+    ring file in the directory
+    """
+    if paths:
+        return dict((name, recording_file(directory, name))
+                    for name in paths)
+    return dict((os.path.basename(filename)[:-len('.rtt')], filename)
+                for filename in glob.glob(os.path.join(directory, '*.rtt')))
+
+
+def history(directory, paths=None, start=None, end=None):
+    """Return the recorded heartbeats between start and end
+
+    Args:
+        directory (str): The [recording] directory
+        paths (list): Path names, default every recorded path
+        start (float): Earliest time, default the oldest record
+        end (float): Latest time, default the newest record
+
+    Returns:
+        list: A dict of FIELDS for each heartbeat, in time order
+    """
+    rows = []
+    for (name, filename) in sorted(ring_files(directory, paths).items()):
+        for (timestamp, rtt, retcode, state) in \
+                RttRecorder.read(filename, start, end):
+            rows.append({
+                'path': name,
+                'timestamp': timestamp,
+                'time': datetime.datetime.fromtimestamp(timestamp)
+                .isoformat(),
+                'rtt': None if math.isnan(rtt) else round(rtt, 3),
+                'retcode': retcode,
+                'state': PathTable.NAMES[state]
+                if state < len(PathTable.NAMES) else state,
+            })
+    rows.sort(key=lambda row: row['timestamp'])
+    return rows
+
+
+def events(directory, paths=None, start=None, end=None):
+    """Return the journaled events between start and end
+
+    Args:
+        directory (str): The [journal] directory
+        paths (list): Path names, default every path
+        start (float): Earliest time, default the first event
+        end (float): Latest time, default the last event
+
+    Returns:
+        list: A dict of EVENT_FIELDS for each event, in time order
+    """
+    rows = []
+    for filename in sorted(glob.glob(os.path.join(directory, '*.jnl'))):
+        journal = os.path.basename(filename)[:-len('.jnl')]
+        for path in paths or [None]:
+            for (timestamp, kind, old, new, result, name, detail) in \
+                    EventJournal.query(filename, start, end, path):
+                row = {'timestamp': timestamp,
+                       'time': datetime.datetime.fromtimestamp(timestamp)
+                       .isoformat(),
+                       'journal': journal,
+                       'path': name,
+                       'event': EventJournal.KINDS.get(kind, kind),
+                       'state': '',
+                       'result': '',
+                       'detail': detail}
+                if kind == EventJournal.TRANSITION:
+                    row['state'] = '{} -> {}'.format(
+                        *[PathTable.NAMES[state]
+                          if state < len(PathTable.NAMES) else state
+                          for state in (old, new)])
+                elif kind == EventJournal.PUSH:
+                    row['result'] = 'ok' if result else 'failed'
+                rows.append(row)
+    rows.sort(key=lambda row: row['timestamp'])
+    return rows
+
+
+def load_ring(numpy, filename, start=None, end=None):
+    """Return the records of a ring file as a NumPy record array, oldest
+    first, without unpacking them one by one
+
+    Args:
+        numpy (module): The numpy module
+        filename (str): The path to the ring file
+        start (float): Skip records before this time
+        end (float): Skip records after this time
+
+    Returns:
+        numpy.ndarray: Records with timestamp, rtt, retcode and state fields
+    """
+    dtype = numpy.dtype([('timestamp', '<f8'), ('rtt', '<f4'),
+                         ('retcode', 'i1'), ('state', 'u1'), ('', 'V2')])
+    with open(filename, 'rb') as fileh:
+        data = fileh.read()
+    (magic, record_size, capacity, written) = \
+        RttRecorder.HEADER.unpack_from(data, 0)
+    if magic != RttRecorder.MAGIC or record_size != dtype.itemsize:
+        raise IOError('{} is not an RTT ring file'.format(filename))
+    records = numpy.frombuffer(data, dtype=dtype, count=capacity,
+                               offset=RttRecorder.HEADER_SIZE)
+    if written >= capacity:
+        # Oldest first, leaving out the record the monitor may be writing
+        first = written % capacity
+        records = numpy.concatenate((records[first + 1:], records[:first]))
+    else:
+        records = records[:written]
+    if start is not None:
+        records = records[records['timestamp'] >= start]
+    if end is not None:
+        records = records[records['timestamp'] <= end]
+    return records
+
+
+def simulate(numpy, rtts, lost, warn_threshold, fail_threshold, window=5,
+             min_good=3, max_warn=3, max_fail=3):
+    """Return the state changes a path would have gone through with the
+    given thresholds.
+
+    Each heartbeat is classified with vectorized comparisons and the
+    "k of the last window" counts of every heartbeat come from cumulative
+    sums, so Python only runs once per state change.  The transitions, and
+    the counters they reset, are those of PathTable.  Adaptive thresholds,
+    quantile statistics, dampening, approval and the decision engine are
+    not simulated.
+
+    Args:
+        numpy (module): The numpy module
+        rtts (numpy.ndarray): The RTT of each heartbeat in ms
+        lost (numpy.ndarray): True for each heartbeat without a reply
+        warn_threshold (float): Candidate alert_threshold
+        fail_threshold (float): Candidate failure_threshold
+        window (int): probe_window
+        min_good (int): Good heartbeats to come up
+        max_warn (int): Degraded heartbeats to warn
+        max_fail (int): Failed heartbeats to fail
+
+    Returns:
+        list: (heartbeat index, old state, new state) for each change
+    """
+    window = max(window, min_good, max_warn, max_fail)
+    with numpy.errstate(invalid='ignore'):
+        failed = lost | (rtts > fail_threshold)
+        degraded = ~failed & (rtts > warn_threshold)
+    outcomes = {ProbeWindow.FAIL: failed, ProbeWindow.WARN: degraded,
+                ProbeWindow.GOOD: ~failed & ~degraded}
+    conditions = {'good': (ProbeWindow.GOOD, min_good),
+                  'recovered': (ProbeWindow.GOOD, min_good),
+                  'warn': (ProbeWindow.WARN, max_warn),
+                  'fail': (ProbeWindow.FAIL, max_fail)}
+    count = len(rtts)
+    totals = {}
+    hits = {}
+    for (outcome, matched) in outcomes.items():
+        # totals[outcome][i] is the number of outcomes before heartbeat i
+        totals[outcome] = numpy.zeros(count + 1, dtype=numpy.int32)
+        numpy.cumsum(matched, out=totals[outcome][1:])
+    counts = numpy.empty(count, dtype=numpy.int32)
+    for (outcome, limit) in set(conditions.values()):
+        # The outcomes in the window ending at each heartbeat
+        total = totals[outcome]
+        counts[:window - 1] = total[1:window]
+        numpy.subtract(total[window:], total[:-window],
+                       out=counts[window - 1:])
+        hits[outcome, limit] = numpy.flatnonzero(counts >= limit)
+
+    def next_hit(outcome, limit, pos, since):
+        """Return the first heartbeat from pos at which the outcomes since
+        the last reset of their counter reach limit, or None
+        """
+        total = totals[outcome]
+        # Until a window has passed the reset hides older outcomes
+        end = min(max(pos, since + window - 1), count)
+        if pos < end:
+            near = numpy.arange(pos, end)
+            met = numpy.flatnonzero(
+                total[near + 1] -
+                total[numpy.maximum(near - window + 1, since)] >= limit)
+            if len(met):
+                return pos + met[0]
+        found = hits[outcome, limit]
+        at = numpy.searchsorted(found, end)
+        return found[at] if at < len(found) else None
+
+    resets = dict((name, outcome) for (outcome, name) in
+                  ProbeWindow.COUNTERS.items())
+    since = dict((outcome, 0) for outcome in outcomes)
+    (state, pos, changes) = (PathTable.STARTUP, 0, [])
+    while pos < count:
+        best = None
+        for transition in PathTable.TRANSITIONS[state]:
+            (outcome, limit) = conditions[transition[0]]
+            hit = next_hit(outcome, limit, pos, since[outcome])
+            if hit is not None and (best is None or hit < best[0]):
+                best = (hit, transition)
+        if best is None:
+            break
+        (hit, (_, new, reset, _, _, _)) = best
+        changes.append((int(hit), state, new))
+        for name in reset:
+            if name in resets:
+                since[resets[name]] = hit + 1
+        (state, pos) = (new, hit + 1)
+    return changes
+
+
+def analyze(numpy, records, thresholds=(), window=5, min_good=3,
+            max_warn=3, max_fail=3):
+    """Summarise the heartbeats of a path and what candidate thresholds
+    would have done with them
+
+    Args:
+        numpy (module): The numpy module
+        records (numpy.ndarray): Heartbeats from load_ring()
+        thresholds (list): (alert_threshold, failure_threshold) pairs
+        window, min_good, max_warn, max_fail: As for simulate()
+
+    Returns:
+        dict: The number of heartbeats, loss and availability (the fraction
+              of heartbeats while the path was up or warned) as recorded,
+              RTT statistics in ms and, for each pair of thresholds, the
+              heartbeats they would have counted as degraded or failed, the
+              Warn and Failed transitions and the availability they would
+              have given
+    """
+    rtts = records['rtt'].astype(float)
+    lost = (records['retcode'] != 0) | numpy.isnan(rtts)
+    replies = rtts[~lost]
+    count = len(records)
+    summary = {
+        'heartbeats': count,
+        'start': float(records['timestamp'][0]) if count else None,
+        'end': float(records['timestamp'][-1]) if count else None,
+        'lost': int(lost.sum()),
+        'loss': float(lost.mean()) if count else None,
+        'availability': float(numpy.in1d(
+            records['state'], (PathTable.UP, PathTable.WARN)).mean())
+        if count else None,
+        'rtt': {},
+        'thresholds': [],
+    }
+    if len(replies):
+        summary['rtt'] = {'mean': float(replies.mean()),
+                          'max': float(replies.max())}
+        for (percentile, value) in zip(
+                PERCENTILES, numpy.percentile(replies, PERCENTILES)):
+            summary['rtt']['p{:g}'.format(percentile)] = float(value)
+    for (warn_threshold, fail_threshold) in thresholds:
+        with numpy.errstate(invalid='ignore'):
+            failed = lost | (rtts > fail_threshold)
+            degraded = ~failed & (rtts > warn_threshold)
+        changes = simulate(numpy, rtts, lost, warn_threshold, fail_threshold,
+                           window, min_good, max_warn, max_fail)
+        # As in the recorded states, the heartbeat which changes the state
+        #   counts in the new one, up to the next change or the last record
+        available = 0
+        for (position, (hit, _, new)) in enumerate(changes):
+            if new in (PathTable.UP, PathTable.WARN):
+                until = changes[position + 1][0] \
+                    if position + 1 < len(changes) else count
+                available += until - hit
+        summary['thresholds'].append({
+            'alert_threshold': warn_threshold,
+            'failure_threshold': fail_threshold,
+            'degraded': int(degraded.sum()),
+            'failed': int(failed.sum()),
+            'warn_transitions': sum(1 for change in changes
+                                    if change[2] == PathTable.WARN),
+            'fail_transitions': sum(1 for change in changes
+                                    if change[2] == PathTable.FAILED),
+            'availability': float(available) / count if count else None,
+        })
+    return summary
+
+
+class ReplaySwitch(object):
+    """Stands in for a switch's eAPI session during a replay, keeping the
+    commands it is sent instead of sending them
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def runCmds(self, version, cmds, *args):
+        """Note the commands and answer each with an empty result"""
+        self.calls.append((ibypass_common.CLOCK.time(), list(cmds)))
+        return [{} for _ in cmds]
+
+
+class Timeline(object):
+    """Collects the state changes and config pushes of a replay.  Takes
+    the place of the EventJournal of the paths' table and dispatcher.
+    """
+
+    def __init__(self):
+        self.events = []
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        """Call callback(event) for each event"""
+        self._callbacks.append(callback)
+
+    def _add(self, **event):
+        event['timestamp'] = ibypass_common.CLOCK.time()
+        self.events.append(event)
+        for callback in self._callbacks:
+            callback(event)
+
+    def transition(self, path, old, new, detail='', now=None):
+        self._add(path=path, event='transition', old=old, new=new,
+                  state='{} -> {}'.format(PathTable.NAMES[old],
+                                          PathTable.NAMES[new]),
+                  result='', detail=detail)
+
+    def push(self, path, name, succeeded, now=None):
+        self._add(path=path, event='push', state='',
+                  result='ok' if succeeded else 'failed', detail=name)
+
+    def alert(self, subject):
+        self._add(path='', event='alert', state='', result='',
+                  detail=subject)
+
+
+class ReplayMail(object):
+    """Takes the place of the email alert queue during a replay, adding
+    each alert to the timeline instead of sending it
+    """
+
+    config = {'enabled': True}
+
+    def __init__(self, timeline):
+        self.timeline = timeline
+
+    def send(self, msg, subject=''):
+        """Note the alert"""
+        self.timeline.alert(subject)
+
+
+def parse_fault(value):
+    """Parse a --fault START:LENGTH:RTT[:LOSS[:PATH]] injected into a
+    synthetic trace
+    """
+    fields = value.split(':', 4)
+    try:
+        fault = {'start': float(fields[0]), 'length': float(fields[1]),
+                 'rtt': float(fields[2]),
+                 'loss': float(fields[3]) if len(fields) > 3 else 0.0,
+                 'path': fields[4] if len(fields) > 4 else None}
+    except (IndexError, ValueError):
+        raise argparse.ArgumentTypeError(
+            'expected START:LENGTH:RTT[:LOSS[:PATH]], not {!r}'.format(value))
+    return fault
+
+
+def synthetic_trace(paths, duration, interval, rtt=(1.0, 3.0), loss=0.0,
+                    faults=(), start=0.0, seed=1):
+    """Return heartbeat results of the given paths, one per interval
+
+    Args:
+        paths (list): Path names
+        duration (float): Seconds of heartbeats
+        interval (float): Seconds between heartbeats
+        rtt (tuple): The range of normal RTTs in ms
+        loss (float): The fraction of normal heartbeats lost
+        faults (list): Dicts from parse_fault(): for length seconds from
+                       start seconds into the trace, heartbeats on path, or
+                       every path, take rtt ms give or take 10% and loss of
+                       them are lost
+        start (float): The time of the first heartbeat
+        seed (int): Seeds the random RTTs and losses
+
+    Returns:
+        list: (time, path, retcode, rtt) for each heartbeat, in time order
+    """
+    rand = random.Random(seed)
+    trace = []
+    for tick in xrange(int(duration // interval)):
+        offset = tick * interval
+        for path in paths:
+            (value, lost) = (rand.uniform(*rtt), rand.random() < loss)
+            for fault in faults:
+                if fault['path'] in (None, path) and \
+                        fault['start'] <= offset < \
+                        fault['start'] + fault['length']:
+                    value = fault['rtt'] * rand.uniform(0.9, 1.1)
+                    lost = rand.random() < fault['loss']
+            trace.append((start + offset, path, 1 if lost else 0,
+                          None if lost else value))
+    return trace
+
+
+def recorded_trace(directory, paths=None, start=None, end=None):
+    """Return the heartbeats recorded by [recording] as a trace for
+    replay()
+    """
+    return [(row['timestamp'], row['path'], row['retcode'], row['rtt'])
+            for row in history(directory, paths, start, end)]
+
+
+def state_at(timeline, path, when):
+    """Return the PathTable state of a path at the given time of a replay
+    timeline
+    """
+    state = PathTable.NOT_STARTED
+    for event in timeline:
+        if event['timestamp'] > when:
+            break
+        if event['event'] == 'transition' and event['path'] == path:
+            state = event['new']
+    return state
+
+
+def replay(CONFIG, trace, faults=()):
+    """Feed a trace of heartbeat results through the monitor's own
+    Heartbeat.do_health_check() and Status.runAll() on a virtual clock.
+
+    Each path of the trace is monitored with the settings of the
+    [path:<name>] section of the same name, or the [General] thresholds.
+    Pings are answered from the trace, config pushes go to ReplaySwitch
+    stand-ins and alerts to the timeline instead of syslog and email.
+
+    Args:
+        CONFIG (dict): Parsed settings from the config file
+        trace (list): (time, path, retcode, rtt) for each heartbeat, in time
+                      order
+        faults (list): The faults injected into a synthetic trace, see
+                       synthetic_trace()
+
+    Returns:
+        dict: The timeline of state changes, pushes and alerts, the
+              detection latency of each failure, the number of heartbeats
+              sent, the simulated seconds and the seconds the replay took
+    """
+    names = sorted(set(name for (_, name, _, _) in trace))
+    configured = dict((path['name'], path) for path in CONFIG['paths'])
+    CONFIG = dict(CONFIG, recording={'enabled': False}, paths=[])
+    for name in names:
+        path = dict(configured.get(name) or
+                    {'interface': name, 'commands': None,
+                     'alert_threshold': CONFIG['alert_threshold'],
+                     'failure_threshold': CONFIG['failure_threshold']})
+        (path['name'], path['probe_dst_address']) = (name, name)
+        CONFIG['paths'].append(path)
+    for section in ('eapi', 'peer'):
+        if CONFIG.get(section):
+            CONFIG[section] = dict(CONFIG[section], switch=ReplaySwitch())
+
+    timeline = Timeline()
+    results = {}
+    # The times of the failed heartbeats in each path's probe window
+    failures = {}
+    heartbeats = [0]
+
+    def ping(address):
+        """Answer a heartbeat from the trace"""
+        (retcode, rtt) = results[address]
+        heartbeats[0] += 1
+        device = paths[address]
+        window = failures.setdefault(address, collections.deque())
+        window.append(ibypass_common.CLOCK.time() if retcode != 0 or
+                      rtt > device.thresholds()[1] else None)
+        while len(window) > device.window.size:
+            window.popleft()
+        return (retcode, rtt, rtt, rtt, 0.0 if rtt is not None else None)
+
+    detections = []
+
+    def on_event(event):
+        """Measure the detection latency of each failure from the oldest
+        failed heartbeat in the window which tripped it
+        """
+        if event['event'] == 'transition' and \
+                event['new'] == PathTable.FAILED:
+            onsets = [when for when in failures.get(event['path'], ())
+                      if when is not None]
+            detections.append({'path': event['path'],
+                               'failed': event['timestamp'],
+                               'onset': onsets[0] if onsets else None})
+
+    timeline.add_callback(on_event)
+    saved = (ibypass_common.CLOCK, ibypass_common.QUIET, hbm.MAIL,
+             hbm.check_path)
+    clock = VirtualClock(trace[0][0] if trace else 0)
+    (ibypass_common.CLOCK, ibypass_common.QUIET, hbm.MAIL,
+     hbm.check_path) = (clock, True, ReplayMail(timeline), ping)
+    began = time.time()
+    try:
+        devices = build_devices(CONFIG)
+        paths = dict((device.name, device) for device in devices)
+        if devices:
+            devices[0].table.journal = timeline
+            devices[0].dispatcher.journal = timeline
+        status = Status()
+        for (timestamp, group) in itertools.groupby(trace,
+                                                    lambda result: result[0]):
+            clock.advance_to(timestamp)
+            due = []
+            for (_, name, retcode, rtt) in group:
+                results[name] = (retcode, rtt)
+                due.append(paths[name])
+            probe_devices(due, now=timestamp)
+            status.runAll(devices)
+    finally:
+        (ibypass_common.CLOCK, ibypass_common.QUIET, hbm.MAIL,
+         hbm.check_path) = saved
+
+    if faults:
+        # Measure from the start of the fault each failure falls in.  A
+        # failure may follow the end of its fault by up to a window of
+        # heartbeats; one outside every fault keeps no onset, and a fault
+        # which caused no failure is listed without one.  Faults starting
+        # while their path is already failed are left out.
+        for detection in detections:
+            detection['onset'] = None
+        trace_start = trace[0][0] if trace else 0
+        slack = CONFIG['probe_window'] * CONFIG['interval']
+        for fault in faults:
+            start = trace_start + fault['start']
+            end = start + fault['length'] + slack
+            for name in names:
+                if fault['path'] not in (None, name) or \
+                        state_at(timeline.events, name, start) == \
+                        PathTable.FAILED:
+                    continue
+                for detection in detections:
+                    if detection['path'] == name and \
+                            detection['onset'] is None and \
+                            start <= detection['failed'] < end:
+                        detection['onset'] = start
+                        break
+                else:
+                    detections.append({'path': name, 'failed': None,
+                                       'onset': start})
+        detections.sort(key=lambda detection: (detection['onset'] or
+                                               detection['failed']))
+    for detection in detections:
+        detection['latency'] = None
+        if detection['onset'] is not None and \
+                detection['failed'] is not None:
+            detection['latency'] = detection['failed'] - detection['onset']
+    return {'timeline': timeline.events,
+            'detections': detections,
+            'heartbeats': heartbeats[0],
+            'paths': names,
+            'start': trace[0][0] if trace else None,
+            'simulated': trace[-1][0] - trace[0][0] if trace else 0,
+            'elapsed': time.time() - began}
+
+
+def export(rows, fmt, output, fields=FIELDS):
+    """Write heartbeats or events as CSV, JSON or one line of text each
+
+    Args:
+        rows (list): Heartbeats from history() or events from events()
+        fmt (str): 'csv', 'json' or 'text'
+        output (file): Where to write them
+        fields (list): The keys of each row
+    """
+    if fmt == 'json':
+        json.dump(rows, output, indent=1, sort_keys=True)
+        output.write('\n')
+        return
+    if fmt == 'text':
+        for row in rows:
+            output.write(' '.join(str(row[field]) for field in fields
+                                  if field != 'timestamp' and
+                                  row[field] not in ('', None)) + '\n')
+        return
+    writer = csv.DictWriter(output, fields)
+    writer.writerow(dict(zip(fields, fields)))
+    for row in rows:
+        writer.writerow(dict((field, '' if row[field] is None
+                              else row[field]) for field in fields))
+
+
+def report(summaries, output):
+    """Write the summaries from analyze() as text
+
+    Args:
+        summaries (dict): A summary per path name
+        output (file): Where to write them
+    """
+    for (name, summary) in sorted(summaries.items()):
+        if not summary['heartbeats']:
+            output.write('{}: no heartbeats\n'.format(name))
+            continue
+        output.write('{}: {} heartbeats from {} to {}, loss {:.3%}, '
+                     'availability {:.3%}\n'.format(
+                         name, summary['heartbeats'],
+                         datetime.datetime.fromtimestamp(summary['start'])
+                         .isoformat(),
+                         datetime.datetime.fromtimestamp(summary['end'])
+                         .isoformat(),
+                         summary['loss'], summary['availability']))
+        if summary['rtt']:
+            output.write('  rtt ms: {}\n'.format(' '.join(
+                '{} {:.2f}'.format(key, summary['rtt'][key]) for key in
+                ['mean'] + ['p{:g}'.format(percentile)
+                            for percentile in PERCENTILES] + ['max'])))
+        for result in summary['thresholds']:
+            output.write('  thresholds {:g}/{:g}: {} degraded, {} failed '
+                         'heartbeats, {} Warn and {} Failed transitions, '
+                         'availability {:.3%}\n'.format(
+                             result['alert_threshold'],
+                             result['failure_threshold'],
+                             result['degraded'], result['failed'],
+                             result['warn_transitions'],
+                             result['fail_transitions'],
+                             result['availability']))
+
+
+def replay_report(result, output):
+    """Write the timeline and detection latencies from replay() as text,
+    with times in seconds from the start of the trace
+
+    Args:
+        result (dict): The result of replay()
+        output (file): Where to write it
+    """
+    start = result['start'] or 0
+    output.write('Replayed {} heartbeats of {} paths, {:.0f}s of heartbeats '
+                 'in {:.2f}s\n'.format(result['heartbeats'],
+                                       len(result['paths']),
+                                       result['simulated'],
+                                       result['elapsed']))
+    for event in result['timeline']:
+        output.write('{:+10.1f}s {}\n'.format(
+            event['timestamp'] - start,
+            ' '.join(str(event[field]) for field in
+                     ('path', 'event', 'state', 'result', 'detail')
+                     if event[field])))
+    for detection in result['detections']:
+        if detection['failed'] is None:
+            output.write('{}: fault at {:+.1f}s not detected\n'.format(
+                detection['path'], detection['onset'] - start))
+        elif detection['onset'] is None:
+            output.write('{}: failed at {:+.1f}s outside any fault\n'.format(
+                detection['path'], detection['failed'] - start))
+        else:
+            output.write('{}: failed at {:+.1f}s, {:.1f}s after the failure '
+                         'began\n'.format(
+                             detection['path'], detection['failed'] - start,
+                             detection['latency']))
+
+
+def parse_range(value):
+    """Parse an RTT range in ms such as 1-3"""
+    try:
+        (low, high) = [float(rtt) for rtt in value.split('-')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected <low>-<high>, not {!r}'.format(value))
+    return (low, high)
+
+
+def parse_thresholds(value):
+    """Parse an alert_threshold/failure_threshold pair such as 13/15"""
+    try:
+        (warn_threshold, fail_threshold) = [float(threshold) for threshold
+                                            in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected <alert_threshold>/<failure_threshold>, not '
+            '{!r}'.format(value))
+    return (warn_threshold, fail_threshold)
+
+
+def parse_cmd_line(argv=None):
+    """Parse the command line"""
+    parser = argparse.ArgumentParser(
+        description='Read the heartbeat history recorded by hbm.py')
+    commands = parser.add_subparsers(dest='command')
+
+    cmd = commands.add_parser('export', help='Export heartbeats to CSV or '
+                                             'JSON')
+    cmd.add_argument('--directory', default='/var/run/hbm',
+                     help='The [recording] directory')
+    cmd.add_argument('--path', action='append', dest='paths',
+                     help='Path to export, default all.  May be repeated.')
+    cmd.add_argument('--start', help='Earliest time, default the oldest '
+                                     'record')
+    cmd.add_argument('--end', help='Latest time, default now')
+    cmd.add_argument('--format', choices=('csv', 'json'), default='csv')
+    cmd.add_argument('--output', help='File to write, default stdout')
+
+    cmd = commands.add_parser('events', help='Show journaled transitions, '
+                                             'config pushes and BFD failures')
+    cmd.add_argument('--directory', default='/persist/sys/hbm',
+                     help='The [journal] directory')
+    cmd.add_argument('--path', action='append', dest='paths',
+                     help='Path to show, default all.  May be repeated.')
+    cmd.add_argument('--start', help='Earliest time, default the first '
+                                     'event')
+    cmd.add_argument('--end', help='Latest time, default now')
+    cmd.add_argument('--format', choices=('text', 'csv', 'json'),
+                     default='text')
+    cmd.add_argument('--output', help='File to write, default stdout')
+
+    cmd = commands.add_parser('analyze', help='RTT percentiles, loss and '
+                                              'availability of recorded '
+                                              'heartbeats, and what '
+                                              'candidate thresholds would '
+                                              'have done.  Needs NumPy.')
+    cmd.add_argument('--directory', default='/var/run/hbm',
+                     help='The [recording] directory')
+    cmd.add_argument('--path', action='append', dest='paths',
+                     help='Path to analyze, default all.  May be repeated.')
+    cmd.add_argument('--start', help='Earliest time, default the oldest '
+                                     'record')
+    cmd.add_argument('--end', help='Latest time, default now')
+    cmd.add_argument('--thresholds', action='append', default=[],
+                     type=parse_thresholds, metavar='ALERT/FAILURE',
+                     help='Candidate alert_threshold/failure_threshold in '
+                          'ms, e.g. 13/15.  May be repeated.')
+    cmd.add_argument('--window', type=int, default=5,
+                     help='probe_window (default 5)')
+    cmd.add_argument('--min-good', type=int, default=3,
+                     help='Good heartbeats in the window to come up')
+    cmd.add_argument('--max-warn', type=int, default=3,
+                     help='Degraded heartbeats in the window to warn')
+    cmd.add_argument('--max-fail', type=int, default=3,
+                     help='Failed heartbeats in the window to fail')
+    cmd.add_argument('--format', choices=('text', 'json'), default='text')
+    cmd.add_argument('--output', help='File to write, default stdout')
+
+    cmd = commands.add_parser('replay', help='Run recorded or synthetic '
+                                             'heartbeats through the '
+                                             'monitor on a virtual clock')
+    cmd.add_argument('--config', default='/persist/sys/bfd_int_sync.ini',
+                     help='The monitor config to replay against')
+    cmd.add_argument('--thresholds', type=parse_thresholds,
+                     metavar='ALERT/FAILURE',
+                     help='Replace the thresholds of every path')
+    cmd.add_argument('--directory', default='/var/run/hbm',
+                     help='The [recording] directory')
+    cmd.add_argument('--path', action='append', dest='paths',
+                     help='Recorded path to replay, default all.  May be '
+                          'repeated.')
+    cmd.add_argument('--start', help='Earliest time, default the oldest '
+                                     'record')
+    cmd.add_argument('--end', help='Latest time, default now')
+    cmd.add_argument('--synthetic', type=float, metavar='SECONDS',
+                     help='Replay this many seconds of generated heartbeats '
+                          'instead of recorded ones')
+    cmd.add_argument('--synthetic-path', action='append',
+                     dest='synthetic_paths',
+                     help='Name of a generated path, default the configured '
+                          'paths.  May be repeated.')
+    cmd.add_argument('--rtt', type=parse_range, default=(1.0, 3.0),
+                     metavar='LOW-HIGH',
+                     help='Normal RTT range in ms (default 1-3)')
+    cmd.add_argument('--loss', type=float, default=0.0,
+                     help='Fraction of normal heartbeats lost')
+    cmd.add_argument('--fault', action='append', dest='faults', default=[],
+                     type=parse_fault,
+                     metavar='START:LENGTH:RTT[:LOSS[:PATH]]',
+                     help='From START for LENGTH seconds, heartbeats take '
+                          'RTT ms and LOSS of them are lost.  May be '
+                          'repeated.')
+    cmd.add_argument('--seed', type=int, default=1,
+                     help='Seed of the generated heartbeats')
+    cmd.add_argument('--format', choices=('text', 'json'), default='text')
+    cmd.add_argument('--output', help='File to write, default stdout')
+    return parser.parse_args(argv)
+
+
+def main_analyze(args):
+    """Analyze the recorded heartbeats of each path"""
+    try:
+        import numpy
+    except ImportError:
+        sys.stderr.write('analyze needs NumPy\n')
+        return 1
+    try:
+        (start, end) = (parse_time(args.start), parse_time(args.end))
+        summaries = {}
+        for (name, filename) in ring_files(args.directory,
+                                           args.paths).items():
+            summaries[name] = analyze(numpy,
+                                      load_ring(numpy, filename, start, end),
+                                      args.thresholds, args.window,
+                                      args.min_good, args.max_warn,
+                                      args.max_fail)
+    except (ValueError, EnvironmentError) as err:
+        sys.stderr.write('{}\n'.format(err))
+        return 1
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        if args.format == 'json':
+            json.dump(summaries, output, indent=1, sort_keys=True)
+            output.write('\n')
+        else:
+            report(summaries, output)
+    finally:
+        if args.output:
+            output.close()
+    return 0
+
+
+def main_replay(args):
+    """Replay heartbeats through the monitor"""
+    try:
+        CONFIG = parse_config(args.config)
+        if args.thresholds:
+            (CONFIG['alert_threshold'], CONFIG['failure_threshold']) = \
+                args.thresholds
+            for path in CONFIG['paths']:
+                (path['alert_threshold'], path['failure_threshold']) = \
+                    args.thresholds
+        if args.synthetic:
+            trace = synthetic_trace(
+                args.synthetic_paths or
+                [path['name'] for path in CONFIG['paths']],
+                args.synthetic, CONFIG['interval'], args.rtt, args.loss,
+                args.faults, seed=args.seed)
+        else:
+            trace = recorded_trace(args.directory, args.paths,
+                                   parse_time(args.start),
+                                   parse_time(args.end))
+    except (ValueError, EnvironmentError) as err:
+        sys.stderr.write('{}\n'.format(err))
+        return 1
+    result = replay(CONFIG, trace, args.faults if args.synthetic else ())
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        if args.format == 'json':
+            json.dump(result, output, indent=1, sort_keys=True)
+            output.write('\n')
+        else:
+            replay_report(result, output)
+    finally:
+        if args.output:
+            output.close()
+    return 0
+
+
+def main(argv=None):
+    """Main function"""
+    args = parse_cmd_line(argv)
+    if args.command == 'analyze':
+        return main_analyze(args)
+    if args.command == 'replay':
+        return main_replay(args)
+    try:
+        (start, end) = (parse_time(args.start), parse_time(args.end))
+        if args.command == 'events':
+            (rows, fields) = (events(args.directory, args.paths, start, end),
+                              EVENT_FIELDS)
+        else:
+            (rows, fields) = (history(args.directory, args.paths, start, end),
+                              FIELDS)
+    except (ValueError, EnvironmentError) as err:
+        sys.stderr.write('{}\n'.format(err))
+        return 1
+    if args.output:
+        with open(args.output, 'w') as output:
+            export(rows, args.format, output, fields)
+    else:
+        export(rows, args.format, sys.stdout, fields)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
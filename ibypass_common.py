@@ -0,0 +1,1053 @@
+# Copyright (c) 2016, Arista Networks, Inc. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# Neither the name of Arista Networks nor the names of its contributors may be
+# used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""Pieces shared by hbm.py, bfd_int_sync.py and ibypassd.py: the clock,
+phase timings and profiler, the compiled config cache, the eAPI response
+cache and config dispatcher, the telemetry subscriber and the event
+journal.
+
+They are kept out of hbm.py so bfd_int_sync.py starts without loading the
+heartbeat monitor.  hbm.py re-exports all of them.
+"""
+
+import array
+import bisect
+import collections
+import copy
+import hashlib
+import json
+import jsonrpclib
+import marshal
+import math
+import os
+from pprint import pformat
+import signal
+import socket
+import struct
+import sys
+import syslog
+import threading
+import time
+import zlib
+
+DEBUG = False          # pylint: disable=C0103
+# Keeps log() out of syslog, for replays of simulated heartbeats
+QUIET = False          # pylint: disable=C0103
+
+# Bump when the structure of the config compiled by hbm.py or
+#   bfd_int_sync.py changes
+CONFIG_CACHE_VERSION = 17
+
+# Seconds to keep the answer to a read-only eAPI command, by command prefix.
+# The longest matching prefix wins.  Interface addresses rarely change; link
+# and route state are only shared between calls made close together.
+EAPI_CACHE_TTL = {
+    'show ip interface': 60,
+    'show interfaces': 1,
+    'show ip route': 1,
+    'show bfd': 0,
+}
+EAPI_CACHE_DEFAULT_TTL = 1
+
+
+class Clock(object):
+    """The time source of the monitors.  A VirtualClock installed as CLOCK
+    runs them on simulated time instead.
+    """
+
+    def time(self):
+        """Return the current time in seconds since the epoch"""
+        return time.time()
+
+    def sleep(self, seconds):
+        """Wait for the given number of seconds"""
+        time.sleep(seconds)
+
+    def wait(self, event, timeout):
+        """Wait up to timeout seconds for a threading.Event to be set
+
+        Returns:
+            bool: True if the event is set
+        """
+        return event.wait(timeout)
+
+
+class VirtualClock(Clock):
+    """A clock which only moves when told to, so hours of heartbeats can be
+    replayed in seconds
+    """
+
+    def __init__(self, now=0.0):
+        """
+        Args:
+            now (float): The starting time
+        """
+        self.now = float(now)
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, event, timeout):
+        if not event.is_set():
+            self.advance(timeout)
+        return event.is_set()
+
+    def advance(self, seconds):
+        """Move the clock forward"""
+        self.now += max(seconds, 0)
+
+    def advance_to(self, now):
+        """Move the clock forward to the given time"""
+        self.now = max(self.now, float(now))
+
+
+# The clock used by the monitors, see VirtualClock
+CLOCK = Clock()      # pylint: disable=C0103
+
+
+class LatencyHistogram(object):
+    """Counts of durations in fixed buckets, so the latency of a phase can
+    be tracked indefinitely in constant memory and cost
+    """
+
+    # Upper bounds of the buckets in ms.  A last bucket holds the rest.
+    BOUNDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000,
+              2500, 5000, 10000)
+
+    __slots__ = ('counts', 'total', 'max')
+
+    def __init__(self):
+        self.counts = array.array('L', [0] * (len(self.BOUNDS) + 1))
+        self.total = 0.0
+        self.max = 0.0
+
+    @property
+    def count(self):
+        """The number of durations added"""
+        return sum(self.counts)
+
+    def add(self, seconds):
+        """Count one duration"""
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.BOUNDS, ms)] += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, pct):
+        """Return the upper bound in ms of the bucket holding the pct
+        percentile, or the largest duration for the last bucket
+        """
+        rank = math.ceil(pct / 100.0 * self.count)
+        seen = 0
+        for (index, count) in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if index < len(self.BOUNDS):
+                    return min(self.BOUNDS[index], self.max)
+                break
+        return self.max
+
+    def summary(self):
+        """Return the count, mean, p50, p99 and max as one line"""
+        count = self.count
+        if not count:
+            return 'n 0'
+        return ('n {} mean {:.2f}ms p50 <={:g}ms p99 <={:g}ms '
+                'max {:.2f}ms').format(count, self.total / count,
+                                       self.percentile(50),
+                                       self.percentile(99), self.max)
+
+
+class PhaseTimings(object):
+    """A LatencyHistogram per phase of the hot path:
+
+        probe      sending a heartbeat and waiting for its reply
+        stats      classifying a heartbeat and updating the path's counters
+                   and RTT statistics
+        evaluate   the state machine pass over every path, including the
+                   pushes and alerts a state change triggers
+        dispatch   one eAPI config push
+        syslog     one message to syslog
+        alert      queuing an email alert
+        smtp       sending an email alert, in the alert thread
+        log read   reading and matching the new lines of the log watched for
+                   BFD state changes
+        log match  matching one BFD state change line to a monitored peer
+    """
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+
+    def add(self, phase, seconds):
+        """Count one duration of phase"""
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases.setdefault(phase, LatencyHistogram())
+        histogram.add(seconds)
+
+    def timed(self, phase):
+        """Return a context manager which times its block as phase"""
+        return _Timed(self, phase)
+
+    def summary(self):
+        """Return one line per phase"""
+        return ['{}: {}'.format(phase, histogram.summary())
+                for (phase, histogram) in self.phases.items()]
+
+
+class _Timed(object):
+    """Times a with block, see PhaseTimings.timed()"""
+
+    __slots__ = ('timings', 'phase', 'start')
+
+    def __init__(self, timings, phase):
+        self.timings = timings
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.phase, time.time() - self.start)
+
+
+# Latency of each phase of the hot path.  Always measured on the real clock.
+TIMINGS = PhaseTimings()      # pylint: disable=C0103
+
+
+def log(msg, level='INFO', error=False):
+    """Log a message to syslog
+
+    Args:
+        msg (str): The message to log.
+        level (str): The priority level for the message. (Default: INFO)
+                    See :mod:`syslog` for more options.
+                    EMERG, ALERT, CRIT, ERR, WARNING, NOTICE, INFO, DEBUG
+        error (bool): Flag if this is an error condition.
+    """
+
+    if DEBUG:
+        print "{0} ({1}) {2}".format(os.path.basename(sys.argv[0]), level, msg)
+
+    if error:
+        level = "ERR"
+        print "ERROR: {0} ({1}) {2}".format(os.path.basename(sys.argv[0]),
+                                            level, msg)
+
+    if not QUIET:
+        priority = ''.join(["syslog.LOG_", level])
+        with TIMINGS.timed('syslog'):
+            syslog.syslog(eval(priority), msg)
+
+
+def _file_sha1(filename):
+    """Return the hex SHA1 digest of a file's contents"""
+    with open(filename, 'rb') as fileh:
+        return hashlib.sha1(fileh.read()).hexdigest()
+
+
+def load_config_cache(filename, cache_file, required=()):
+    """Return the compiled config stored in cache_file if it was built from
+    the current contents of filename.
+
+    The INI mtime and size are checked first so a hit costs one stat().  If
+    they differ, the SHA1 of the INI is compared so a touched but unchanged
+    file is still a hit.
+
+    Args:
+        filename (str): The path to the config file.
+        cache_file (str): The path to the compiled config cache.
+        required (tuple): Keys which must be present in a valid config
+
+    Returns:
+        The cached config, or None if the cache is missing, stale or invalid
+    """
+    try:
+        with open(cache_file, 'rb') as cache:
+            entry = marshal.load(cache)
+        stat = os.stat(filename)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if not isinstance(entry, dict) or \
+            entry.get('version') != CONFIG_CACHE_VERSION or \
+            not isinstance(entry.get('config'), dict):
+        return None
+    if [key for key in required if key not in entry['config']]:
+        return None
+
+    if (entry.get('mtime'), entry.get('size')) != \
+            (stat.st_mtime, stat.st_size):
+        try:
+            if entry.get('sha1') != _file_sha1(filename):
+                return None
+        except IOError:
+            return None
+
+    return entry['config']
+
+
+def save_config_cache(filename, cache_file, config):
+    """Atomically write a compiled config to cache_file.  Failure to write the
+    cache is not fatal.
+
+    Args:
+        filename (str): The path to the config file config was parsed from.
+        cache_file (str): The path to the compiled config cache.
+        config (dict): The parsed configuration
+    """
+    tmp_file = '{}.{}'.format(cache_file, os.getpid())
+    try:
+        stat = os.stat(filename)
+        entry = {'version': CONFIG_CACHE_VERSION,
+                 'mtime': stat.st_mtime,
+                 'size': stat.st_size,
+                 'sha1': _file_sha1(filename),
+                 'config': config}
+        fdesc = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fdesc, 'wb') as cache:
+            marshal.dump(entry, cache)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError, ValueError) as err:
+        log('Unable to write config cache {}: {}'.format(cache_file, err),
+            level='DEBUG')
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+
+
+def load_config(filename, parse, cache_file=None, required=()):
+    """Return the compiled config for filename, parsing the INI only when the
+    cache is missing or stale.
+
+    Args:
+        filename (str): The path to the config file.
+        parse (callable): Called with filename to parse the INI.  Must return
+                          a marshal-able dict.
+        cache_file (str): The path to the compiled config cache, or None to
+                          disable caching.
+        required (tuple): Keys which must be present in a valid cached config
+
+    Returns:
+        tuple: (config, source, seconds) where source is 'cache' or 'parsed'
+    """
+    begin = time.time()
+    config = None
+    source = 'cache'
+    if cache_file:
+        config = load_config_cache(filename, cache_file, required=required)
+    if config is None:
+        source = 'parsed'
+        config = parse(filename)
+        if cache_file:
+            save_config_cache(filename, cache_file, config)
+    return (config, source, time.time() - begin)
+
+
+class CachedServer(object):
+    """Wrap a jsonrpclib Server, memoizing the answers to read-only (show)
+    commands.
+
+    Each entry expires after the TTL for its command (see EAPI_CACHE_TTL) and
+    the least recently used entry is evicted once max_entries is reached.
+    Any command which is not a show command, such as a config push, clears
+    the cache for the switch.  Every caller gets its own copy of a cached
+    response, so it may modify it freely.
+
+    The cache is not locked while a request is in flight, so cached answers
+    are not held up by a slow one.  Requests to the switch are serialized
+    since the underlying transport keeps a single HTTP connection.
+    """
+
+    def __init__(self, server, max_entries=64, ttl=None,
+                 default_ttl=EAPI_CACHE_DEFAULT_TTL):
+        """
+        Args:
+            server (obj): JSONrpc Switch object
+            max_entries (int): Maximum cached responses. 0 disables caching.
+            ttl (dict): Seconds to cache each command prefix
+            default_ttl (float): Seconds to cache other show commands
+        """
+        self.server = server
+        self.max_entries = max_entries
+        self.ttl = EAPI_CACHE_TTL if ttl is None else ttl
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+        # Bumped by every invalidation, so a response fetched across a
+        #   config push is not cached
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._request_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.server, name)
+
+    def _expiry(self, cmds):
+        """Return the TTL for a list of show commands, the shortest of the
+        TTLs of each command
+        """
+        ttls = []
+        for cmd in cmds:
+            prefixes = [prefix for prefix in self.ttl
+                        if cmd.startswith(prefix)]
+            if prefixes:
+                ttls.append(self.ttl[max(prefixes, key=len)])
+            else:
+                ttls.append(self.default_ttl)
+        return min(ttls)
+
+    def invalidate(self):
+        """Drop all cached responses for this switch"""
+        with self._lock:
+            self._cache.clear()
+            self._generation += 1
+
+    def _request(self, version, cmds, args):
+        with self._request_lock:
+            return self.server.runCmds(version, cmds, *args)
+
+    def runCmds(self, version, cmds, *args):
+        """Run commands on the switch, answering show commands from the cache
+        when possible.  Arguments match jsonrpclib's runCmds().
+        """
+        cacheable = self.max_entries > 0 and cmds and \
+            all(cmd.startswith('show ') for cmd in cmds)
+        if not cacheable:
+            self.invalidate()
+            try:
+                return self._request(version, cmds, args)
+            finally:
+                self.invalidate()
+
+        key = (version, tuple(cmds)) + args
+        with self._lock:
+            now = CLOCK.time()
+            entry = self._cache.pop(key, None)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                self._cache[key] = entry
+                return copy.deepcopy(entry[1])
+            self.misses += 1
+            generation = self._generation
+
+        response = self._request(version, cmds, args)
+        expiry = self._expiry(cmds)
+        if expiry > 0:
+            with self._lock:
+                if generation == self._generation:
+                    self._cache[key] = (now + expiry, copy.deepcopy(response))
+                    while len(self._cache) > self.max_entries:
+                        self._cache.popitem(last=False)
+        return response
+
+
+def run_cmds(eapi, cmds):
+    """Returns the output of eapi_client.runCmds()
+
+    Args:
+        eapi (obj): JSONrpc Switch object
+        cmds (list): List of commands to execute on a switch
+
+    Returns:
+        bool: True if the switch accepted the commands
+    """
+
+    if DEBUG:
+        print "Executing commands: {}".format(pformat(cmds))
+
+    try:
+        with TIMINGS.timed('dispatch'):
+            eapi.runCmds(1, cmds)
+    except jsonrpclib.jsonrpc.ProtocolError as err:
+        log("Command Error: {}. Attempted commands: {}.".format(
+            err[0][1], json.loads(jsonrpclib.history.request)['params'][1]),
+            error=True)
+        return False
+    return True
+
+
+class TelemetrySubscriber(object):
+    """Follow interface and BFD peer state from a streaming telemetry feed
+    instead of polling eAPI or scraping syslog.
+
+    The feed is a TCP stream of newline-delimited JSON, as produced by an
+    on-box gNMI or EOS SDK bridge.  After the client sends
+    {"subscribe": [<topics>]} the server replies with a snapshot of current
+    state, a {"type": "sync"} marker, then one event per state change:
+
+        {"type": "interface", "name": "Ethernet2",
+         "linkStatus": "connected", "lineProtocolStatus": "up"}
+        {"type": "bfd", "peer": "192.0.3.1", "status": "down"}
+
+    The snapshot only populates the state tables; callbacks fire for changes
+    received after the sync marker.  A malformed event, or a callback which
+    raises, is logged and skipped.  The connection is retried with backoff
+    and synced is cleared while it is down so callers can fall back to
+    polling.
+    """
+
+    def __init__(self, hostname, port, topics=('interface', 'bfd')):
+        """
+        Args:
+            hostname (str): Telemetry feed address
+            port (int): Telemetry feed TCP port
+            topics (tuple): Event types to subscribe to
+        """
+        self.address = (hostname, port)
+        self.topics = list(topics)
+        self.interfaces = {}
+        self.bfd_peers = {}
+        self.events = 0
+        self.synced = threading.Event()
+        self.changed = threading.Event()
+        self._callbacks = []
+        self._stopped = threading.Event()
+        self._sock = None
+
+    def add_callback(self, callback):
+        """Call callback(event) for each state change"""
+        self._callbacks.append(callback)
+
+    def start(self):
+        """Follow the feed in a background thread"""
+        thread = threading.Thread(target=self.run, name='telemetry')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """Stop following the feed"""
+        self._stopped.set()
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def run(self):
+        """Connect, follow the feed until it closes, and reconnect"""
+        delay = 0.1
+        while not self._stopped.is_set():
+            try:
+                self._follow()
+            except socket.error as err:
+                log('Telemetry feed {}:{} unavailable: {}'.format(
+                    self.address[0], self.address[1], err), level='DEBUG')
+            except Exception as err:
+                log('Telemetry feed {}:{} failed: {}'.format(
+                    self.address[0], self.address[1], err), level='ERR')
+            finally:
+                # Whatever ended the feed, stop trusting its state
+                if self.synced.is_set():
+                    log('Telemetry feed {}:{} lost, falling back to '
+                        'polling'.format(*self.address), level='WARNING')
+                    self.synced.clear()
+                    delay = 0.1
+            self._stopped.wait(delay)
+            delay = min(delay * 2, 5)
+
+    def _follow(self):
+        """Subscribe and dispatch events until the connection closes"""
+        sock = socket.create_connection(self.address, timeout=5)
+        self._sock = sock
+        try:
+            sock.settimeout(None)
+            sock.sendall(json.dumps({'subscribe': self.topics}) + '\n')
+            stream = sock.makefile('r')
+            for line in iter(stream.readline, ''):
+                if not line.strip():
+                    continue
+                try:
+                    self.dispatch(json.loads(line))
+                except Exception as err:
+                    log('Telemetry feed {}:{} skipped event {!r}: {}'.format(
+                        self.address[0], self.address[1], line.strip()[:80],
+                        err), level='WARNING')
+        finally:
+            self._sock = None
+            sock.close()
+
+    def dispatch(self, event):
+        """Record one event and pass state changes to the callbacks
+
+        Args:
+            event (dict): A decoded telemetry event
+        """
+        kind = event.get('type')
+        if kind == 'sync':
+            log('Telemetry feed {}:{} synchronized: {} interfaces, {} BFD '
+                'peers'.format(self.address[0], self.address[1],
+                               len(self.interfaces), len(self.bfd_peers)))
+            self.synced.set()
+            return
+        elif kind == 'interface':
+            self.interfaces[event['name']] = event
+        elif kind == 'bfd':
+            self.bfd_peers[event['peer']] = event
+        else:
+            return
+
+        if not self.synced.is_set():
+            return
+        self.events += 1
+        self.changed.set()
+        for callback in self._callbacks:
+            try:
+                callback(event)
+            except Exception as err:
+                log('Telemetry callback failed on {}: {}'.format(event, err),
+                    level='ERR')
+
+    def interface_status(self, name):
+        """Return the last reported state of an interface
+
+        Args:
+            name (str): Interface name
+
+        Returns:
+            dict: linkStatus and lineProtocolStatus, or None if the feed is
+                  not synchronized or has not reported the interface
+        """
+        if not self.synced.is_set():
+            return None
+        return self.interfaces.get(name)
+
+    def wait_for_change(self, timeout):
+        """Block until a state change arrives or timeout seconds pass
+
+        Returns:
+            bool: True if a change arrived
+        """
+        changed = self.changed.wait(timeout)
+        self.changed.clear()
+        return changed
+
+
+class Dispatcher(object):
+    """Apply named config sets (starting_config, ok_config, fail_config, ...)
+    to the local and peer switch.
+
+    One dispatcher is shared by every detector in a process.  A set which is
+    already in effect is not pushed again, so two paths or two detectors
+    reaching the same conclusion cause a single push.  A set which a switch
+    rejected is not in effect, so the next attempt pushes it again.  Paths
+    with their own config sets, from a [path:<name>] section, are pushed over
+    the same switch sessions but tracked separately.
+    """
+
+    SECTIONS = ('eapi', 'peer')
+
+    def __init__(self, config):
+        """
+        Args:
+            config (dict): Parsed settings with 'eapi' and optional 'peer'
+                           sections, each holding a 'switch' and the
+                           config sets
+        """
+        self.config = config
+        # The set last applied per path, None for the shared sets
+        self.applied = {}
+        self.pushes = 0
+        self.skipped = 0
+        # Records each push and its result, see EventJournal
+        self.journal = None
+        self._lock = threading.Lock()
+
+    def apply(self, name, force=False, path=None, commands=None):
+        """Push a config set to every switch which defines it
+
+        Args:
+            name (str): The config set, e.g. 'fail_config'
+            force (bool): Push even if the set is already in effect
+            path (str): The name of the path the set belongs to
+            commands (dict): The path's own config sets per section, as
+                             in CONFIG['paths'].  By default the sets of
+                             the eapi and peer sections.
+
+        Returns:
+            bool: True if the set was pushed and every switch accepted it
+        """
+        key = path if commands else None
+        with self._lock:
+            if name == self.applied.get(key) and not force:
+                self.skipped += 1
+                log('{} already applied{}, not pushing again'.format(
+                    name, ' to {}'.format(key) if key else ''),
+                    level='DEBUG')
+                return False
+            succeeded = False
+            try:
+                results = []
+                for section in self.SECTIONS:
+                    target = self.config.get(section) or {}
+                    sets = commands[section] if commands else target
+                    if sets.get(name) and target.get('switch'):
+                        results.append(run_cmds(target['switch'], sets[name]))
+                succeeded = all(results)
+            finally:
+                if self.journal is not None:
+                    self.journal.push(path or '', name, succeeded)
+            if succeeded:
+                self.applied[key] = name
+                self.pushes += 1
+            return succeeded
+
+
+class EventJournal(object):
+    """Append state transitions, config pushes and BFD failures to a binary
+    journal so an incident can be reconstructed without searching the logs.
+
+    The journal is a header followed by fixed-size records in the order they
+    were written.  A sparse index beside it, <journal>.idx, holds the
+    earliest and latest time of each BLOCK records and a mask of the paths
+    they mention, so query() only reads the blocks which can hold matching
+    records.  A record torn by a crash is dropped when the journal is opened
+    and index entries which may be behind the journal are rebuilt.
+    """
+
+    MAGIC = 'HBMJNL01'
+    # magic, record size, records per index entry
+    HEADER = struct.Struct('<8sII')
+    # time, kind, old state, new state, result, path, detail
+    RECORD = struct.Struct('<dBBBB36s48s')
+    # earliest time, latest time, path mask
+    INDEX = struct.Struct('<ddQ')
+    BLOCK = 256
+
+    TRANSITION, PUSH, BFD = range(1, 4)
+    KINDS = {TRANSITION: 'transition', PUSH: 'push', BFD: 'bfd'}
+
+    def __init__(self, filename):
+        """Open the journal for appending, creating it if necessary
+
+        Args:
+            filename (str): The path to the journal
+        """
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._entry = None
+        self._fdesc = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_APPEND,
+                              0644)
+        try:
+            header = self.HEADER.pack(self.MAGIC, self.RECORD.size,
+                                      self.BLOCK)
+            size = os.fstat(self._fdesc).st_size
+            if not size:
+                os.write(self._fdesc, header)
+                size = len(header)
+            elif os.read(self._fdesc, len(header)) != header:
+                raise IOError('{} is not an event journal'.format(filename))
+            self.count = (size - len(header)) // self.RECORD.size
+            end = len(header) + self.count * self.RECORD.size
+            if size != end:
+                os.ftruncate(self._fdesc, end)
+            self._index = os.open(filename + '.idx', os.O_RDWR | os.O_CREAT,
+                                  0644)
+        except EnvironmentError:
+            os.close(self._fdesc)
+            raise
+        self._reindex()
+
+    def _reindex(self):
+        """Rebuild the index entries which may not describe the journal:
+        the last one written and any missing after it
+        """
+        blocks = (self.count + self.BLOCK - 1) // self.BLOCK
+        indexed = os.fstat(self._index).st_size // self.INDEX.size
+        for block in xrange(max(min(indexed, blocks) - 1, 0), blocks):
+            os.lseek(self._fdesc, self.HEADER.size +
+                     block * self.BLOCK * self.RECORD.size, os.SEEK_SET)
+            data = os.read(self._fdesc, self.BLOCK * self.RECORD.size)
+            self._entry = [None, None, 0]
+            for offset in xrange(0, len(data), self.RECORD.size):
+                (timestamp, _, _, _, _, path, _) = \
+                    self.RECORD.unpack_from(data, offset)
+                self._add(timestamp, path.rstrip('\0'))
+            self._write_entry(block)
+        os.ftruncate(self._index, blocks * self.INDEX.size)
+        if not self.count % self.BLOCK:
+            self._entry = None
+
+    @staticmethod
+    def path_mask(path):
+        """Return the bit standing for path in the index's path masks"""
+        return 1 << (zlib.crc32(path) & 63)
+
+    def _add(self, timestamp, path):
+        """Widen the current block's index entry to include a record"""
+        entry = self._entry
+        if entry[0] is None or timestamp < entry[0]:
+            entry[0] = timestamp
+        if entry[1] is None or timestamp > entry[1]:
+            entry[1] = timestamp
+        entry[2] |= self.path_mask(path)
+
+    def _write_entry(self, block):
+        os.lseek(self._index, block * self.INDEX.size, os.SEEK_SET)
+        os.write(self._index, self.INDEX.pack(*self._entry))
+
+    def append(self, kind, path, detail='', old=0, new=0, result=0,
+               now=None):
+        """Add a record to the journal and its index entry
+
+        Args:
+            kind (int): TRANSITION, PUSH or BFD
+            path (str): The path the event concerns, '' for none
+            detail (str): Up to 48 characters of description
+            old (int): The PathTable state left by a transition
+            new (int): The PathTable state entered by a transition
+            result (int): 1 if a config push succeeded
+            now (float): CLOCK.time() of the event
+        """
+        if now is None:
+            now = CLOCK.time()
+        (path, detail) = (str(path)[:36], str(detail)[:48])
+        record = self.RECORD.pack(now, kind, old, new, result, path, detail)
+        with self._lock:
+            os.write(self._fdesc, record)
+            if self._entry is None:
+                self._entry = [None, None, 0]
+            self._add(now, path)
+            self._write_entry(self.count // self.BLOCK)
+            self.count += 1
+            if not self.count % self.BLOCK:
+                self._entry = None
+
+    def transition(self, path, old, new, detail='', now=None):
+        """Record a path changing state"""
+        self.append(self.TRANSITION, path, detail, old=old, new=new, now=now)
+
+    def push(self, path, name, succeeded, now=None):
+        """Record a config set pushed to the switches"""
+        self.append(self.PUSH, path, name, result=int(succeeded), now=now)
+
+    def bfd(self, path, peer, source='', now=None):
+        """Record a BFD peer reported down"""
+        self.append(self.BFD, path, '{} {}'.format(peer, source).strip(),
+                    now=now)
+
+    def close(self):
+        """Close the journal and index"""
+        os.close(self._fdesc)
+        os.close(self._index)
+
+    @classmethod
+    def query(cls, filename, start=None, end=None, path=None):
+        """Return the records of a journal between start and end about a
+        path, in the order they were written.  Only the blocks whose index
+        entry allows a match are read.
+
+        Args:
+            filename (str): The path to the journal
+            start (float): Skip records before this time
+            end (float): Skip records after this time
+            path (str): Only return records about this path
+
+        Returns:
+            list: (time, kind, old, new, result, path, detail) tuples
+        """
+        with open(filename, 'rb') as fileh:
+            header = fileh.read(cls.HEADER.size)
+            if len(header) != cls.HEADER.size or \
+                    cls.HEADER.unpack(header) != (cls.MAGIC, cls.RECORD.size,
+                                                  cls.BLOCK):
+                raise IOError('{} is not an event journal'.format(filename))
+            count = (os.fstat(fileh.fileno()).st_size -
+                     cls.HEADER.size) // cls.RECORD.size
+            blocks = (count + cls.BLOCK - 1) // cls.BLOCK
+            try:
+                with open(filename + '.idx', 'rb') as index:
+                    data = index.read(blocks * cls.INDEX.size)
+            except IOError:
+                data = ''
+            # The last entry may be behind the journal, so is not trusted
+            entries = [cls.INDEX.unpack_from(data, offset) for offset in
+                       xrange(0, len(data) - cls.INDEX.size + 1,
+                              cls.INDEX.size)][:blocks - 1]
+            mask = None if path is None else cls.path_mask(path)
+
+            records = []
+            for block in xrange(blocks):
+                if block < len(entries):
+                    (earliest, latest, paths) = entries[block]
+                    if (start is not None and latest < start) or \
+                            (end is not None and earliest > end) or \
+                            (mask is not None and not paths & mask):
+                        continue
+                fileh.seek(cls.HEADER.size +
+                           block * cls.BLOCK * cls.RECORD.size)
+                data = fileh.read(min(cls.BLOCK, count - block * cls.BLOCK) *
+                                  cls.RECORD.size)
+                for offset in xrange(0, len(data) - cls.RECORD.size + 1,
+                                     cls.RECORD.size):
+                    record = cls.RECORD.unpack_from(data, offset)
+                    if (start is not None and record[0] < start) or \
+                            (end is not None and record[0] > end):
+                        continue
+                    record = record[:5] + (record[5].rstrip('\0'),
+                                           record[6].rstrip('\0'))
+                    if path is None or record[5] == path:
+                        records.append(record)
+        return records
+
+
+def journal_file(directory, process):
+    """Return the EventJournal file written by a monitor process"""
+    return os.path.join(directory, '{}.jnl'.format(process))
+
+
+def open_journal(CONFIG, process, devices, journal=None):
+    """Open the event journal if the config enables it and give it to the
+    devices' table and dispatcher
+
+    Args:
+        CONFIG (dict): Parsed settings from the config file
+        process (str): The monitor's name, which names the journal file
+        devices (list): The Heartbeats being monitored
+        journal (EventJournal): The journal already open, if any
+
+    Returns:
+        EventJournal: The journal, or None if there is none
+    """
+    settings = CONFIG.get('journal', {})
+    filename = None
+    if settings.get('enabled'):
+        filename = journal_file(settings['directory'], process)
+    if journal is not None and journal.filename != filename:
+        journal.close()
+        journal = None
+    if filename is not None and journal is None:
+        try:
+            if not os.path.isdir(settings['directory']):
+                os.makedirs(settings['directory'])
+            journal = EventJournal(filename)
+        except EnvironmentError as err:
+            log('Unable to open event journal {}: {}'.format(filename, err),
+                level='WARNING')
+    for device in devices:
+        device.table.journal = journal
+        if device.dispatcher is not None:
+            device.dispatcher.journal = journal
+    return journal
+
+
+def log_timings(signum=None, frame=None):
+    """SIGUSR1 handler: log the latency of each phase of the hot path"""
+    for line in TIMINGS.summary() or ['no phases timed yet']:
+        log('Timings: {}'.format(line))
+
+
+class Profiler(object):
+    """Profile the main loop with cProfile for a bounded window when asked,
+    without restarting the monitor.  When the window ends the raw profile
+    is written to <directory>/<name>.<pid>.<time>.prof for pstats and the
+    functions with the most cumulative time to a .txt beside it.
+
+    Only the thread calling tick() is profiled, not the alert or telemetry
+    threads.
+    """
+
+    def __init__(self, name, seconds=60, directory='/tmp'):
+        """
+        Args:
+            name (str): Names the output files
+            seconds (float): Length of each window
+            directory (str): Where to write the results
+        """
+        self.name = name
+        self.seconds = seconds
+        self.directory = directory
+        self.requested = False
+        self._profile = None
+        self._until = None
+
+    @property
+    def active(self):
+        """Whether a window is open"""
+        return self._profile is not None
+
+    def request(self, signum=None, frame=None):
+        """Open a window at the next tick().  Safe as a signal handler."""
+        self.requested = True
+
+    def tick(self, now=None):
+        """Start or finish a window; call once per pass of the main loop.
+        Windows are timed on the real clock.
+        """
+        if now is None:
+            now = time.time()
+        if self._profile is not None and now >= self._until:
+            self._finish()
+        if self.requested and self._profile is None:
+            self.requested = False
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._until = now + self.seconds
+            log('Profiling {} for {}s'.format(self.name, self.seconds))
+            self._profile.enable()
+
+    def _finish(self):
+        import pstats
+        self._profile.disable()
+        base = os.path.join(self.directory, '{}.{}.{}'.format(
+            self.name, os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        try:
+            self._profile.dump_stats(base + '.prof')
+            with open(base + '.txt', 'w') as fileh:
+                stats = pstats.Stats(self._profile, stream=fileh)
+                stats.sort_stats('cumulative').print_stats(40)
+            log('Profile written to {0}.prof and {0}.txt'.format(base))
+        except (IOError, OSError) as err:
+            log('Unable to write profile {}: {}'.format(base, err),
+                level='WARNING')
+        self._profile = None
+
+
+def install_diagnostics(name, args):
+    """Log the phase timings on SIGUSR1 and profile the main loop on
+    SIGUSR2, or from startup with --profile
+
+    Returns:
+        Profiler: To tick() from the main loop
+    """
+    profiler = Profiler(name, seconds=args.profile or 60,
+                        directory=args.profile_dir)
+    if args.profile:
+        profiler.request()
+    signal.signal(signal.SIGUSR1, log_timings)
+    signal.siginterrupt(signal.SIGUSR1, False)
+    signal.signal(signal.SIGUSR2, profiler.request)
+    signal.siginterrupt(signal.SIGUSR2, False)
+    return profiler
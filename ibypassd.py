@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# pylint: disable=broad-except, invalid-name
+#
+# Copyright (c) 2016, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#  - Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#  - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#  - Neither the name of Arista Networks nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""Intelligent bypass daemon: run the heartbeat monitor (hbm.py) and the BFD
+watcher (bfd_int_sync.py) in a single process.
+
+Both detectors share one parsed config, one eAPI session per switch, one
+alert queue and one Dispatcher, so a failure seen by both results in a
+single fail_config push and one python interpreter is resident instead of
+two.  Heartbeat probes, BFD syslog lines and BFD poll/telemetry events are
+all serviced from the same event loop.
+
+Start with:
+
+    bash# /usr/bin/ibypassd.py --config /persist/sys/bfd_int_sync.ini
+
+or, via the service script:
+
+    bash# /usr/bin/hbm_service start_ibypassd
+
+SIGHUP reloads the config file as for hbm.py.
+"""
+
+import signal
+import syslog
+import threading
+import traceback
+
+import hbm
+from hbm import log, parse_cmd_line, parse_config, REQUIRED_CONFIG, \
+    IMPORT_SECONDS, mail, AlertQueue, DecisionEngine, startup, \
+    build_devices, reload_config, record_signal, open_baselines, \
+    read_approvals, write_status, batch_evaluator, probe_devices, Status, \
+    PathTable, setProcName
+import ibypass_common
+from ibypass_common import load_config, CachedServer, Dispatcher, \
+    TelemetrySubscriber, open_journal
+from jsonrpclib import Server
+import bfd_int_sync
+from bfd_int_sync import BfdWatcher
+
+
+def main():
+    """Main function"""
+
+    syslog.openlog('ibypassd', 0, syslog.LOG_LOCAL4)
+
+    args = parse_cmd_line()
+    if not hbm.DEBUG:
+        syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_INFO))
+    bfd_int_sync.DEBUG = hbm.DEBUG
+
+    cache_file = None
+    if not args.no_config_cache:
+        cache_file = args.config_cache or '{}.hbm.cache'.format(args.config)
+    (CONFIG, source, parse_seconds) = load_config(
+        args.config, parse_config, cache_file=cache_file,
+        required=REQUIRED_CONFIG)
+    log('Startup cost: imports {:.3f}s, config {:.3f}s ({})'.format(
+        IMPORT_SECONDS, parse_seconds, source))
+
+    # One alert queue for both detectors.  bfd_int_sync's own EMAIL settings
+    # stay empty so it only logs to syslog.
+    hbm.MAIL = AlertQueue(mail(CONFIG['email'])).start()
+
+    # One eAPI session per switch, shared by every detector
+    CONFIG['eapi']['switch'] = CachedServer(
+        Server(CONFIG['eapi']['url']), max_entries=CONFIG['eapi_cache_size'])
+    if CONFIG.get('peer', {}).get('url'):
+        CONFIG['peer']['switch'] = CachedServer(
+            Server(CONFIG['peer']['url']),
+            max_entries=CONFIG['eapi_cache_size'])
+
+    log('Testing path on startup...', email=True,
+        subject='Intelligent bypass starting')
+
+    deadline = None
+    if CONFIG['startup_timeout'] > 0:
+        deadline = ibypass_common.CLOCK.time() + CONFIG['startup_timeout']
+    startup(CONFIG, deadline=deadline)
+
+    wake = threading.Event()
+    schedule = {'probe': 0, 'evaluate': False}
+
+    telemetry = None
+    if CONFIG['telemetry']['enabled']:
+        telemetry = TelemetrySubscriber(CONFIG['telemetry']['hostname'],
+                                        CONFIG['telemetry']['port'])
+
+    # Heartbeats, BFD and interface state all feed one decision engine, so
+    # whichever signal sees a failure first fails the path.
+    dispatcher = Dispatcher(CONFIG)
+    engine = DecisionEngine()
+    devices = build_devices(CONFIG, dispatcher=dispatcher, engine=engine)
+    journal = open_journal(CONFIG, 'ibypassd', devices)
+    status = Status()
+    watcher = BfdWatcher(CONFIG['eapi']['switch'],
+                         [path['interface'] for path in CONFIG['paths']],
+                         dispatcher,
+                         logfile=args.logfile,
+                         sources=CONFIG['bfd_sources'],
+                         poll_interval=CONFIG['bfd_poll_interval'],
+                         telemetry=telemetry,
+                         alert_holddown=CONFIG['alert_holddown'],
+                         alerts=hbm.MAIL,
+                         wake=wake,
+                         engine=engine,
+                         journal=journal,
+                         paths=CONFIG['paths'])
+
+    def on_engine_failure(path):
+        """Run the state machines now rather than at the next probe"""
+        schedule['evaluate'] = True
+        wake.set()
+
+    engine.add_callback(on_engine_failure)
+
+    def on_state_change(device, old, new):
+        """Resume BFD detection once every path has recovered"""
+        if new == PathTable.UP and old == PathTable.FAILED and \
+                watcher.failed is not None and \
+                all(path.state == 'up' for path in devices):
+            log('Paths recovered; resuming BFD detection')
+            watcher.restart()
+
+    devices[0].table.add_callback(on_state_change)
+
+    def on_telemetry(event):
+        """Run the next health check now if a monitored path changed"""
+        for device in devices:
+            if event.get('name') == device.interface or \
+                    event.get('peer') == device.probe_dst_address:
+                record_signal(device, event)
+                schedule['probe'] = 0
+                wake.set()
+
+    if telemetry is not None:
+        telemetry.add_callback(on_telemetry)
+        telemetry.start()
+
+    signal.signal(signal.SIGHUP, hbm.request_reload)
+    signal.siginterrupt(signal.SIGHUP, False)
+    profiler = ibypass_common.install_diagnostics('ibypassd', args)
+
+    baselines = open_baselines(CONFIG, args.config, devices)
+    evaluator = batch_evaluator(CONFIG, devices)
+    try:
+        while True:
+            profiler.tick()
+            if hbm.RELOAD:
+                hbm.RELOAD = False
+                (CONFIG, devices) = reload_config(args.config, CONFIG,
+                                                  devices,
+                                                  cache_file=cache_file)
+                baselines.restore(devices)
+                journal = open_journal(CONFIG, 'ibypassd', devices, journal)
+                evaluator = batch_evaluator(CONFIG, devices)
+                watcher.journal = journal
+                watcher.use_switch(CONFIG['eapi']['switch'])
+                watcher.alert_holddown = CONFIG['alert_holddown']
+                watcher.watch([path['interface'] for path in CONFIG['paths']],
+                              paths=CONFIG['paths'])
+
+            now = ibypass_common.CLOCK.time()
+            if now >= schedule['probe']:
+                read_approvals(args.approve_file, devices)
+                if watcher.failed is not None:
+                    watcher.recheck()
+                probe_devices(devices, evaluator, now=now)
+                baselines.save(devices, now=now)
+                status.runAll(devices, evaluator)
+                write_status(args.status_file, devices, now=now)
+                schedule['probe'] = now + CONFIG['interval']
+                schedule['evaluate'] = False
+            elif schedule['evaluate']:
+                schedule['evaluate'] = False
+                status.runAll(devices, evaluator)
+                write_status(args.status_file, devices)
+
+            delay = schedule['probe'] - ibypass_common.CLOCK.time()
+            if watcher.state != 'done':
+                delay = min(delay, watcher.step())
+            ibypass_common.CLOCK.wait(wake, max(delay, 0))
+            wake.clear()
+    except (KeyboardInterrupt, SystemExit):
+        baselines.save(devices, force=True)
+        raise
+
+if __name__ == '__main__':
+    setProcName('ibypassd')
+
+    try:
+        main()
+    except KeyboardInterrupt:
+        log('Exiting by user interrupt (^C)')
+    except Exception, e:
+        log('Intelligent bypass daemon failed: %s (%s)' %
+            (e, traceback.format_exc()), error=True)
+    finally:
+        if hbm.MAIL:
+            hbm.MAIL.stop()
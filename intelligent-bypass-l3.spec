@@ -66,6 +66,9 @@ Arista(config-event-handler-hbm)
 %{__install} -m 0644 -D bfd_int_sync.ini %{buildroot}%{_sysconfdir}/bfd_int_sync.ini
 %{__install} -m 0755 -D bfd_int_sync.py %{buildroot}%{_bindir}/bfd_int_sync.py
 %{__install} -m 0755 -D hbm.py %{buildroot}%{_bindir}/hbm.py
+%{__install} -m 0644 -D ibypass_common.py %{buildroot}%{_bindir}/ibypass_common.py
+%{__install} -m 0755 -D ibypassd.py %{buildroot}%{_bindir}/ibypassd.py
+%{__install} -m 0755 -D hbm_history.py %{buildroot}%{_bindir}/hbm_history.py
 %{__install} -m 0755 -D hbm_service %{buildroot}/%{_bindir}/hbm_service
 
 %clean
@@ -76,6 +79,9 @@ rm -rf %{buildroot}
 %config(noreplace) %attr(644,root,root) %{_sysconfdir}/bfd_int_sync.ini
 %{_bindir}/bfd_int_sync.py
 %{_bindir}/hbm.py
+%{_bindir}/ibypass_common.py
+%{_bindir}/ibypassd.py
+%{_bindir}/hbm_history.py
 %{_bindir}/hbm_service
 %exclude %{_bindir}/*.py[co]
 
@@ -14,7 +14,9 @@ config = {
     'https://github.com/arista-eosplus/Intelligent-Bypass-L3/releases',
     'license': open('LICENSE').read().strip(),
     'version': open('VERSION').read().strip(),
-    'scripts': ['hbm_service', 'hbm.py', 'bfd_int_sync.py'],
+    'scripts': ['hbm_service', 'hbm.py', 'bfd_int_sync.py', 'ibypassd.py',
+                'hbm_history.py'],
+    'py_modules': ['ibypass_common'],
     'data_files': [('/mnt/flash', ['bfd_int_sync.ini'])],
 }
 
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Time hbm_history.py analyze on a month of heartbeats
+
+Writes a ring file of synthetic heartbeats, by default a month at a 100 ms
+interval: replies of 1-3 ms with 0.1% lost, and every few hours a burst of
+slow or lost replies.  It then times loading the file and analysing it with
+three candidate threshold sets.
+
+    python test/bench/bench_analyze.py [--samples 25920000]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import numpy  # noqa
+from hbm import RttRecorder, PathTable  # noqa
+from hbm_history import load_ring, analyze  # noqa
+
+
+def write_ring(filename, samples, seed=1):
+    """Write a full ring file of synthetic heartbeats"""
+    rand = numpy.random.RandomState(seed)
+    rtts = rand.uniform(1, 3, samples).astype('<f4')
+    for start in rand.randint(0, samples, samples // 100000):
+        rtts[start:start + rand.randint(10, 300)] = rand.uniform(10, 30)
+    retcodes = (rand.random_sample(samples) < 0.001).astype('i1')
+    rtts[retcodes != 0] = numpy.nan
+    records = numpy.zeros(samples, dtype=[
+        ('timestamp', '<f8'), ('rtt', '<f4'), ('retcode', 'i1'),
+        ('state', 'u1'), ('', 'V2')])
+    records['timestamp'] = 1.4e9 + numpy.arange(samples) * 0.1
+    records['rtt'] = rtts
+    records['retcode'] = retcodes
+    records['state'] = PathTable.UP
+    with open(filename, 'wb') as fileh:
+        header = RttRecorder.HEADER.pack(RttRecorder.MAGIC,
+                                         RttRecorder.RECORD.size, samples,
+                                         samples)
+        fileh.write(header.ljust(RttRecorder.HEADER_SIZE, '\0'))
+        fileh.write(records.tostring())
+
+
+def main():
+    """Print the time to load and analyze the heartbeats"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--samples', type=int, default=30 * 86400 * 10,
+                        help='Heartbeats in the ring file')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'segment-a.rtt')
+        write_ring(filename, args.samples)
+        start = time.time()
+        records = load_ring(numpy, filename)
+        loaded = time.time()
+        summary = analyze(numpy, records, [(13, 15), (10, 20), (5, 25)])
+        done = time.time()
+    finally:
+        shutil.rmtree(tmpdir)
+    print '{} heartbeats: load {:.2f}s, analyze {:.2f}s'.format(
+        summary['heartbeats'], loaded - start, done - loaded)
+    for result in summary['thresholds']:
+        print '  {:g}/{:g}: {} Warn and {} Failed transitions'.format(
+            result['alert_threshold'], result['failure_threshold'],
+            result['warn_transitions'], result['fail_transitions'])
+
+if __name__ == '__main__':
+    main()
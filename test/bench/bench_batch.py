@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Per-tick cost of evaluating the heartbeats of many paths
+
+Compares evaluating each path in turn, as the monitors do by default
+(Heartbeat.evaluate() then PathTable.tick()), with BatchEvaluator with and
+without NumPy.  No pings are sent: every tick feeds each path a synthetic
+result, a reply of 1-3 ms with 1% of replies lost, so only the evaluation
+is timed.
+
+    python test/bench/bench_batch.py [--paths 10,100,1000] [--ticks 200]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+from hbm import Heartbeat, PathTable, BatchEvaluator, DecisionEngine  # noqa
+
+
+class NullDispatcher(object):
+    """Accept config pushes without contacting a switch"""
+
+    def apply(self, name):
+        pass
+
+
+def build(count):
+    """Return a PathTable of count started paths sharing an engine"""
+    table = PathTable()
+    (dispatcher, engine) = (NullDispatcher(), DecisionEngine())
+    for index in range(count):
+        device = Heartbeat('10.{}.{}.1'.format(index // 256, index % 256),
+                           interface='Ethernet{}'.format(index),
+                           table=table)
+        (device.dispatcher, device.engine) = (dispatcher, engine)
+    return table
+
+
+def results(count, ticks, seed=1):
+    """Return (retcodes, rtts) for each tick"""
+    rand = random.Random(seed)
+    rounds = []
+    for _ in range(ticks):
+        retcodes = [int(rand.random() < 0.01) for _ in range(count)]
+        rtts = [None if retcode else rand.uniform(1, 3)
+                for retcode in retcodes]
+        rounds.append((retcodes, rtts))
+    return rounds
+
+
+def per_path(table, rounds):
+    """Evaluate each path in turn; return seconds per tick"""
+    devices = list(table.devices)
+    start = time.time()
+    for (retcodes, rtts) in rounds:
+        for (device, retcode, rtt) in zip(devices, retcodes, rtts):
+            device.evaluate(retcode, rtt)
+        table.tick()
+    return (time.time() - start) / len(rounds)
+
+
+def batch(table, rounds, vectorize):
+    """Evaluate all paths with a BatchEvaluator; return seconds per tick"""
+    evaluator = BatchEvaluator(table, vectorize=vectorize)
+    if vectorize and evaluator.numpy is None:
+        return None
+    rows = range(len(table.devices))
+    start = time.time()
+    for (retcodes, rtts) in rounds:
+        evaluator.record(rows, retcodes, rtts)
+        evaluator.tick()
+    return (time.time() - start) / len(rounds)
+
+
+def main():
+    """Print the cost per tick for each number of paths"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--paths', default='10,100,1000',
+                        help='Comma separated numbers of paths')
+    parser.add_argument('--ticks', type=int, default=200,
+                        help='Ticks to time for each run')
+    args = parser.parse_args()
+
+    print '{:>6} {:>14} {:>14} {:>14}'.format('paths', 'per path',
+                                              'batch python', 'batch numpy')
+    for count in [int(value) for value in args.paths.split(',')]:
+        rounds = results(count, args.ticks)
+        timings = [per_path(build(count), rounds),
+                   batch(build(count), rounds, False),
+                   batch(build(count), rounds, True)]
+        print '{:>6} {:>14} {:>14} {:>14}'.format(
+            count, *['-' if seconds is None else
+                     '{:.1f} us'.format(seconds * 1e6)
+                     for seconds in timings])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""End-to-end failover latency of hbm.py and bfd_int_sync.py
+
+Runs each monitor as its own process against two stand-in eAPI servers on
+the loopback, which record when each config push arrives, and a stand-in
+probe target which answers heartbeats with injected delay or loss (a
+'ping' ahead of the real one on the monitor's PATH).  The paths come up,
+then at a random point in the probe interval the fault is injected: the
+first path's heartbeats are lost or delayed past failure_threshold for
+hbm.py, a BFD Down is written to the watched log for bfd_int_sync.py.
+Each run reports, in ms from the fault:
+
+    detection  the first failed heartbeat completes (hbm.py), or the BFD
+               Down is read (bfd_int_sync.py)
+    decision   the path's Failed transition or the BFD failure is
+               journaled
+    dispatch   fail_config has arrived at both switches
+
+    python test/bench/bench_failover.py [--monitor hbm,bfd] [--runs 20]
+        [--interval 1] [--fault loss|delay:<ms>]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+from hbm import PathTable, parse_config  # noqa
+from ibypass_common import EventJournal, journal_file  # noqa
+from eapi_server import EapiServer  # noqa
+from probe_target import ProbeTarget  # noqa
+from virtual_time import write_config  # noqa
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..')
+PATHS = (('Ethernet2', '127.0.0.2'), ('Ethernet3', '127.0.0.3'))
+STAGES = ('detection', 'decision', 'dispatch')
+BFD_DOWN = 'Rib: %BGP-BFD-STATE-CHANGE: peer {} (AS 10000) Up to Down\n'
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a sorted list"""
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def wait_for(condition, timeout, process=None):
+    """Poll condition() until it returns something true
+
+    Raises:
+        RuntimeError: On timeout, or if process exits first
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = condition()
+        if result:
+            return result
+        if process is not None and process.poll() is not None:
+            raise RuntimeError('monitor exited with {}'.format(
+                process.returncode))
+        time.sleep(0.002)
+    raise RuntimeError('timed out after {}s'.format(timeout))
+
+
+class Bench(object):
+    """The stand-ins and config shared by every run"""
+
+    def __init__(self, args):
+        self.args = args
+        self.tmpdir = tempfile.mkdtemp()
+        self.local = EapiServer().start()
+        self.peer = EapiServer().start()
+        self.target = ProbeTarget(timeout=args.ping_timeout).start()
+        for (interface, peer) in PATHS:
+            self.local.switch.set_interface(interface)
+            self.local.switch.routes[interface] = peer
+        self.logfile = os.path.join(self.tmpdir, 'eos')
+        self.config = write_config(
+            self.tmpdir,
+            General={'interval': str(args.interval),
+                     'timeout': str(args.interval),
+                     'probe_dst_address1': PATHS[0][1],
+                     'probe_dst_address2': PATHS[1][1],
+                     'bfd_sources': 'log', 'alert_holddown': '0',
+                     'startup_timeout': '30'},
+            eapi={'hostname': '127.0.0.1', 'protocol': 'http',
+                  'port': str(self.local.port)},
+            peer_eapi={'hostname': '127.0.0.1', 'protocol': 'http',
+                       'port': str(self.peer.port)},
+            email={'enabled': 'no'},
+            journal={'enabled': 'yes',
+                     'directory': os.path.join(self.tmpdir, 'journal')})
+        CONFIG = parse_config(self.config)
+        self.sets = CONFIG['eapi']
+        self.failure_threshold = CONFIG['failure_threshold']
+        self.env = dict(os.environ, PATH=os.pathsep.join(
+            [self.target.install(self.tmpdir), os.environ.get('PATH', '')]))
+
+    def close(self):
+        self.local.stop()
+        self.peer.stop()
+        self.target.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def start(self, script, *args):
+        """Start a monitor and wait for ok_config on both switches"""
+        for server in (self.local, self.peer):
+            del server.switch.pushes[:]
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, script), '--config',
+             self.config, '--no-config-cache'] + list(args),
+            env=self.env, cwd=self.tmpdir)
+        try:
+            wait_for(lambda: all(server.arrivals(self.sets['ok_config'])
+                                 for server in (self.local, self.peer)),
+                     60, process)
+        except RuntimeError:
+            self.stop(process)
+            raise
+        return process
+
+    def stop(self, process):
+        """Stop a monitor"""
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+            try:
+                wait_for(lambda: process.poll() is not None, 5)
+            except RuntimeError:
+                process.kill()
+        process.wait()
+
+    def dispatched(self, fault):
+        """Return when fail_config had arrived at both switches"""
+        arrivals = [server.arrivals(self.sets['fail_config'], fault)
+                    for server in (self.local, self.peer)]
+        return all(arrivals) and max(times[0] for times in arrivals)
+
+    def journaled(self, process, fault, kind, new=0):
+        """Return the time of the first journal record of kind since the
+        fault
+        """
+        filename = journal_file(os.path.join(self.tmpdir, 'journal'),
+                                process)
+        for record in EventJournal.query(filename, fault, None,
+                                         PATHS[0][0]):
+            if record[1] == kind and record[3] == new:
+                return record[0]
+        return None
+
+    def run_hbm(self):
+        """Fail the first path's heartbeats; return (fault, stages)"""
+        (address, delay) = (PATHS[0][1], self.args.delay)
+        self.target.set(address)
+        process = self.start(
+            'hbm.py', '--status-file', os.path.join(self.tmpdir, 'status'),
+            '--approve-file', os.path.join(self.tmpdir, 'approve'))
+        try:
+            time.sleep(random.uniform(0, self.args.interval))
+            fault = time.time()
+            if delay:
+                self.target.set(address, delay=delay)
+            else:
+                self.target.set(address, loss=1.0)
+            dispatched = wait_for(lambda: self.dispatched(fault), 120,
+                                  process)
+        finally:
+            self.stop(process)
+            self.target.set(address)
+        failed = [when for (when, sent, outcome) in self.target.received
+                  if sent == address and when >= fault and outcome != 'reply']
+        detected = failed[0] + (delay / 1000.0 if delay else
+                                self.args.ping_timeout)
+        decided = self.journaled('hbm', fault, EventJournal.TRANSITION,
+                                 PathTable.FAILED)
+        return (fault, (detected, decided, dispatched))
+
+    def run_bfd(self):
+        """Log a BFD Down for the first path; return (fault, stages)"""
+        open(self.logfile, 'w').close()
+        process = self.start('bfd_int_sync.py', '--logfile', self.logfile)
+        try:
+            time.sleep(random.uniform(0, self.args.interval))
+            fault = time.time()
+            with open(self.logfile, 'a') as fileh:
+                fileh.write(BFD_DOWN.format(PATHS[0][1]))
+            dispatched = wait_for(lambda: self.dispatched(fault), 60,
+                                  process)
+        finally:
+            self.stop(process)
+        decided = self.journaled('bfd_int_sync', fault, EventJournal.BFD)
+        return (fault, (decided, decided, dispatched))
+
+
+def report(name, results):
+    """Print the percentiles of each stage in ms"""
+    print '{}: {} runs'.format(name, len(results))
+    print '  {:<10} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'ms', 'min', 'p50', 'p90', 'p99', 'max')
+    for (index, stage) in enumerate(STAGES):
+        values = sorted((times[index] - fault) * 1000
+                        for (fault, times) in results
+                        if times[index] is not None)
+        if not values:
+            print '  {:<10} {:>9}'.format(stage, '-')
+            continue
+        print '  {:<10} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            stage, values[0], percentile(values, 50),
+            percentile(values, 90), percentile(values, 99), values[-1])
+
+
+def main():
+    """Time failovers of each monitor and print the latency percentiles"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--monitor', default='hbm,bfd',
+                        help='Comma separated monitors to time: hbm, bfd')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='Failovers to time per monitor')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='Heartbeat interval in seconds')
+    parser.add_argument('--fault', default='loss',
+                        help="'loss' of every heartbeat or 'delay:<ms>' of "
+                             "each reply")
+    parser.add_argument('--ping-timeout', type=float, default=1.0,
+                        help='Seconds a heartbeat waits for its reply')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    args.delay = 0.0
+    if args.fault.startswith('delay:'):
+        args.delay = float(args.fault.split(':', 1)[1])
+    random.seed(args.seed)
+
+    bench = Bench(args)
+    if args.delay and args.delay <= bench.failure_threshold:
+        parser.error('delay must exceed failure_threshold ({} ms)'.format(
+            bench.failure_threshold))
+    try:
+        for monitor in args.monitor.split(','):
+            run = bench.run_bfd if monitor == 'bfd' else bench.run_hbm
+            report('bfd_int_sync.py' if monitor == 'bfd' else
+                   'hbm.py ({})'.format(args.fault),
+                   [run() for _ in range(args.runs)])
+    finally:
+        bench.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""Log following throughput, lag and CPU cost of bfd_int_sync.py
+
+A separate writer process appends synthetic /var/log/eos traffic to a
+temporary file at each given rate: noise lines with a BGP-BFD-STATE-CHANGE
+line for a monitored peer every --bfd-every seconds.  Depending on the
+scenario the log is also rotated (renamed and recreated) or truncated in
+place every --churn seconds.  In this process a BfdWatcher follows the log
+with its own step() loop, as bfd_int_sync.py's main() does, against a
+stubbed eAPI switch; after each match it goes straight back to watching.
+
+For each scenario and rate the lines written per second, the BFD lines
+matched and missed, the lag from writing each BFD line to the matched
+action in ms, and the CPU used by the follower are reported.
+
+    python test/bench/bench_logtail.py [--rates 100,1000,10000,100000]
+        [--scenarios plain,rotate,truncate] [--duration 5]
+"""
+
+import argparse
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import ibypass_common  # noqa
+from bfd_int_sync import BfdWatcher  # noqa
+from virtual_time import FakeSwitch  # noqa
+
+PEERS = (('Ethernet2', '192.0.3.1'), ('Ethernet3', '192.0.4.1'))
+NOISE = ('{} sw1 Lldp: %LLDP-5-NEIGHBOR_NEW: LLDP neighbor with chassisId '
+         '001c.7300.{:04x} and portId "Ethernet{}" added on interface '
+         'Ethernet1\n')
+BFD_DOWN = ('{} sw1 Rib[{}]: %BGP-BFD-STATE-CHANGE: peer {} (AS 10000) Up '
+            'to Down\n')
+SEQUENCE = re.compile(r'Rib\[(\d+)\]')
+
+
+class NullDispatcher(object):
+    """Accept config pushes without contacting a switch"""
+
+    def apply(self, name, force=False, path=None, commands=None):
+        return True
+
+
+def write_log(logfile, rate, duration, bfd_every, scenario, churn, pipe):
+    """Append noise and BFD lines to logfile at rate lines per second,
+    rotating or truncating it every churn seconds, then send the number of
+    lines written and the time each BFD line was written down pipe
+    """
+    stamp = time.strftime('%b %d %H:%M:%S')
+    noise = [NOISE.format(stamp, index, index % 48 + 1)
+             for index in range(1024)]
+    fileh = open(logfile, 'a')
+    (written, bfd_times) = (0, {})
+    start = time.time()
+    # Churn between BFD lines: a line truncated away before anyone could
+    #   read it is lost to any follower
+    (next_bfd, next_churn) = (start + bfd_every,
+                              start + churn + bfd_every / 2)
+    now = start
+    while now < start + duration:
+        due = int((now - start) * rate) - written
+        if due > 0:
+            fileh.write(''.join(noise[(written + index) % 1024]
+                                for index in xrange(due)))
+            written += due
+        if now >= next_bfd:
+            seq = len(bfd_times)
+            (_, peer) = PEERS[seq % len(PEERS)]
+            fileh.write(BFD_DOWN.format(stamp, seq, peer))
+            written += 1
+            bfd_times[seq] = time.time()
+            next_bfd += bfd_every
+        fileh.flush()
+        if scenario != 'plain' and now >= next_churn:
+            if scenario == 'rotate':
+                fileh.close()
+                os.rename(logfile, logfile + '.1')
+                fileh = open(logfile, 'a')
+            else:
+                fileh.truncate(0)
+                fileh.seek(0)
+            next_churn += churn
+        time.sleep(0.001)
+        now = time.time()
+    fileh.close()
+    pipe.send((written, time.time() - start, bfd_times))
+    pipe.close()
+
+
+def follow(directory, rate, args, scenario):
+    """Follow the log while a writer fills it; return the results"""
+    logfile = os.path.join(directory, 'eos')
+    open(logfile, 'w').close()
+    switch = FakeSwitch(ibypass_common.Clock())
+    for (interface, peer) in PEERS:
+        switch.set_interface(interface)
+        switch.routes[interface] = peer
+    # A long holddown keeps step() from closing the log after a match
+    watcher = BfdWatcher(switch, [interface for (interface, _) in PEERS],
+                         NullDispatcher(), logfile=logfile,
+                         sources=('log',), alert_holddown=10 ** 9)
+    while watcher.state != 'watching':
+        watcher.step()
+
+    matched = {}
+    fail = watcher._fail
+
+    def record(line, *args):
+        """Note when each BFD line was acted on"""
+        matched[int(SEQUENCE.search(line).group(1))] = time.time()
+        fail(line, *args)
+    watcher._fail = record
+
+    (receiver, sender) = multiprocessing.Pipe(False)
+    writer = multiprocessing.Process(
+        target=write_log, args=(logfile, rate, args.duration, args.bfd_every,
+                                scenario, args.churn, sender))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    begin = time.time()
+    writer.start()
+    end = None
+    while end is None or time.time() < end:
+        delay = watcher.step()
+        if watcher.state == 'failed':
+            watcher.state = 'watching'
+            continue
+        ibypass_common.CLOCK.wait(watcher.wake, delay)
+        watcher.wake.clear()
+        if end is None and not writer.is_alive():
+            # Let the follower catch up with the last lines
+            end = time.time() + 1
+    elapsed = time.time() - begin
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    (written, seconds, bfd_times) = receiver.recv()
+    writer.join()
+    watcher.stop()
+    for name in os.listdir(directory):
+        os.unlink(os.path.join(directory, name))
+
+    lags = sorted((matched[seq] - when) * 1000
+                  for (seq, when) in bfd_times.items() if seq in matched)
+    return {'rate': written / seconds,
+            'bfd': len(bfd_times),
+            'matched': len(lags),
+            'lags': lags,
+            'cpu': (after.ru_utime + after.ru_stime - usage.ru_utime -
+                    usage.ru_stime) / elapsed}
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a sorted list"""
+    return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+
+def main():
+    """Print the lag and CPU cost of following the log at each rate"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rates', default='100,1000,10000,100000',
+                        help='Comma separated lines per second')
+    parser.add_argument('--scenarios', default='plain,rotate,truncate',
+                        help='Comma separated: plain, rotate, truncate')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='Seconds to write at each rate')
+    parser.add_argument('--bfd-every', type=float, default=0.25,
+                        help='Seconds between BFD lines')
+    parser.add_argument('--churn', type=float, default=1,
+                        help='Seconds between rotations or truncations')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        print '{:<9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+            'scenario', 'lines/s', 'matched', 'lag p50', 'lag p99',
+            'lag max', 'cpu')
+        for scenario in args.scenarios.split(','):
+            for rate in [int(value) for value in args.rates.split(',')]:
+                result = follow(directory, rate, args, scenario)
+                lags = result['lags']
+                print '{:<9} {:>9.0f} {:>9} {:>9} {:>9} {:>9} {:>8.1%}'.format(
+                    scenario, result['rate'],
+                    '{}/{}'.format(result['matched'], result['bfd']),
+                    *(['{:.1f}ms'.format(value) for value in
+                       (percentile(lags, 50), percentile(lags, 99),
+                        lags[-1])] if lags else ['-'] * 3) +
+                    [result['cpu']])
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
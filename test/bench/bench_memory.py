@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Resident memory per monitored path
+
+Builds the given numbers of paths with build_devices() from the sample
+config, with adaptive thresholds and dampening enabled so each path has
+every per-path object, and reports the growth in RSS per path.  Linux
+only: RSS is read from /proc/self/statm.
+
+    python test/bench/bench_memory.py [--paths 1000,10000] [--history 32]
+"""
+
+import argparse
+import gc
+import os
+import resource
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+from hbm import parse_config, build_devices  # noqa
+
+INI = os.path.join(os.path.dirname(__file__), '../../bfd_int_sync.ini')
+
+
+def rss():
+    """Return the resident set size of this process in bytes"""
+    with open('/proc/self/statm') as fileh:
+        return int(fileh.read().split()[1]) * resource.getpagesize()
+
+
+def config(count, history):
+    """Return the sample config with count paths sharing its config sets"""
+    CONFIG = parse_config(INI)
+    CONFIG['rtt_history'] = history
+    CONFIG['adaptive'] = {'enabled': True, 'alpha': 0.05,
+                          'warn_deviation': 3.0, 'fail_deviation': 6.0,
+                          'warn_floor': 2.0, 'fail_floor': 4.0}
+    CONFIG['dampening'] = {'enabled': True, 'half_life': 900,
+                           'suppress': 2000, 'reuse': 750, 'penalty': 500,
+                           'max_suppress': 3600}
+    CONFIG['paths'] = [
+        {'name': 'path{}'.format(index),
+         'interface': 'Ethernet{}/{}'.format(index // 48 + 1,
+                                             index % 48 + 1),
+         'probe_dst_address': '10.{}.{}.1'.format(index // 256,
+                                                  index % 256),
+         'alert_threshold': CONFIG['alert_threshold'],
+         'failure_threshold': CONFIG['failure_threshold'],
+         'commands': None}
+        for index in range(count)]
+    return CONFIG
+
+
+def main():
+    """Print the RSS growth per path for each number of paths"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--paths', default='1000,10000',
+                        help='Comma separated numbers of paths')
+    parser.add_argument('--history', type=int, default=32,
+                        help='RTTs kept per path (rtt_history)')
+    args = parser.parse_args()
+
+    print '{:>6} {:>14} {:>14}'.format('paths', 'RSS growth', 'per path')
+    for count in [int(value) for value in args.paths.split(',')]:
+        CONFIG = config(count, args.history)
+        gc.collect()
+        before = rss()
+        devices = build_devices(CONFIG)
+        gc.collect()
+        growth = rss() - before
+        print '{:>6} {:>11} kB {:>8} bytes'.format(
+            len(devices), growth // 1024, growth // len(devices))
+        del devices
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Stand-in eAPI server which answers JSON-RPC over HTTP on the loopback
+like a FakeSwitch, recording when each config push arrives
+"""
+
+import BaseHTTPServer
+import json
+import os
+import sys
+import threading
+
+sys.path.append(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import ibypass_common  # noqa
+from virtual_time import FakeSwitch  # noqa
+
+
+class EapiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer runCmds requests from the server's switch"""
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(
+            int(self.headers.getheader('content-length', 0))))
+        params = request.get('params')
+        cmds = params[1] if isinstance(params, list) else params['cmds']
+        response = {'jsonrpc': '2.0', 'id': request.get('id'),
+                    'result': self.server.switch.runCmds(1, cmds)}
+        body = json.dumps(response)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class EapiServer(object):
+    """A JSON-RPC eAPI endpoint on 127.0.0.1 backed by a FakeSwitch.  The
+    switch's pushes hold the wall clock time each config push arrived.
+    """
+
+    def __init__(self, switch=None):
+        """
+        Args:
+            switch (FakeSwitch): Answers the commands, by default a new one
+                                 on the real clock
+        """
+        self.switch = switch or FakeSwitch(ibypass_common.Clock())
+        self._server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                 EapiHandler)
+        self._server.switch = self.switch
+        self.port = self._server.server_address[1]
+
+    def start(self):
+        """Serve requests in a background thread"""
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  name='eapi')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def arrivals(self, cmds, since=0):
+        """Return the times at which the given commands were pushed"""
+        return [when for (when, pushed) in self.switch.pushes
+                if pushed == list(cmds) and when >= since]
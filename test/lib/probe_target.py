@@ -0,0 +1,112 @@
+"""Stand-in probe target which answers heartbeats on the loopback with an
+injected delay and loss per probe address
+"""
+
+import os
+import random
+import socket
+import stat
+import sys
+import threading
+import time
+
+# Installed as 'ping' ahead of the real one on PATH.  Sends one datagram
+# naming the probed address to the ProbeTarget and prints the reply's RTT
+# as ping -c 1 does, or exits 1 if no reply arrives within the timeout.
+PING = '''#!{python}
+import socket
+import sys
+import time
+
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sock.settimeout({timeout!r})
+start = time.time()
+sock.sendto(sys.argv[-1], ('127.0.0.1', {port}))
+try:
+    sock.recv(64)
+except socket.timeout:
+    sys.exit(1)
+rtt = (time.time() - start) * 1000
+print '1 packets transmitted, 1 received, 0% packet loss, time 0ms'
+print 'rtt min/avg/max/mdev = %.3f/%.3f/%.3f/0.000 ms' % (rtt, rtt, rtt)
+'''
+
+
+class ProbeTarget(object):
+    """Answer the heartbeats of every monitored path from one UDP socket.
+    Each probe address can be given a delay and a loss rate while a
+    monitor is running.
+    """
+
+    def __init__(self, timeout=1.0, seed=1):
+        """
+        Args:
+            timeout (float): Seconds the installed ping waits for a reply
+            seed (int): Seeds which heartbeats are lost
+        """
+        self.timeout = timeout
+        # address: (delay in seconds, fraction lost)
+        self.faults = {}
+        # (time, address, outcome) of each heartbeat received, where
+        # outcome is 'reply', 'delayed' or 'lost'
+        self.received = []
+        self._random = random.Random(seed)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self.port = self._sock.getsockname()[1]
+        self._stopped = threading.Event()
+
+    def set(self, address, delay=0.0, loss=0.0):
+        """Delay the replies to address by delay ms and lose loss of them"""
+        self.faults[address] = (delay / 1000.0, loss)
+
+    def install(self, directory):
+        """Write the ping stand-in to directory/ping
+
+        Returns:
+            str: The directory, to put first on PATH
+        """
+        filename = os.path.join(directory, 'ping')
+        with open(filename, 'w') as fileh:
+            fileh.write(PING.format(python=sys.executable,
+                                    timeout=self.timeout, port=self.port))
+        os.chmod(filename, stat.S_IRWXU)
+        return directory
+
+    def start(self):
+        """Answer heartbeats in a background thread"""
+        thread = threading.Thread(target=self.run, name='probe-target')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """Stop answering"""
+        self._stopped.set()
+        self._sock.close()
+
+    def run(self):
+        """Answer each heartbeat as its address's fault dictates"""
+        self._sock.settimeout(0.1)
+        while not self._stopped.is_set():
+            try:
+                (address, sender) = self._sock.recvfrom(64)
+            except socket.timeout:
+                continue
+            except socket.error:
+                return
+            (delay, loss) = self.faults.get(address, (0.0, 0.0))
+            if loss and self._random.random() < loss:
+                self.received.append((time.time(), address, 'lost'))
+            elif delay:
+                self.received.append((time.time(), address, 'delayed'))
+                threading.Timer(delay, self._reply, (address, sender)).start()
+            else:
+                self.received.append((time.time(), address, 'reply'))
+                self._reply(address, sender)
+
+    def _reply(self, address, sender):
+        try:
+            self._sock.sendto(address, sender)
+        except socket.error:
+            pass
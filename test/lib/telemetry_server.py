@@ -0,0 +1,88 @@
+"""Stand-in streaming telemetry server which replays recorded state changes
+"""
+
+import json
+import socket
+import threading
+import time
+
+
+class TelemetryReplayServer(object):
+    """Serve a recorded telemetry session to each subscriber.
+
+    Each client must send a subscribe request first.  It then receives the
+    snapshot events, a sync marker, and the recorded changes.  Changes with a
+    'delay' key are sent that many seconds after the previous one.
+    """
+
+    def __init__(self, snapshot=(), changes=(), hold_open=True):
+        """
+        Args:
+            snapshot (list): Events describing the state at subscription
+            changes (list): Events to replay after the sync marker
+            hold_open (bool): Keep the connection open after the replay
+        """
+        self.snapshot = list(snapshot)
+        self.changes = list(changes)
+        self.hold_open = hold_open
+        self.subscriptions = []
+        self._stopped = threading.Event()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(5)
+        self._sock.settimeout(0.1)
+        self.port = self._sock.getsockname()[1]
+        self._clients = []
+
+    def start(self):
+        """Accept subscribers in a background thread"""
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """Close the listening socket and all client connections"""
+        self._stopped.set()
+        for client in self._clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            client.close()
+        self._sock.close()
+
+    def _accept(self):
+        while not self._stopped.is_set():
+            try:
+                (client, _) = self._sock.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                return
+            self._clients.append(client)
+            thread = threading.Thread(target=self._replay, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _replay(self, client):
+        try:
+            client.settimeout(None)
+            request = client.makefile('r').readline()
+            self.subscriptions.append(json.loads(request))
+            for event in self.snapshot:
+                client.sendall(json.dumps(event) + '\n')
+            client.sendall(json.dumps({'type': 'sync'}) + '\n')
+            for event in self.changes:
+                if isinstance(event, dict):
+                    event = dict(event)
+                    time.sleep(event.pop('delay', 0))
+                    event = json.dumps(event)
+                client.sendall(event + '\n')
+            if self.hold_open:
+                self._stopped.wait()
+        except socket.error:
+            pass
+        finally:
+            client.close()
@@ -0,0 +1,305 @@
+"""Run the monitors on virtual time.
+
+ScenarioClock takes the place of ibypass_common.CLOCK and jumps straight to
+the next scheduled action instead of sleeping, so minutes of startup
+retries, holddowns and failovers run in milliseconds.  FakeSwitch, FakePings
+and AlertSink stand in for eAPI, ping and email, recording what the monitors
+send along with the virtual time it was sent.
+"""
+
+import ConfigParser
+import heapq
+import os
+import socket
+import sys
+import threading
+from mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import hbm  # noqa
+import ibypass_common  # noqa
+import bfd_int_sync  # noqa
+
+INI = os.path.join(os.path.dirname(__file__), '../../bfd_int_sync.ini')
+
+
+class ScenarioEnd(Exception):
+    """Raised by ScenarioClock when the scenario runs out of time"""
+
+
+class ScenarioClock(ibypass_common.VirtualClock):
+    """A VirtualClock which runs scheduled actions as time passes and ends
+    the scenario once time passes until
+    """
+
+    def __init__(self, now=0.0, until=None):
+        """
+        Args:
+            now (float): The starting time
+            until (float): Raise ScenarioEnd rather than move past this time
+        """
+        ibypass_common.VirtualClock.__init__(self, now)
+        self.until = until
+        self._actions = []
+        self._lock = threading.RLock()
+
+    def at(self, when, action, *args):
+        """Call action(*args) once the clock reaches when"""
+        with self._lock:
+            heapq.heappush(self._actions,
+                           (when, len(self._actions), action, args))
+
+    def after(self, seconds, action, *args):
+        """Call action(*args) seconds from now"""
+        self.at(self.now + seconds, action, *args)
+
+    def advance(self, seconds):
+        self._run_until(self.now + max(seconds, 0))
+
+    def advance_to(self, now):
+        self._run_until(max(self.now, float(now)))
+
+    def wait(self, event, timeout):
+        if not event.is_set():
+            self._run_until(self.now + timeout, event)
+        return event.is_set()
+
+    def _run_until(self, end, event=None):
+        """Move to end, running the actions due on the way.  Stop early if
+        an action sets event.
+        """
+        with self._lock:
+            while self._actions and self._actions[0][0] <= end:
+                (when, _, action, args) = heapq.heappop(self._actions)
+                self.now = max(self.now, when)
+                action(*args)
+                if event is not None and event.is_set():
+                    return
+            if self.until is not None and end > self.until:
+                self.now = self.until
+                raise ScenarioEnd()
+            self.now = max(self.now, end)
+
+
+class FakeSwitch(object):
+    """Answer the eAPI commands the monitors send and record config
+    pushes
+    """
+
+    def __init__(self, clock, reachable=True):
+        """
+        Args:
+            clock (VirtualClock): Timestamps each push
+            reachable (bool): False refuses every request, as a switch with
+                              eAPI not yet enabled
+        """
+        self.clock = clock
+        self.reachable = reachable
+        # interface: (linkStatus, lineProtocolStatus)
+        self.interfaces = {}
+        # interface: BGP next hop learnt over it
+        self.routes = {}
+        # (time, commands) of each config push
+        self.pushes = []
+
+    def set_interface(self, name, up=True):
+        """Report an interface as connected and up, or not connected"""
+        self.interfaces[name] = ('connected', 'up') if up else \
+            ('notconnect', 'down')
+
+    def runCmds(self, version, cmds, *args):
+        if not self.reachable:
+            raise socket.error(111, 'Connection refused')
+        if 'configure' in cmds:
+            self.pushes.append((self.clock.time(), list(cmds)))
+        return [self._answer(cmd) for cmd in cmds]
+
+    def _answer(self, cmd):
+        words = cmd.split()
+        if words[:2] == ['show', 'interfaces'] and len(words) > 2:
+            (link, protocol) = self.interfaces.get(words[2],
+                                                   ('notconnect', 'down'))
+            status = {words[2]: {'linkStatus': link,
+                                 'lineProtocolStatus': protocol}}
+            if words[3:] == ['status']:
+                return {'interfaceStatuses': status}
+            return {'interfaces': status}
+        if cmd == 'show ip route':
+            return {'vrfs': {'default': {'routes': dict(
+                ('10.{}.0.0/24'.format(index),
+                 {'vias': [{'interface': interface, 'nexthopAddr': peer}]})
+                for (index, (interface, peer))
+                in enumerate(sorted(self.routes.items())))}}}
+        if cmd == 'show bfd peers':
+            return {'vrfs': {}}
+        return {}
+
+
+class FakePings(object):
+    """Take the place of hbm.check_path, answering from the RTT set for
+    each address
+    """
+
+    def __init__(self, clock, rtt=2.0):
+        """
+        Args:
+            clock (VirtualClock): Timestamps each ping
+            rtt (float): The RTT in ms of addresses not set
+        """
+        self.clock = clock
+        self.default = rtt
+        self.rtts = {}
+        # (time, address) of each ping
+        self.sent = []
+
+    def set(self, address, rtt):
+        """Answer address after rtt ms from now on, or not at all if rtt is
+        None
+        """
+        self.rtts[address] = rtt
+
+    def check_path(self, address):
+        self.sent.append((self.clock.time(), address))
+        rtt = self.rtts.get(address, self.default)
+        if rtt is None:
+            return (1, None, None, None, None)
+        return (0, rtt, rtt, rtt, 0.0)
+
+
+class AlertSink(object):
+    """Take the place of hbm's AlertQueue, recording the time and subject
+    of each alert instead of emailing it
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.config = {'enabled': True}
+        # (time, subject) of each alert
+        self.alerts = []
+
+    def __call__(self, mailer):
+        self.config = mailer.config
+        return self
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def send(self, msg, subject=''):
+        self.alerts.append((self.clock.time(), subject))
+
+    def times(self, subject):
+        """Return the times of the alerts with the given subject"""
+        return [when for (when, sent) in self.alerts if sent == subject]
+
+
+def write_config(directory, **sections):
+    """Write the sample config with some options replaced
+
+    Args:
+        directory (str): Where to write it
+        sections (dict): Options to replace per section, e.g.
+                         General={'interval': '5'}.  A section not in
+                         the sample is added; None removes the section.
+
+    Returns:
+        str: The config file name
+    """
+    config = ConfigParser.RawConfigParser()
+    config.read(INI)
+    for (section, options) in sections.items():
+        if options is None:
+            config.remove_section(section)
+            continue
+        if not config.has_section(section):
+            config.add_section(section)
+        for (option, value) in options.items():
+            config.set(section, option, value)
+    filename = os.path.join(directory, 'scenario.ini')
+    with open(filename, 'w') as fileh:
+        config.write(fileh)
+    return filename
+
+
+def config_sets(filename):
+    """Return the config set names of the local switch keyed by their
+    commands
+    """
+    config = hbm.parse_config(filename)
+    return dict((tuple(config['eapi'][name]), name)
+                for name in hbm.CONFIG_SETS if config['eapi'].get(name))
+
+
+def pushed(switch, filename):
+    """Return (time, config set name) for each push to a FakeSwitch"""
+    names = config_sets(filename)
+    return [(when, names.get(tuple(cmds), cmds))
+            for (when, cmds) in switch.pushes]
+
+
+def switches_by_host(local, peer):
+    """Return a stand-in for jsonrpclib.Server which connects to local or,
+    for a URL naming the sample config's peer_eapi host, peer
+    """
+    def server(url):
+        return peer if '@192.0.2.1:' in url else local
+    return server
+
+
+def run_hbm(filename, clock, local, peer, pings, alerts, directory):
+    """Run hbm.main() on a ScenarioClock until it ends the scenario
+
+    Args:
+        filename (str): The config file
+        clock (ScenarioClock): Installed as ibypass_common.CLOCK
+        local (FakeSwitch): The local switch
+        peer (FakeSwitch): The peer switch
+        pings (FakePings): Answers the heartbeats
+        alerts (AlertSink): Receives the email alerts
+        directory (str): Where to keep the status and approval files
+    """
+    argv = ['hbm.py', '--config', filename, '--no-config-cache',
+            '--status-file', os.path.join(directory, 'hbm.status'),
+            '--approve-file', os.path.join(directory, 'hbm.approve')]
+    mail = hbm.MAIL
+    try:
+        with patch.object(ibypass_common, 'CLOCK', clock), \
+                patch.multiple(hbm, check_path=pings.check_path,
+                               AlertQueue=alerts,
+                               Server=switches_by_host(local, peer)), \
+                patch('sys.argv', argv), patch('syslog.syslog'), \
+                patch('syslog.openlog'), patch('syslog.setlogmask'):
+            hbm.main()
+    except ScenarioEnd:
+        pass
+    finally:
+        hbm.MAIL = mail
+
+
+def run_bfd_int_sync(filename, clock, local, peer, logfile):
+    """Run bfd_int_sync.main() on a ScenarioClock until the watcher is
+    done or the scenario ends
+
+    Args:
+        filename (str): The config file
+        clock (ScenarioClock): Installed as ibypass_common.CLOCK
+        local (FakeSwitch): The local switch
+        peer (FakeSwitch): The peer switch
+        logfile (str): The log to watch for BFD state changes
+    """
+    argv = ['bfd_int_sync.py', '--config', filename, '--no-config-cache',
+            '--logfile', logfile]
+    try:
+        with patch.object(ibypass_common, 'CLOCK', clock), \
+                patch.multiple(bfd_int_sync,
+                               Server=switches_by_host(local, peer),
+                               setProcName=lambda name: None), \
+                patch.dict(bfd_int_sync.CONFIG), \
+                patch.dict(bfd_int_sync.EMAIL), \
+                patch('sys.argv', argv), patch('syslog.syslog'):
+            bfd_int_sync.main()
+    except ScenarioEnd:
+        pass
@@ -0,0 +1,349 @@
+"""Validate bfd_int_sync helpers
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from mock import MagicMock, patch
+from StringIO import StringIO
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+import bfd_int_sync  # noqa
+from bfd_int_sync import get_bfd_peers, BfdPeerPoller, BfdWatcher  # noqa
+from hbm import DecisionEngine  # noqa
+from virtual_time import write_config  # noqa
+
+
+def bfd_peers(statuses):
+    """Build a 'show bfd peers' response with one session per peer"""
+    neighbors = {}
+    for peer, status in statuses.items():
+        neighbors[peer] = {
+            'peerStats': {'': {'status': status,
+                               'peerStatsDetail': {}}}}
+    return [{'vrfs': {'default': {'ipv4Neighbors': neighbors,
+                                  'ipv6Neighbors': {}}}}]
+
+
+def show_cmds(version, cmds):
+    """Answer the show commands BfdWatcher issues with both links up and a
+    route via each monitored interface
+    """
+    if cmds[0].startswith('show interfaces'):
+        interface = cmds[0].split()[2]
+        return [{'interfaceStatuses': {
+            interface: {'linkStatus': 'connected',
+                        'lineProtocolStatus': 'up'}}}]
+    if cmds[0] == 'show ip route':
+        routes = {}
+        for prefix, interface, peer in (
+                ('10.1.0.0/16', 'Ethernet2', '192.0.3.1'),
+                ('10.2.0.0/16', 'Ethernet3', '192.0.4.1')):
+            routes[prefix] = {'vias': [{'interface': interface,
+                                        'nexthopAddr': peer}]}
+        return [{'vrfs': {'default': {'routes': routes}}}]
+    return [{}]
+
+
+class TestBfdIntSync(unittest.TestCase):
+
+    def test_get_bfd_peers(self):
+        """Verify the BFD peer table is summarized per peer
+        """
+        response = bfd_peers({'192.0.3.1': 'up', '192.0.4.1': 'down'})
+        self.assertEqual(get_bfd_peers(response),
+                         {'192.0.3.1': 'up', '192.0.4.1': 'down'})
+        self.assertEqual(get_bfd_peers([{}]), {})
+
+    def test_poller_emits_changes_only(self):
+        """Verify only peers which changed since the last poll are reported
+        """
+        switch = MagicMock()
+        poller = BfdPeerPoller(switch, ['192.0.3.1', '192.0.4.1'])
+        events = []
+        poller.add_callback(events.append)
+
+        switch.runCmds.return_value = bfd_peers({'192.0.3.1': 'up',
+                                                 '192.0.4.1': 'up'})
+        self.assertEqual(poller.poll(), [])
+
+        self.assertEqual(poller.poll(), [])
+
+        switch.runCmds.return_value = bfd_peers({'192.0.3.1': 'up',
+                                                 '192.0.4.1': 'down'})
+        changes = poller.poll()
+        self.assertEqual(changes, [{'type': 'bfd', 'peer': '192.0.4.1',
+                                    'status': 'down', 'previous': 'up',
+                                    'source': 'poll'}])
+        self.assertEqual(events, changes)
+
+        # A monitored peer missing from the table is down
+        switch.runCmds.return_value = bfd_peers({'192.0.4.1': 'down'})
+        changes = poller.poll()
+        self.assertEqual([(event['peer'], event['status'])
+                          for event in changes], [('192.0.3.1', 'down')])
+        switch.runCmds.assert_called_with(1, ['show bfd peers'])
+
+    @patch('syslog.syslog')
+    def test_watcher(self, mock_syslog):
+        """Verify the watcher arms once links and routes are up, then
+        applies fail_config on the first matching syslog line
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            logfile = os.path.join(tmpdir, 'eos')
+            with open(logfile, 'w') as fileh:
+                fileh.write('Rib: %BGP-BFD-STATE-CHANGE: peer 192.0.4.1 '
+                            '(AS 10000) Up to Down\n')
+            switch = MagicMock()
+            switch.runCmds.side_effect = show_cmds
+            dispatcher = MagicMock()
+            watcher = BfdWatcher(switch, ['Ethernet2', 'Ethernet3'],
+                                 dispatcher, logfile=logfile)
+
+            watcher.step(now=0)
+            self.assertEqual(watcher.state, 'watching')
+            self.assertEqual(watcher.peers, ['192.0.3.1', '192.0.4.1'])
+            self.assertEqual([args[0][0] for args in
+                              dispatcher.apply.call_args_list],
+                             ['starting_config', 'ok_config'])
+
+            # Lines written before the watcher armed are ignored
+            self.assertEqual(watcher.step(now=1), BfdWatcher.LOG_INTERVAL)
+            with open(logfile, 'a') as fileh:
+                fileh.write('Rib: %BGP-5-ADJCHANGE: peer 192.0.4.1\n')
+                fileh.write('Rib: %BGP-BFD-STATE-CHANGE: peer 192.0.4.1 '
+                            '(AS 10000) Up to Down\n')
+            watcher.step(now=2)
+            self.assertEqual(watcher.state, 'done')
+            self.assertEqual(watcher.failed, ('192.0.4.1', 'Ethernet3'))
+            dispatcher.apply.assert_called_with('fail_config')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('syslog.syslog')
+    def test_watcher_truncated_log(self, mock_syslog):
+        """Verify the watcher reads a log truncated in place from the
+        start, so a BFD Down written after the truncation is acted on
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            logfile = os.path.join(tmpdir, 'eos')
+            open(logfile, 'w').close()
+            switch = MagicMock()
+            switch.runCmds.side_effect = show_cmds
+            dispatcher = MagicMock()
+            watcher = BfdWatcher(switch, ['Ethernet2', 'Ethernet3'],
+                                 dispatcher, logfile=logfile)
+            watcher.step(now=0)
+            with open(logfile, 'a') as fileh:
+                for _ in range(10):
+                    fileh.write('Rib: %BGP-5-ADJCHANGE: peer 192.0.4.1\n')
+            watcher.step(now=1)
+            self.assertEqual(watcher.state, 'watching')
+
+            # As logrotate's copytruncate does
+            with open(logfile, 'r+') as fileh:
+                fileh.truncate(0)
+            watcher.step(now=2)
+            with open(logfile, 'a') as fileh:
+                fileh.write('Rib: %BGP-BFD-STATE-CHANGE: peer 192.0.3.1 '
+                            '(AS 10000) Up to Down\n')
+            watcher.step(now=3)
+            self.assertEqual(watcher.state, 'done')
+            self.assertEqual(watcher.failed, ('192.0.3.1', 'Ethernet2'))
+            dispatcher.apply.assert_called_with('fail_config')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('syslog.syslog')
+    def test_watcher_event(self, mock_syslog):
+        """Verify a BFD Down from the poller or telemetry also fails the
+        path, and the watcher waits for the alert holddown
+        """
+        switch = MagicMock()
+        switch.runCmds.side_effect = show_cmds
+        dispatcher = MagicMock()
+        engine = DecisionEngine()
+        watcher = BfdWatcher(switch, ['Ethernet2', 'Ethernet3'], dispatcher,
+                             sources=[], alert_holddown=300, engine=engine)
+        watcher.step(now=0)
+        self.assertEqual(watcher.step(now=1), BfdWatcher.IDLE_INTERVAL)
+
+        watcher._on_event({'type': 'bfd', 'peer': '192.0.3.1',
+                           'status': 'down', 'previous': 'up',
+                           'source': 'poll'})
+        self.assertTrue(watcher.wake.is_set())
+        self.assertEqual(engine.failed('Ethernet2'), ['bfd'])
+        self.assertIsNone(engine.failed('Ethernet3'))
+        self.assertEqual(watcher.step(now=2), 300)
+        self.assertEqual(watcher.state, 'failed')
+        self.assertEqual(watcher.failed, ('192.0.3.1', 'Ethernet2'))
+        watcher.step(now=302)
+        self.assertEqual(watcher.state, 'done')
+
+        # Once the paths recover, watching resumes without another
+        # ok_config push
+        dispatcher.reset_mock()
+        watcher.restart()
+        watcher.step(now=303)
+        self.assertEqual(watcher.state, 'watching')
+        self.assertIsNone(watcher.failed)
+        self.assertFalse(dispatcher.apply.called)
+
+    @patch('syslog.syslog')
+    def test_watcher_recheck(self, mock_syslog):
+        """Verify a failed watcher reports its peers' current BFD state to
+        the engine, so a path failed on BFD can recover
+        """
+        switch = MagicMock()
+        switch.runCmds.side_effect = show_cmds
+        engine = DecisionEngine()
+        watcher = BfdWatcher(switch, ['Ethernet2', 'Ethernet3'], MagicMock(),
+                             sources=[], engine=engine)
+        watcher.step(now=0)
+        watcher._on_event({'type': 'bfd', 'peer': '192.0.3.1',
+                           'status': 'down', 'previous': 'up'})
+        watcher.step(now=1)
+        self.assertEqual(engine.faults('Ethernet2'), ['bfd'])
+
+        switch.runCmds.side_effect = None
+        switch.runCmds.return_value = bfd_peers({'192.0.3.1': 'down',
+                                                 '192.0.4.1': 'up'})
+        watcher.recheck()
+        self.assertEqual(engine.faults('Ethernet2'), ['bfd'])
+        switch.runCmds.return_value = bfd_peers({'192.0.3.1': 'up'})
+        watcher.recheck()
+        self.assertEqual(engine.faults('Ethernet2'), [])
+        switch.runCmds.assert_called_with(1, ['show bfd peers'])
+
+    @patch('syslog.syslog')
+    def test_reload_rollback(self, mock_syslog):
+        """Verify a reload which fails part way through parsing leaves the
+        running config exactly as it was
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with patch.dict(bfd_int_sync.CONFIG, clear=True), \
+                    patch.dict(bfd_int_sync.EMAIL, clear=True), \
+                    patch('sys.stdout', StringIO()):
+                ini = write_config(tmpdir, email={'enabled': 'no'})
+                bfd_int_sync.reload_config(ini)
+                # As if the running config had no [telemetry] section
+                del bfd_int_sync.CONFIG['telemetry_hostname']
+                (config, email) = (dict(bfd_int_sync.CONFIG),
+                                   dict(bfd_int_sync.EMAIL))
+
+                # Fails on the telemetry port, after alert_holddown and
+                # the telemetry hostname were parsed
+                write_config(tmpdir, General={'alert_holddown': '99'},
+                             telemetry={'port': 'none'},
+                             email={'enabled': 'no'})
+                self.assertEqual(bfd_int_sync.reload_config(ini), [])
+                self.assertEqual(bfd_int_sync.CONFIG, config)
+                self.assertEqual(bfd_int_sync.EMAIL, email)
+
+                write_config(tmpdir, General={'alert_holddown': '99'},
+                             email={'enabled': 'no'})
+                self.assertIn('alert_holddown',
+                              bfd_int_sync.reload_config(ini))
+                self.assertEqual(bfd_int_sync.CONFIG['alert_holddown'], 99)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('syslog.syslog')
+    def test_reload_removed_sections(self, mock_syslog):
+        """Verify settings whose section was removed from the file are
+        dropped on reload, so nothing is pushed to a removed peer
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with patch.dict(bfd_int_sync.CONFIG, clear=True), \
+                    patch.dict(bfd_int_sync.EMAIL, clear=True), \
+                    patch('sys.stdout', StringIO()):
+                ini = write_config(tmpdir, email={'enabled': 'no'})
+                bfd_int_sync.reload_config(ini)
+                self.assertIn('peer', bfd_int_sync.dispatch_config(
+                    MagicMock(), MagicMock()))
+
+                write_config(tmpdir, peer_eapi=None, telemetry=None,
+                             email={'enabled': 'no'})
+                changes = bfd_int_sync.reload_config(ini)
+                self.assertIn('peer_url', changes)
+                self.assertIn('peer_fail_config', changes)
+                for key in ('peer_url', 'peer_fail_config',
+                            'telemetry_hostname', 'telemetry_port'):
+                    self.assertNotIn(key, bfd_int_sync.CONFIG)
+                self.assertFalse(bfd_int_sync.CONFIG['telemetry_enabled'])
+                self.assertNotIn('peer', bfd_int_sync.dispatch_config(
+                    MagicMock(), None))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_watcher_use_switch(self):
+        """Verify a new eAPI session reaches the BFD peer poller"""
+        (old, new) = (MagicMock(), MagicMock())
+        watcher = BfdWatcher(old, ['Ethernet2'], MagicMock(), sources=[])
+        watcher.poller = BfdPeerPoller(old, ['192.0.3.1'])
+        watcher.use_switch(new)
+        self.assertIs(watcher.switch, new)
+        self.assertIs(watcher.poller.switch, new)
+
+    @patch('syslog.syslog')
+    def test_watcher_path_sets(self, mock_syslog):
+        """Verify a BFD failure pushes the fail_config of the failed path
+        when it has its own config sets
+        """
+        switch = MagicMock()
+        switch.runCmds.side_effect = show_cmds
+        dispatcher = MagicMock()
+        commands = {'eapi': {'fail_config': ['interface Ethernet3',
+                                             'shutdown']},
+                    'peer': {}}
+        paths = [{'name': 'a', 'interface': 'Ethernet2', 'commands': None},
+                 {'name': 'b', 'interface': 'Ethernet3',
+                  'commands': commands}]
+        watcher = BfdWatcher(switch, ['Ethernet2', 'Ethernet3'], dispatcher,
+                             sources=[], paths=paths)
+        watcher.step(now=0)
+        watcher._on_event({'type': 'bfd', 'peer': '192.0.4.1',
+                           'status': 'down', 'previous': 'up'})
+        watcher.step(now=1)
+        self.assertEqual(watcher.failed, ('192.0.4.1', 'Ethernet3'))
+        dispatcher.apply.assert_called_with('fail_config', path='b',
+                                            commands=commands)
+
+    @patch('syslog.syslog')
+    def test_watcher_reload_interfaces(self, mock_syslog):
+        """Verify a reloaded interface list re-resolves the BFD peers
+        without pushing ok_config again, and an unchanged one is a no-op
+        """
+        switch = MagicMock()
+        switch.runCmds.side_effect = show_cmds
+        dispatcher = MagicMock()
+        watcher = BfdWatcher(switch, ['Ethernet2'], dispatcher, sources=[])
+        watcher.step(now=0)
+        self.assertEqual(watcher.peers, ['192.0.3.1'])
+
+        dispatcher.reset_mock()
+        self.assertFalse(watcher.watch(['Ethernet2']))
+        self.assertEqual(watcher.state, 'watching')
+        self.assertTrue(watcher.watch(['Ethernet2', 'Ethernet3']))
+        self.assertEqual(watcher.peers, [None, None])
+        watcher.step(now=1)
+        self.assertEqual(watcher.state, 'watching')
+        self.assertEqual(watcher.peers, ['192.0.3.1', '192.0.4.1'])
+        self.assertFalse(dispatcher.apply.called)
+
+        # Paths added with SIGHUP fail on BFD like the original ones
+        watcher._on_event({'type': 'bfd', 'peer': '192.0.4.1',
+                           'status': 'down', 'previous': 'up'})
+        watcher.step(now=2)
+        self.assertEqual(watcher.failed, ('192.0.4.1', 'Ethernet3'))
+
+if __name__ == '__main__':
+    unittest.main(module=__name__, buffer=True, exit=False)
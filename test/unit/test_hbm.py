@@ -1,7 +1,14 @@
 import sys
 import os
+import json
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
-from mock import patch
+from mock import patch, MagicMock
 import jsonrpclib
 # from pprint import pprint
 from StringIO import StringIO
@@ -11,7 +18,16 @@ from contextlib import contextmanager
 sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
 sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
 
-from hbm import log, conf_string_to_list, run_cmds, intfStatus  # noqa
+from hbm import log, conf_string_to_list, intfStatus, wait_for_eapi, \
+    startup, parse_config, load_config, build_devices, \
+    reload_config, record_signal, CachedServer, Dispatcher, AlertQueue, \
+    DecisionEngine, Heartbeat, Status, RttBaseline, BaselineStore, \
+    configure_device, P2Quantile, RttQuantiles, read_approvals, \
+    config_changes, REQUIRED_CONFIG  # noqa
+from ibypass_common import run_cmds, LatencyHistogram, PhaseTimings, \
+    Profiler  # noqa
+
+INI = os.path.join(os.path.dirname(__file__), '../../bfd_int_sync.ini')
 
 EMAIL = {}
 
@@ -148,7 +164,648 @@ class TestHbm(unittest.TestCase):
             mock.return_value = response
 
             output = run_cmds(eapi_obj, ['show version'])
-            self.assertEquals(None, output)
+            self.assertTrue(output)
+
+    @patch('syslog.syslog')
+    @patch('time.sleep')
+    def test_wait_for_eapi_backoff(self, mock_sleep, mock_syslog):
+        """Verify wait_for_eapi() retries with exponential backoff
+        """
+        eapi_obj = MagicMock()
+        eapi_obj.runCmds.side_effect = [socket.error, socket.error,
+                                        socket.error, [{}]]
+        wait_for_eapi(eapi_obj)
+        self.assertEqual(eapi_obj.runCmds.call_count, 4)
+        delays = [args[0] for args, _ in mock_sleep.call_args_list]
+        self.assertEqual(delays, [0.1, 0.2, 0.4])
+
+    @patch('syslog.syslog')
+    def test_wait_for_eapi_deadline(self, mock_syslog):
+        """Verify wait_for_eapi() gives up once the deadline passes
+        """
+        eapi_obj = MagicMock()
+        eapi_obj.runCmds.side_effect = socket.error
+        self.assertRaises(socket.error, wait_for_eapi, eapi_obj,
+                          deadline=time.time() + 0.2)
+
+    @patch('syslog.syslog')
+    @patch('hbm.get_peer_addr')
+    def test_startup_concurrent(self, mock_get_peer_addr, mock_syslog):
+        """Verify startup() overlaps peer eAPI and address discovery
+        """
+        def slow(*args):
+            time.sleep(0.2)
+            return '192.0.2.2'
+
+        local = MagicMock()
+        peer = MagicMock()
+        peer.runCmds.side_effect = slow
+        mock_get_peer_addr.side_effect = slow
+        config = {'eapi': {'switch': local},
+                  'peer': {'switch': peer},
+                  'paths': [{'interface': 'Ethernet1',
+                             'probe_dst_address': ''},
+                            {'interface': 'Ethernet2',
+                             'probe_dst_address': '192.0.2.6'}]}
+
+        timings = startup(config)
+        self.assertEqual(config['paths'][0]['probe_dst_address'],
+                         '192.0.2.2')
+        self.assertEqual(config['paths'][1]['probe_dst_address'],
+                         '192.0.2.6')
+        self.assertEqual(config['discovered'], {'Ethernet1': '192.0.2.2'})
+        self.assertEqual(mock_get_peer_addr.call_count, 1)
+        self.assertIn('peer eAPI', timings)
+        self.assertIn('address Ethernet1', timings)
+        self.assertLess(timings['total'], 0.35)
+
+    @patch('syslog.syslog')
+    def test_startup_failure(self, mock_syslog):
+        """Verify startup() reports the phase which missed the deadline
+        """
+        local = MagicMock()
+        local.runCmds.side_effect = socket.error
+        config = {'eapi': {'switch': local},
+                  'paths': [{'interface': 'Ethernet1',
+                             'probe_dst_address': ''}]}
+        self.assertRaises(RuntimeError, startup, config,
+                          deadline=time.time() + 0.1)
+
+    @patch('syslog.syslog')
+    def test_load_config_cache(self, mock_syslog):
+        """Verify the compiled config cache is used until the INI changes
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ini = os.path.join(tmpdir, 'hbm.ini')
+            cache = ini + '.hbm.cache'
+            shutil.copy(INI, ini)
+
+            (config, source, _) = load_config(ini, parse_config, cache,
+                                              REQUIRED_CONFIG)
+            self.assertEqual(source, 'parsed')
+            self.assertTrue(os.path.exists(cache))
+
+            (cached, source, _) = load_config(ini, parse_config, cache,
+                                              REQUIRED_CONFIG)
+            self.assertEqual(source, 'cache')
+            self.assertEqual(cached, config)
+
+            # Touched but unchanged contents are still a hit
+            os.utime(ini, (0, 0))
+            (cached, source, _) = load_config(ini, parse_config, cache,
+                                              REQUIRED_CONFIG)
+            self.assertEqual(source, 'cache')
+
+            with open(ini, 'a') as fileh:
+                fileh.write('\n[General]\ninterval = 7\n')
+            (config, source, _) = load_config(ini, parse_config, cache,
+                                              REQUIRED_CONFIG)
+            self.assertEqual(source, 'parsed')
+            self.assertEqual(config['interval'], 7)
+
+            # A corrupt or incomplete cache is ignored
+            with open(cache, 'wb') as fileh:
+                fileh.write('garbage')
+            (_, source, _) = load_config(ini, parse_config, cache,
+                                         REQUIRED_CONFIG)
+            self.assertEqual(source, 'parsed')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('syslog.syslog')
+    @patch('hbm.get_peer_addr')
+    def test_reload_config(self, mock_get_peer_addr, mock_syslog):
+        """Verify a reload updates running Heartbeats in place
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ini = os.path.join(tmpdir, 'hbm.ini')
+            shutil.copy(INI, ini)
+            config = parse_config(ini)
+            local = MagicMock()
+            config['eapi']['switch'] = local
+            config['peer']['switch'] = MagicMock()
+            config['paths'][0]['probe_dst_address'] = '192.0.3.1'
+            config['paths'][1]['probe_dst_address'] = '192.0.4.1'
+            config['discovered'] = {'Ethernet2': '192.0.3.1',
+                                    'Ethernet3': '192.0.4.1'}
+            devices = build_devices(config)
+            devices[0].good_count = 2
+
+            with open(INI) as fileh:
+                text = fileh.read()
+            text = text.replace('alert_threshold = 13', 'alert_threshold = 10')
+            with open(ini, 'w') as fileh:
+                fileh.write(text)
+            (new, reloaded) = reload_config(ini, config, devices)
+            self.assertIs(reloaded[0], devices[0])
+            self.assertIs(reloaded[1], devices[1])
+            self.assertEqual(reloaded[0].warn_threshold, 10)
+            self.assertEqual(reloaded[0].good_count, 2)
+            self.assertIs(new['eapi']['switch'], local)
+            self.assertEqual(new['paths'][0]['probe_dst_address'],
+                             '192.0.3.1')
+            mock_get_peer_addr.assert_not_called()
+
+            mock_get_peer_addr.return_value = '192.0.5.1'
+            with open(ini, 'w') as fileh:
+                fileh.write(text.replace('interface2 = Ethernet3',
+                                         'interface2 = Ethernet5'))
+            (new, reloaded) = reload_config(ini, new, reloaded)
+            self.assertIs(reloaded[0], devices[0])
+            self.assertEqual(reloaded[1].interface, 'Ethernet5')
+            self.assertEqual(reloaded[1].probe_dst_address, '192.0.5.1')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('syslog.syslog')
+    def test_parse_paths(self, mock_syslog):
+        """Verify [path:<name>] sections replace interface1/interface2
+        """
+        config = parse_config(INI)
+        self.assertEqual([(path['name'], path['commands']) for path in
+                          config['paths']],
+                         [('Ethernet2', None), ('Ethernet3', None)])
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ini = os.path.join(tmpdir, 'hbm.ini')
+            with open(INI) as fileh:
+                text = fileh.read()
+            sections = ['[path:a]\ninterface = Ethernet5\n'
+                        'alert_threshold = 2\n'
+                        'fail_config = shutdown a\n'
+                        'peer_fail_config = peer shutdown a\n',
+                        '[path:b]\ninterface = Ethernet6\n'
+                        'probe_dst_address = 192.0.6.1\n']
+            for index in range(2, 40):
+                sections.append('[path:p{0}]\ninterface = Ethernet{0}/1\n'
+                                .format(index))
+            with open(ini, 'w') as fileh:
+                fileh.write(text + '\n' + '\n'.join(sections))
+            config = parse_config(ini)
+            paths = dict((path['name'], path) for path in config['paths'])
+            self.assertEqual(len(paths), 40)
+            self.assertEqual((paths['a']['alert_threshold'],
+                              paths['a']['failure_threshold']), (2, 15))
+            self.assertEqual(paths['a']['commands']['eapi']['fail_config'],
+                             ['shutdown a'])
+            self.assertEqual(paths['a']['commands']['peer']['fail_config'],
+                             ['peer shutdown a'])
+            self.assertEqual(paths['a']['commands']['eapi']['ok_config'],
+                             config['eapi']['ok_config'])
+            self.assertEqual((paths['b']['probe_dst_address'],
+                              paths['b']['commands']), ('192.0.6.1', None))
+            self.assertEqual(paths['p7']['probe_dst_address'], '')
+
+            # One table, dispatcher and engine for every path
+            devices = build_devices(config)
+            self.assertEqual(len(devices), 40)
+            self.assertEqual(len(set(id(device.table) for device in
+                                     devices)), 1)
+            self.assertEqual(len(set(id(device.dispatcher) for device in
+                                     devices)), 1)
+            self.assertIs(devices[0].commands, paths['a']['commands'])
+            self.assertEqual((devices[0].name, devices[0].warn_threshold),
+                             ('a', 2))
+
+            changed = parse_config(ini)
+            changed['paths'][1]['alert_threshold'] = 9
+            self.assertEqual(config_changes(config, changed), ['path:b'])
+
+            with open(ini, 'a') as fileh:
+                fileh.write('\n[path:c]\ninterface = Ethernet5\n')
+            self.assertRaises(IOError, parse_config, ini)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('syslog.syslog')
+    def test_reload_config_invalid(self, mock_syslog):
+        """Verify a failed reload keeps the running config
+        """
+        config = {'interval': 5}
+        devices = []
+        with stdout_redirector(StringIO()):
+            result = reload_config('/nonexistent/hbm.ini', config, devices)
+        self.assertIs(result[0], config)
+        self.assertIs(result[1], devices)
+
+    def test_cached_server(self):
+        """Verify show commands are cached and config pushes invalidate
+        """
+        server = MagicMock()
+        server.runCmds.side_effect = lambda version, cmds: [{'cmds': cmds}]
+        switch = CachedServer(server, max_entries=2)
+
+        first = switch.runCmds(1, ['show ip interface Ethernet1'])
+        first[0]['cmds'] = None
+        second = switch.runCmds(1, ['show ip interface Ethernet1'])
+        self.assertEqual(second, [{'cmds': ['show ip interface Ethernet1']}])
+        second[0]['cmds'] = None
+        self.assertEqual(switch.runCmds(1, ['show ip interface Ethernet1']),
+                         [{'cmds': ['show ip interface Ethernet1']}])
+        self.assertEqual(server.runCmds.call_count, 1)
+        self.assertEqual((switch.hits, switch.misses), (2, 1))
+
+        # enable is a liveness check and is never cached
+        switch.runCmds(1, ['enable'])
+        switch.runCmds(1, ['show ip interface Ethernet1'])
+        self.assertEqual(server.runCmds.call_count, 3)
+
+        # Config pushes clear the cache
+        switch.runCmds(1, ['enable', 'configure', 'interface Ethernet1'])
+        switch.runCmds(1, ['show ip interface Ethernet1'])
+        self.assertEqual(server.runCmds.call_count, 5)
+
+    def test_cached_server_concurrency(self):
+        """Verify cached answers are not held up by a request in flight,
+        and a response fetched across a config push is not cached
+        """
+        server = MagicMock()
+        (started, release) = (threading.Event(), threading.Event())
+
+        def run_cmds(version, cmds):
+            if cmds == ['show interfaces Ethernet2']:
+                started.set()
+                release.wait(5)
+            return [{'cmds': cmds}]
+        server.runCmds.side_effect = run_cmds
+        switch = CachedServer(server)
+        switch.runCmds(1, ['show ip interface Ethernet1'])
+
+        thread = threading.Thread(target=switch.runCmds,
+                                  args=(1, ['show interfaces Ethernet2']))
+        thread.start()
+        self.assertTrue(started.wait(5))
+        self.assertEqual(switch.runCmds(1, ['show ip interface Ethernet1']),
+                         [{'cmds': ['show ip interface Ethernet1']}])
+        switch.invalidate()
+        release.set()
+        thread.join(5)
+
+        switch.runCmds(1, ['show interfaces Ethernet2'])
+        self.assertEqual(server.runCmds.call_count, 3)
+
+    def test_cached_server_expiry(self):
+        """Verify cached responses expire and the LRU entry is evicted
+        """
+        server = MagicMock()
+        switch = CachedServer(server, max_entries=2,
+                              ttl={'show ip interface': 60,
+                                   'show ip interface Ethernet9': 0})
+        with patch('time.time') as mock_time:
+            mock_time.return_value = 1000.0
+            switch.runCmds(1, ['show ip interface Ethernet1'])
+            switch.runCmds(1, ['show ip interface Ethernet2'])
+            switch.runCmds(1, ['show ip interface Ethernet1'])
+            self.assertEqual(server.runCmds.call_count, 2)
+
+            # Ethernet2 is least recently used and gets evicted
+            switch.runCmds(1, ['show ip interface Ethernet3'])
+            switch.runCmds(1, ['show ip interface Ethernet1'])
+            self.assertEqual(server.runCmds.call_count, 3)
+            switch.runCmds(1, ['show ip interface Ethernet2'])
+            self.assertEqual(server.runCmds.call_count, 4)
+
+            # The longest matching prefix sets the TTL
+            switch.runCmds(1, ['show ip interface Ethernet9'])
+            switch.runCmds(1, ['show ip interface Ethernet9'])
+            self.assertEqual(server.runCmds.call_count, 6)
+
+            mock_time.return_value = 1061.0
+            switch.runCmds(1, ['show ip interface Ethernet2'])
+            self.assertEqual(server.runCmds.call_count, 7)
+
+    @patch('syslog.syslog')
+    def test_dispatcher(self, mock_syslog):
+        """Verify a config set already in effect is not pushed again
+        """
+        local = MagicMock()
+        peer = MagicMock()
+        dispatcher = Dispatcher({
+            'eapi': {'switch': local, 'ok_config': ['ok'],
+                     'fail_config': ['fail']},
+            'peer': {'switch': peer, 'ok_config': ['peer ok'],
+                     'fail_config': []}})
+        self.assertTrue(dispatcher.apply('ok_config'))
+        self.assertFalse(dispatcher.apply('ok_config'))
+        self.assertTrue(dispatcher.apply('fail_config'))
+        self.assertFalse(dispatcher.apply('fail_config'))
+        self.assertTrue(dispatcher.apply('fail_config', force=True))
+        self.assertEqual(local.runCmds.call_count, 3)
+        peer.runCmds.assert_called_once_with(1, ['peer ok'])
+        self.assertEqual((dispatcher.pushes, dispatcher.skipped), (3, 2))
+
+    @patch('syslog.syslog')
+    def test_dispatcher_retry(self, mock_syslog):
+        """Verify a config set a switch rejected is pushed again on the
+        next attempt
+        """
+        local = MagicMock()
+        local.runCmds.side_effect = [
+            jsonrpclib.jsonrpc.ProtocolError((1002, 'rejected')), None]
+        dispatcher = Dispatcher({
+            'eapi': {'switch': local, 'fail_config': ['fail']}})
+        with patch('jsonrpclib.history') as mock_history, \
+                stdout_redirector(StringIO()):
+            mock_history.request = json.dumps({'params': [1, ['fail']]})
+            self.assertFalse(dispatcher.apply('fail_config'))
+        self.assertEqual(dispatcher.applied, {})
+        self.assertEqual(dispatcher.pushes, 0)
+        self.assertTrue(dispatcher.apply('fail_config'))
+        self.assertEqual(dispatcher.applied, {None: 'fail_config'})
+        self.assertEqual(local.runCmds.call_count, 2)
+        self.assertFalse(dispatcher.apply('fail_config'))
+
+    @patch('syslog.syslog')
+    def test_dispatcher_paths(self, mock_syslog):
+        """Verify a path's own config sets use the shared switches and are
+        tracked apart from the shared sets
+        """
+        local = MagicMock()
+        dispatcher = Dispatcher({
+            'eapi': {'switch': local, 'fail_config': ['fail']}})
+        commands = {'eapi': {'fail_config': ['fail a']}, 'peer': {}}
+        self.assertTrue(dispatcher.apply('fail_config'))
+        self.assertTrue(dispatcher.apply('fail_config', path='a',
+                                         commands=commands))
+        self.assertFalse(dispatcher.apply('fail_config', path='a',
+                                          commands=commands))
+        self.assertTrue(dispatcher.apply('fail_config', path='b',
+                                         commands=commands))
+        # Paths without their own sets share them
+        self.assertFalse(dispatcher.apply('fail_config', path='c'))
+        self.assertEqual([args[0][1] for args in
+                          local.runCmds.call_args_list],
+                         [['fail'], ['fail a'], ['fail a']])
+
+    def test_alert_queue(self):
+        """Verify queued alerts are delivered in order by the worker
+        """
+        mailer = MagicMock()
+        mailer.config = {'enabled': True}
+        alerts = AlertQueue(mailer).start()
+        self.assertTrue(alerts.config['enabled'])
+        alerts.send('first', subject='one')
+        alerts.send('second')
+        alerts.stop()
+        self.assertEqual([args for args in mailer.send.call_args_list],
+                         [(('first',), {'subject': 'one'}),
+                          (('second',), {'subject': ''})])
+
+    @patch('syslog.syslog')
+    def test_decision_engine(self, mock_syslog):
+        """Verify signals are weighted into a per-path score
+        """
+        engine = DecisionEngine(threshold=1.0)
+        failures = []
+        engine.add_callback(failures.append)
+
+        engine.record('Ethernet2', 'rtt', 1.0)
+        self.assertEqual(engine.score('Ethernet2'), 0.5)
+        self.assertTrue(engine.degraded('Ethernet2'))
+        self.assertIsNone(engine.failed('Ethernet2'))
+        self.assertFalse(engine.degraded('Ethernet3'))
+
+        # Degraded heartbeats bring a failure forward
+        engine.record('Ethernet2', 'probe', 2.0 / 3)
+        self.assertEqual(engine.failed('Ethernet2'), ['probe', 'rtt'])
+        self.assertEqual(failures, ['Ethernet2'])
+
+        # A BFD Down alone fails the path, and callbacks fire on edges only
+        engine.record('Ethernet3', 'bfd', True, source='poll')
+        engine.record('Ethernet3', 'bfd', True, source='log')
+        self.assertEqual(engine.failed('Ethernet3'), ['bfd'])
+        self.assertEqual(failures, ['Ethernet2', 'Ethernet3'])
+        engine.record('Ethernet3', 'bfd', False)
+        self.assertIsNone(engine.failed('Ethernet3'))
+
+        # A zero weight ignores a signal
+        engine.weights['bfd'] = 0
+        engine.record('Ethernet3', 'bfd', True)
+        self.assertIsNone(engine.failed('Ethernet3'))
+
+    @patch('syslog.syslog')
+    @patch('hbm.Heartbeat.on_fail')
+    @patch('hbm.Heartbeat.on_up')
+    def test_bfd_short_circuits_heartbeats(self, mock_on_up, mock_on_fail,
+                                           mock_syslog):
+        """Verify a BFD Down fails an up path without waiting for
+        max_fail_count heartbeat failures
+        """
+        device = Heartbeat('192.0.3.1', interface='Ethernet2')
+        device.engine = DecisionEngine()
+        device.good_count = 3
+        status = Status()
+        status.runAll([device])
+        self.assertEqual(device.state, 'up')
+
+        record_signal(device, {'type': 'bfd', 'peer': '192.0.3.1',
+                               'status': 'down'})
+        self.assertEqual(device.failing(), 'failed on bfd (score 1.00)')
+        status.runAll([device])
+        self.assertEqual(device.state, 'failed')
+        self.assertEqual(device.fail_count, 0)
+        mock_on_fail.assert_called()
+
+    def test_rtt_baseline(self):
+        """Verify thresholds follow the learned RTT within floor and ceiling
+        """
+        baseline = RttBaseline(alpha=0.1)
+        for _ in range(RttBaseline.MIN_SAMPLES - 1):
+            baseline.update(5.0)
+        self.assertEqual(baseline.thresholds(13, 15), (13, 15))
+        baseline.update(5.0)
+        self.assertAlmostEqual(baseline.mean, 5.0)
+        # A steady path still allows some variation
+        (warn, fail) = baseline.thresholds(13, 15)
+        self.assertAlmostEqual(warn, 6.5)
+        self.assertAlmostEqual(fail, 8.0)
+
+        # A fast path is held at the floors
+        fast = RttBaseline()
+        for _ in range(RttBaseline.MIN_SAMPLES):
+            fast.update(0.2)
+        self.assertEqual(fast.thresholds(13, 15), (2.0, 4.0))
+
+        for index in range(500):
+            baseline.update(4.0 + (index % 3))
+        (warn, fail) = baseline.thresholds(13, 15)
+        self.assertAlmostEqual(baseline.mean, 5.0, places=0)
+        self.assertTrue(5.0 < warn < fail < 15)
+
+        # A slow path is capped at the fixed thresholds
+        for _ in range(500):
+            baseline.update(40.0)
+        self.assertEqual(baseline.thresholds(13, 15), (13, 15))
+
+    def test_p2_quantile(self):
+        """Verify P2 estimates converge on the true quantiles
+        """
+        rand = random.Random(1)
+        samples = [rand.uniform(0, 100) for _ in range(5000)]
+        for p in (0.5, 0.95, 0.99):
+            sketch = P2Quantile(p)
+            for sample in samples:
+                sketch.add(sample)
+            exact = sorted(samples)[int(p * (len(samples) - 1))]
+            self.assertAlmostEqual(sketch.value(), exact, delta=2)
+            self.assertEqual(len(sketch.heights), 5)
+
+        sketch = P2Quantile(0.5)
+        self.assertIsNone(sketch.value())
+        for sample in (3, 1, 2):
+            sketch.add(sample)
+        self.assertEqual(sketch.value(), 2)
+
+    @patch('syslog.syslog')
+    @patch('hbm.check_path')
+    def test_quantile_thresholds(self, mock_check_path, mock_syslog):
+        """Verify thresholds can apply to tail latency over a window
+        """
+        device = Heartbeat('192.0.3.1', interface='Ethernet2')
+        (device.warn_threshold, device.fail_threshold) = (10, 20)
+        device.warn_statistic = 'p95'
+        device.rtt_quantiles = RttQuantiles(window=300)
+
+        # One slow heartbeat in five lifts p95 over the warn threshold
+        # though most heartbeats are well under it
+        for index in range(100):
+            rtt = 15.0 if index % 5 == 4 else 2.0
+            mock_check_path.return_value = (0, rtt, rtt, rtt, 0)
+            device.do_health_check()
+        self.assertGreater(device.rtt_quantiles.get('p95'), 10)
+        self.assertGreater(device.warn_count, 0)
+        self.assertEqual(device.fail_count, 0)
+
+        # The previous window is used until the new one has samples
+        quantiles = RttQuantiles(window=10)
+        for index in range(20):
+            quantiles.add(float(index), now=index * 0.5)
+        quantiles.add(100.0, now=11)
+        self.assertLess(quantiles.get('p50'), 100)
+        for index in range(10):
+            quantiles.add(100.0, now=12 + index)
+        self.assertEqual(quantiles.get('p50'), 100)
+
+    def test_latency_histogram(self):
+        """Verify durations are counted in fixed buckets
+        """
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.summary(), 'n 0')
+        for ms in [0.05] * 50 + [3] * 48 + [40, 20000]:
+            histogram.add(ms / 1000.0)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.percentile(50), 0.1)
+        self.assertEqual(histogram.percentile(51), 5)
+        self.assertEqual(histogram.percentile(99), 50)
+        self.assertEqual(histogram.percentile(100), 20000)
+        self.assertEqual(histogram.max, 20000)
+        self.assertEqual(len(histogram.counts), len(histogram.BOUNDS) + 1)
+        self.assertEqual(histogram.counts[-1], 1)
+
+    @patch('syslog.syslog')
+    @patch('hbm.check_path')
+    def test_phase_timings(self, mock_check_path, mock_syslog):
+        """Verify each health check times the probe and the statistics
+        """
+        timings = PhaseTimings()
+        mock_check_path.return_value = (0, 2.0, 2.0, 2.0, 0)
+        device = Heartbeat('192.0.3.1', interface='Ethernet2')
+        with patch('ibypass_common.TIMINGS', timings):
+            for _ in range(3):
+                device.do_health_check()
+            log('timed')
+        self.assertEqual(timings.phases['probe'].count, 3)
+        self.assertEqual(timings.phases['stats'].count, 3)
+        self.assertEqual(timings.phases['syslog'].count,
+                         mock_syslog.call_count)
+        summary = timings.summary()
+        self.assertTrue(summary[0].startswith('probe: n 3 mean '))
+
+    @patch('syslog.syslog')
+    def test_profiler(self, mock_syslog):
+        """Verify a requested profile covers one window and is written out
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            profiler = Profiler('hbm', seconds=10, directory=tmpdir)
+            profiler.tick(now=100)
+            self.assertFalse(profiler.active)
+            profiler.request()
+            profiler.tick(now=100)
+            self.assertTrue(profiler.active)
+            conf_string_to_list('a, b')
+            profiler.tick(now=109)
+            self.assertTrue(profiler.active)
+            profiler.tick(now=110)
+            self.assertFalse(profiler.active)
+            files = sorted(os.listdir(tmpdir))
+            self.assertEqual([name.rsplit('.', 1)[1] for name in files],
+                             ['prof', 'txt'])
+            with open(os.path.join(tmpdir, files[1])) as fileh:
+                self.assertIn('conf_string_to_list', fileh.read())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('syslog.syslog')
+    def test_baseline_store(self, mock_syslog):
+        """Verify baselines survive a restart
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'hbm.baseline')
+            config = {'eapi': {}, 'peer': {}, 'timeout': 1,
+                      'alert_threshold': 13, 'failure_threshold': 15,
+                      'alert_holddown': 0, 'probe_window': 5,
+                      'failed_probe_interval': 30, 'recovery': 'auto',
+                      'interface1': 'Ethernet2', 'interface2': 'Ethernet3',
+                      'adaptive': {'enabled': True, 'alpha': 0.05,
+                                   'warn_deviation': 3, 'fail_deviation': 6,
+                                   'warn_floor': 2, 'fail_floor': 4}}
+            device = Heartbeat('192.0.3.1', interface='Ethernet2')
+            configure_device(device, config)
+            store = BaselineStore(filename).load()
+            self.assertFalse(store.save([device]))
+            for _ in range(30):
+                device.baseline.update(7.5)
+            self.assertTrue(store.save([device], now=0))
+            self.assertFalse(store.save([device], now=1))
+
+            restarted = Heartbeat('192.0.3.1', interface='Ethernet2')
+            configure_device(restarted, config)
+            BaselineStore(filename).load().restore([restarted])
+            self.assertEqual(restarted.baseline.samples, 30)
+            self.assertAlmostEqual(restarted.baseline.mean, 7.5)
+            (warn, fail) = restarted.thresholds()
+            self.assertAlmostEqual(warn, 7.5 + 3 * 0.75)
+            self.assertAlmostEqual(fail, 7.5 + 6 * 0.75)
+
+            config['adaptive'] = {'enabled': False}
+            configure_device(restarted, config)
+            self.assertEqual(restarted.thresholds(), (13, 15))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('syslog.syslog')
+    def test_read_approvals(self, mock_syslog):
+        """Verify listed paths are approved and the file is consumed
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'hbm.approve')
+            devices = [MagicMock(interface='Ethernet2'),
+                       MagicMock(interface='Ethernet3')]
+            read_approvals(filename, devices)
+            with open(filename, 'w') as fileh:
+                fileh.write('Ethernet3\n')
+            read_approvals(filename, devices)
+            self.assertFalse(devices[0].approve.called)
+            devices[1].approve.assert_called_once_with()
+            self.assertFalse(os.path.exists(filename))
+        finally:
+            shutil.rmtree(tmpdir)
 
     @patch('syslog.syslog')
     def test_log(self, mock_syslog):
@@ -0,0 +1,414 @@
+"""Validate heartbeat recording and hbm_history.py
+"""
+
+import csv
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from mock import patch, MagicMock
+from StringIO import StringIO
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+from hbm import Heartbeat, PathTable, BatchEvaluator, RttRecorder, \
+    Dispatcher, parse_config, build_devices  # noqa
+from ibypass_common import EventJournal  # noqa
+from bfd_int_sync import BfdWatcher  # noqa
+import ibypass_common  # noqa
+from hbm_history import parse_time, history, events, export, simulate, \
+    analyze, load_ring, parse_fault, synthetic_trace, replay, main  # noqa
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+INI = os.path.join(os.path.dirname(__file__), '../../bfd_int_sync.ini')
+
+
+class TestRttRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'Ethernet1.rtt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_ring(self):
+        """Verify the ring keeps the newest records, oldest first, and
+        survives being reopened
+        """
+        recorder = RttRecorder(self.filename, capacity=4)
+        for index in range(6):
+            recorder.record(1000 + index, None if index == 3 else index,
+                            1 if index == 3 else 0, PathTable.UP)
+        # The oldest record of a full ring may be being overwritten
+        records = RttRecorder.read(self.filename)
+        self.assertEqual([record[0] for record in records],
+                         [1003, 1004, 1005])
+        self.assertTrue(math.isnan(records[0][1]))
+        self.assertEqual(records[0][2:], (1, PathTable.UP))
+        self.assertEqual([record[0] for record in
+                          RttRecorder.read(self.filename, 1003, 1004)],
+                         [1003, 1004])
+        recorder.close()
+
+        recorder = RttRecorder(self.filename, capacity=4)
+        self.assertEqual(recorder.written, 6)
+        recorder.record(1006, 2.0, 0, PathTable.WARN)
+        self.assertEqual(RttRecorder.read(self.filename)[-1],
+                         (1006, 2.0, 0, PathTable.WARN))
+        recorder.close()
+
+        # A different capacity starts again
+        recorder = RttRecorder(self.filename, capacity=8)
+        self.assertEqual(RttRecorder.read(self.filename), [])
+        recorder.close()
+
+    @patch('syslog.syslog')
+    def test_evaluate(self, mock_syslog):
+        """Verify every heartbeat is recorded, evaluated one at a time or
+        in a batch
+        """
+        table = PathTable()
+        devices = [Heartbeat('192.0.2.{}'.format(index),
+                             interface='Ethernet{}'.format(index),
+                             table=table) for index in (1, 2)]
+        for device in devices:
+            device.recorder = RttRecorder(os.path.join(
+                self.tmpdir, '{}.rtt'.format(device.interface)))
+        devices[0].evaluate(0, 1.5)
+        devices[0].evaluate(1, None)
+        for vectorize in (False, True):
+            evaluator = BatchEvaluator(table, vectorize=vectorize)
+            evaluator.record([0, 1], [0, 0], [2.5, 9.0])
+        self.assertEqual([record[1:3] for record in RttRecorder.read(
+            devices[0].recorder.filename)][0::2], [(1.5, 0), (2.5, 0)])
+        self.assertEqual([record[1] for record in RttRecorder.read(
+            devices[1].recorder.filename)], [9.0, 9.0])
+        for device in devices:
+            device.recorder.close()
+
+    @patch('syslog.syslog')
+    def test_build_devices(self, mock_syslog):
+        """Verify the [recording] section opens a ring file per path"""
+        CONFIG = parse_config(INI)
+        CONFIG['recording'] = {'enabled': True, 'records': 10,
+                               'directory': os.path.join(self.tmpdir, 'rec')}
+        devices = build_devices(CONFIG)
+        self.assertEqual(sorted(os.listdir(CONFIG['recording']['directory'])),
+                         sorted(set('{}.rtt'.format(device.name)
+                                    for device in devices)))
+        CONFIG['recording'] = {'enabled': False}
+        devices = build_devices(CONFIG, devices)
+        self.assertEqual([device.recorder for device in devices],
+                         [None] * len(devices))
+
+
+class TestEventJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'hbm.jnl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch.object(EventJournal, 'BLOCK', 4)
+    def test_query(self):
+        """Verify queries by time and path read only the indexed blocks
+        which can match, and survive a torn record and a lost index
+        """
+        journal = EventJournal(self.filename)
+        for index in range(10):
+            journal.transition('segment-{}'.format('ab'[index % 2]),
+                               PathTable.UP, PathTable.FAILED,
+                               'reached max_fail_count', now=1000 + index)
+        journal.push('segment-a', 'fail_config', True, now=1010)
+        journal.close()
+        self.assertEqual(os.path.getsize(self.filename + '.idx'),
+                         3 * EventJournal.INDEX.size)
+
+        records = EventJournal.query(self.filename, 1003, 1005)
+        self.assertEqual([record[0] for record in records],
+                         [1003, 1004, 1005])
+        self.assertEqual(records[0][1:],
+                         (EventJournal.TRANSITION, PathTable.UP,
+                          PathTable.FAILED, 0, 'segment-b',
+                          'reached max_fail_count'))
+        self.assertEqual([record[0] for record in EventJournal.query(
+            self.filename, path='segment-a')],
+            [1000, 1002, 1004, 1006, 1008, 1010])
+
+        # The first block's entry rules it out, so it is not read
+        with open(self.filename, 'r+b') as fileh:
+            fileh.seek(EventJournal.HEADER.size)
+            fileh.write(EventJournal.RECORD.pack(1005, 1, 0, 0, 0,
+                                                 'segment-a', ''))
+        self.assertEqual(len(EventJournal.query(self.filename, 1005, 1005)),
+                         1)
+
+        # A torn record is dropped and a missing index rebuilt
+        with open(self.filename, 'ab') as fileh:
+            fileh.write('torn')
+        os.unlink(self.filename + '.idx')
+        journal = EventJournal(self.filename)
+        self.assertEqual(journal.count, 11)
+        journal.bfd('Ethernet3', '192.0.3.1', 'poll', now=1011)
+        journal.close()
+        self.assertEqual(EventJournal.query(self.filename, 1010)[1:],
+                         [(1011, EventJournal.BFD, 0, 0, 0, 'Ethernet3',
+                           '192.0.3.1 poll')])
+        self.assertEqual(len(EventJournal.query(self.filename,
+                                                path='segment-b')), 5)
+
+        with open(self.filename, 'r+b') as fileh:
+            fileh.write('garbage!')
+        self.assertRaises(IOError, EventJournal, self.filename)
+
+    @patch('syslog.syslog')
+    def test_monitors(self, mock_syslog):
+        """Verify transitions, pushes and BFD failures are journaled"""
+        journal = EventJournal(self.filename)
+        switch = MagicMock()
+        device = Heartbeat('192.0.2.1', interface='Ethernet1')
+        device.dispatcher = Dispatcher({'eapi': {'switch': switch,
+                                                 'ok_config': ['enable']}})
+        (device.table.journal, device.dispatcher.journal) = (journal,
+                                                             journal)
+        device.good_count = 3
+        device.table.tick()
+        watcher = BfdWatcher(switch, ['Ethernet1'], device.dispatcher,
+                             journal=journal)
+        watcher._fail('line', '192.0.3.1', 'Ethernet1', 'poll')
+        journal.close()
+
+        rows = events(self.tmpdir)
+        self.assertEqual([(row['journal'], row['path'], row['event'],
+                           row['state'], row['result'], row['detail'])
+                          for row in rows],
+                         [('hbm', 'Ethernet1', 'transition',
+                           'not started -> up', '', 'good'),
+                          ('hbm', 'Ethernet1', 'push', '', 'ok',
+                           'ok_config'),
+                          ('hbm', 'Ethernet1', 'bfd', '', '',
+                           '192.0.3.1 poll'),
+                          ('hbm', '', 'push', '', 'ok', 'fail_config')])
+
+        output = StringIO()
+        with patch('sys.stdout', output):
+            self.assertEqual(main(['events', '--directory', self.tmpdir,
+                                   '--path', 'Ethernet1']), 0)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].endswith(
+            'hbm Ethernet1 transition not started -> up good'))
+
+
+class TestHbmHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for (name, offset) in (('segment-a', 0), ('segment-b', 0.5)):
+            recorder = RttRecorder(os.path.join(self.tmpdir,
+                                                name + '.rtt'))
+            for index in range(10):
+                recorder.record(1000 + index * 5 + offset, 1.0 + index,
+                                0, PathTable.UP)
+            recorder.record(1050 + offset, None, 1, PathTable.FAILED)
+            recorder.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_time(self):
+        """Verify epoch, relative and ISO times"""
+        self.assertEqual(parse_time('1000.5'), 1000.5)
+        self.assertEqual(parse_time('-15m', now=5000), 4100)
+        self.assertEqual(parse_time('-2h', now=10000), 2800)
+        self.assertEqual(parse_time('now', now=5000), 5000)
+        self.assertEqual(parse_time(None), None)
+        self.assertEqual(parse_time('1970-01-02T00:00') -
+                         parse_time('1970-01-01T00:00'), 86400)
+        self.assertRaises(ValueError, parse_time, 'yesterday')
+
+    def test_export(self):
+        """Verify a time window of every path, or one, in CSV and JSON"""
+        rows = history(self.tmpdir, start=1040, end=1050.5)
+        self.assertEqual([(row['path'], row['rtt']) for row in rows],
+                         [('segment-a', 9.0), ('segment-b', 9.0),
+                          ('segment-a', 10.0), ('segment-b', 10.0),
+                          ('segment-a', None), ('segment-b', None)])
+        self.assertEqual(rows[-1]['state'], 'failed')
+
+        output = StringIO()
+        export(rows, 'csv', output)
+        output.seek(0)
+        exported = list(csv.DictReader(output))
+        self.assertEqual(len(exported), 6)
+        self.assertEqual(exported[-1]['rtt'], '')
+        self.assertEqual(exported[0]['timestamp'], '1040.0')
+
+        output = StringIO()
+        with patch('sys.stdout', output):
+            self.assertEqual(main(['export', '--directory', self.tmpdir,
+                                   '--path', 'segment-b', '--format',
+                                   'json', '--start', '1045']), 0)
+        self.assertEqual([(row['path'], row['retcode'])
+                          for row in json.loads(output.getvalue())],
+                         [('segment-b', 0), ('segment-b', 1)])
+
+
+class TestAnalyze(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    @patch('syslog.syslog')
+    def test_simulate(self, mock_syslog):
+        """Verify the vectorized simulation changes state at the same
+        heartbeats as a Heartbeat evaluating them one by one
+        """
+        rand = random.Random(3)
+        rtts = []
+        while len(rtts) < 1500:
+            # Calm stretches with bursts of slow or lost replies
+            (low, high) = rand.choice([(1, 3)] * 3 + [(10, 20), (14, 30)])
+            rtts.extend(None if rand.random() < 0.05 else
+                        rand.uniform(low, high)
+                        for _ in range(rand.randint(1, 12)))
+        for (warn_threshold, fail_threshold, window) in \
+                ((13, 15, 5), (10, 20, 8), (2, 25, 3)):
+            device = Heartbeat('192.0.2.1')
+            (device.warn_threshold, device.fail_threshold) = \
+                (warn_threshold, fail_threshold)
+            device.resize_window(window)
+            device.state = 'starting up'
+            expected = []
+            for (index, rtt) in enumerate(rtts):
+                device.evaluate(0 if rtt is not None else 1, rtt)
+                with patch.object(Heartbeat, 'on_fail'), \
+                        patch.object(Heartbeat, 'on_up'), \
+                        patch.object(Heartbeat, 'on_warn'):
+                    expected.extend((index, old, new) for (_, old, new)
+                                    in device.table.tick())
+            lost = numpy.array([rtt is None for rtt in rtts])
+            values = numpy.array([numpy.nan if rtt is None else rtt
+                                  for rtt in rtts])
+            changes = simulate(numpy, values, lost, warn_threshold,
+                               fail_threshold, window)
+            self.assertTrue(len(changes) > 10)
+            self.assertEqual(changes, expected)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_analyze(self):
+        """Verify loss, availability, percentiles and candidate thresholds
+        of a recorded path
+        """
+        recorder = RttRecorder(os.path.join(self.tmpdir, 'segment-a.rtt'),
+                               capacity=150)
+        for index in range(200):
+            lost = 120 <= index < 130
+            recorder.record(1000 + index, None if lost else index % 10,
+                            int(lost), PathTable.FAILED if lost
+                            else PathTable.UP)
+        recorder.close()
+        records = load_ring(numpy, recorder.filename)
+        self.assertEqual(list(records['timestamp']),
+                         [record[0] for record in
+                          RttRecorder.read(recorder.filename)])
+
+        summary = analyze(numpy, records, [(8.5, 100), (20, 100)])
+        self.assertEqual(summary['heartbeats'], 149)
+        self.assertEqual(summary['lost'], 10)
+        self.assertAlmostEqual(summary['availability'], 139 / 149.0)
+        self.assertEqual(summary['rtt']['p50'], 5.0)
+        self.assertEqual(summary['rtt']['max'], 9.0)
+        (first, second) = summary['thresholds']
+        self.assertEqual((first['degraded'], first['failed']), (14, 10))
+        self.assertEqual((first['warn_transitions'],
+                          first['fail_transitions']), (0, 1))
+        self.assertEqual((second['degraded'], second['warn_transitions']),
+                         (0, 0))
+
+        output = StringIO()
+        with patch('sys.stdout', output):
+            self.assertEqual(main(['analyze', '--directory', self.tmpdir,
+                                   '--thresholds', '8.5/100',
+                                   '--start', '1100']), 0)
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('segment-a: 100 heartbeats'))
+        self.assertTrue(lines[2].startswith('  thresholds 8.5/100: 9 '
+                                            'degraded, 10 failed'))
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_analyze_short_trace(self):
+        """Verify candidate thresholds count availability up to the last
+        heartbeat, as the recorded states do
+        """
+        recorder = RttRecorder(os.path.join(self.tmpdir, 'segment-a.rtt'),
+                               capacity=10)
+        recorder.record(1000, 1.0, 0, PathTable.STARTUP)
+        recorder.record(1001, 1.0, 0, PathTable.UP)
+        recorder.close()
+        records = load_ring(numpy, recorder.filename)
+
+        summary = analyze(numpy, records, [(50, 100)], min_good=2)
+        self.assertEqual(summary['heartbeats'], 2)
+        self.assertEqual(summary['availability'], 0.5)
+        self.assertEqual(summary['thresholds'][0]['availability'], 0.5)
+
+
+class TestReplay(unittest.TestCase):
+
+    @patch('syslog.syslog')
+    def test_replay(self, mock_syslog):
+        CONFIG = parse_config(INI)
+        faults = [parse_fault('300:60:30'), parse_fault('500:20:2')]
+        trace = synthetic_trace(['Ethernet2'], 900, CONFIG['interval'],
+                                faults=faults, start=1000)
+        self.assertEqual(len(trace), 180)
+        clock = ibypass_common.CLOCK
+        result = replay(CONFIG, trace, faults)
+        self.assertIs(ibypass_common.CLOCK, clock)
+        self.assertFalse(ibypass_common.QUIET)
+        self.assertFalse(mock_syslog.called)
+
+        # Three heartbeats over failure_threshold trip the path, and 2 ms
+        # is no fault at all
+        self.assertEqual(result['detections'], [
+            {'path': 'Ethernet2', 'onset': 1300, 'failed': 1310,
+             'latency': 10},
+            {'path': 'Ethernet2', 'onset': 1500, 'failed': None,
+             'latency': None}])
+        pushes = [(event['timestamp'], event['detail'])
+                  for event in result['timeline'] if event['event'] == 'push']
+        self.assertEqual(pushes[:2], [(1010, 'ok_config'),
+                                      (1310, 'fail_config')])
+        self.assertEqual(pushes[2][1], 'ok_config')
+        self.assertEqual(result['simulated'], 895)
+        self.assertLess(result['heartbeats'], 180)
+
+        output = StringIO()
+        with patch('sys.stdout', output):
+            self.assertEqual(main(['replay', '--config', INI,
+                                   '--synthetic', '900', '--synthetic-path',
+                                   'Ethernet2', '--fault', '300:60:30']), 0)
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Replayed '))
+        self.assertEqual(lines[-1], 'Ethernet2: failed at +310.0s, 10.0s '
+                                    'after the failure began')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,9 @@
 """
 
 import os
+import random
 import sys
+import time
 import mock
 import unittest
 from contextlib import contextmanager
@@ -10,7 +12,14 @@ from contextlib import contextmanager
 sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
 sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
 
-from hbm import Heartbeat, Status  # noqa
+from hbm import Heartbeat, Status, PathTable, ProbeWindow, FlapDamper, \
+    BatchEvaluator, DecisionEngine, RttQuantiles  # noqa
+from ibypass_common import Dispatcher  # noqa
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 @contextmanager
@@ -66,11 +75,10 @@ class TestState(unittest.TestCase):
         mystatus.runAll([device])
         self.assertEqual(device.state, 'up')
         device.fail_count = 3
-        self.assertRaises(SystemExit, mystatus.runAll, [device])
+        mystatus.runAll([device])
         self.assertEqual(device.state, 'failed')
         mock_on_fail.assert_called()
 
-    @unittest.skip('Not Applicable when FSM configured to exit on fail')
     @mock.patch('hbm.Heartbeat.on_fail')
     @mock.patch('hbm.Heartbeat.on_up')
     def test_fail_to_up(self, mock_on_fail, mock_on_up):
@@ -138,10 +146,9 @@ class TestState(unittest.TestCase):
         mystatus.runAll([device])
         self.assertEqual(device.state, 'warn')
         device.fail_count = 3
-        self.assertRaises(SystemExit, mystatus.runAll, [device])
+        mystatus.runAll([device])
         self.assertEqual(device.state, 'failed')
         mock_on_fail.assert_called()
-        self.assertRaises(SystemExit)
 
     @mock.patch('hbm.Heartbeat.on_up')
     def test_warn_to_up(self, mock_on_up):
@@ -169,5 +176,464 @@ class TestState(unittest.TestCase):
         self.assertEqual(device.state, 'up')
         mock_on_up.assert_called()
 
+
+class TestProbeWindow(unittest.TestCase):
+
+    def test_k_of_n(self):
+        """Counters cover only the last window of outcomes
+        """
+        device = Heartbeat('192.0.2.1')
+        (good, warn, fail) = (ProbeWindow.GOOD, ProbeWindow.WARN,
+                              ProbeWindow.FAIL)
+        for outcome in (fail, fail, good, fail, good):
+            device.record(outcome)
+        self.assertEqual((device.good_count, device.warn_count,
+                          device.fail_count), (2, 0, 3))
+        device.record(warn)
+        device.record(good)
+        self.assertEqual((device.good_count, device.warn_count,
+                          device.fail_count), (3, 1, 1))
+
+        # Counters stay bounded however long the path runs
+        for _ in range(10000):
+            device.record(fail)
+        self.assertEqual(device.fail_count, 5)
+        self.assertEqual(len(device.window.ring), 5)
+
+    def test_reset_and_resize(self):
+        """Resetting a counter forgets its outcomes; resizing recounts
+        """
+        device = Heartbeat('192.0.2.1')
+        for outcome in (ProbeWindow.GOOD, ProbeWindow.FAIL, ProbeWindow.GOOD):
+            device.record(outcome)
+        device.reset_counts(['good_count'])
+        self.assertEqual(device.window.outcomes(), [ProbeWindow.FAIL])
+        device.record(ProbeWindow.GOOD)
+        device.resize_window(8)
+        self.assertEqual((device.window.size, device.good_count,
+                          device.fail_count), (8, 1, 1))
+        # Never smaller than the thresholds
+        device.resize_window(1)
+        self.assertEqual(device.window.size, 3)
+
+
+class TestFlapDamper(unittest.TestCase):
+
+    def test_penalty_decay(self):
+        """Penalties halve every half life; suppression lifts below reuse
+        """
+        damper = FlapDamper(half_life=60, suppress=2000, reuse=750,
+                            penalty=1000, max_suppress=600)
+        damper.flap(now=0)
+        self.assertFalse(damper.suppressed(now=0))
+        damper.flap(now=0)
+        self.assertTrue(damper.suppressed(now=0))
+        self.assertAlmostEqual(damper.reuse_in(now=0), 60 * 1.415, places=0)
+        self.assertTrue(damper.suppressed(now=60))
+        self.assertAlmostEqual(damper.penalty, 1000)
+        self.assertFalse(damper.suppressed(now=90))
+        self.assertEqual(damper.reuse_in(now=90), 0)
+
+    def test_max_suppress(self):
+        """However often a path flaps, it is suppressed for max_suppress
+        """
+        damper = FlapDamper(half_life=60, penalty=1000, max_suppress=600)
+        for _ in range(1000):
+            damper.flap(now=0)
+        self.assertAlmostEqual(damper.reuse_in(now=0), 600)
+        self.assertEqual(damper.flaps, 1000)
+
+    def test_recovery_penalty(self):
+        """Recovering from a failure adds the penalty too; coming up for
+        the first time does not
+        """
+        damper = FlapDamper(half_life=60, suppress=2000, reuse=750,
+                            penalty=500)
+        damper.recover(now=0)
+        self.assertEqual(damper.penalty, 0)
+        damper.flap(now=0)
+        damper.recover(now=0)
+        damper.recover(now=0)
+        self.assertEqual(damper.penalty, 1000)
+        damper.flap(now=0)
+        self.assertFalse(damper.suppressed(now=0))
+        damper.recover(now=0)
+        self.assertTrue(damper.suppressed(now=0))
+        self.assertEqual(damper.flaps, 2)
+
+
+@mock.patch('syslog.syslog')
+class TestPathTable(unittest.TestCase):
+
+    def test_tick_many_paths(self, mock_syslog):
+        """Evaluate many paths in one tick; callbacks run on edges only
+        """
+        table = PathTable()
+        devices = [Heartbeat('192.0.2.{}'.format(index), table=table)
+                   for index in range(200)]
+        edges = []
+        table.add_callback(lambda device, old, new: edges.append(
+            (device.probe_dst_address, old, new)))
+        with mock.patch('hbm.Heartbeat.on_up') as mock_on_up:
+            table.tick()
+            self.assertEqual(set(device.state for device in devices),
+                             set(['starting up']))
+            self.assertEqual(edges, [])
+
+            for device in devices[:50]:
+                device.good_count = 3
+            self.assertEqual(len(table.tick()), 50)
+            self.assertEqual(len(table.tick()), 0)
+            self.assertEqual(mock_on_up.call_count, 50)
+        self.assertEqual(edges[0], ('192.0.2.0', PathTable.STARTUP,
+                                    PathTable.UP))
+        self.assertEqual([device.state for device in devices[49:51]],
+                         ['up', 'starting up'])
+
+        with mock.patch('hbm.Heartbeat.on_warn') as mock_on_warn:
+            devices[7].warn_count = 3
+            table.tick()
+            self.assertEqual(devices[7].state, 'warn')
+            self.assertEqual(devices[7].good_count, 0)
+            mock_on_warn.assert_called_once_with()
+
+    @mock.patch('hbm.Heartbeat.on_up')
+    @mock.patch('hbm.Heartbeat.on_warn')
+    def test_transitions_refire(self, mock_on_warn, mock_on_up, mock_syslog):
+        """Thresholds are met at or above their count, so a path which
+        recovers can degrade again
+        """
+        device = Heartbeat('192.0.2.1')
+        for _ in range(4):
+            device.record(ProbeWindow.GOOD)
+        device.table.tick()
+        self.assertEqual(device.state, 'up')
+        for cycle in range(3):
+            for _ in range(4):
+                device.record(ProbeWindow.WARN)
+            device.table.tick()
+            self.assertEqual(device.state, 'warn')
+            for _ in range(3):
+                device.record(ProbeWindow.GOOD)
+            device.table.tick()
+            self.assertEqual(device.state, 'up')
+        self.assertEqual(mock_on_warn.call_count, 3)
+
+    @mock.patch('hbm.Heartbeat.dispatch')
+    @mock.patch('time.time')
+    def test_dampening(self, mock_time, mock_dispatch, mock_syslog):
+        """A flapping path does not re-apply ok_config until it is stable
+        """
+        mock_time.return_value = 0
+        device = Heartbeat('192.0.2.1', interface='Ethernet2')
+        device.damper = FlapDamper(half_life=60)
+        table = device.table
+
+        def cycle(outcome):
+            for _ in range(3):
+                device.record(outcome)
+            table.tick()
+
+        cycle(ProbeWindow.GOOD)
+        cycle(ProbeWindow.FAIL)
+        cycle(ProbeWindow.GOOD)
+        cycle(ProbeWindow.FAIL)
+        self.assertEqual(device.state, 'failed')
+        self.assertEqual([args[0][0] for args in
+                          mock_dispatch.call_args_list],
+                         ['ok_config', 'fail_config', 'ok_config',
+                          'fail_config'])
+        self.assertIn('penalty 1500', device.summary())
+        self.assertNotIn('suppressed', device.summary())
+
+        # The second recovery brings the penalty to suppress
+        mock_dispatch.reset_mock()
+        cycle(ProbeWindow.GOOD)
+        self.assertEqual(device.state, 'up')
+        self.assertFalse(mock_dispatch.called)
+        self.assertIn('penalty 2000 suppressed reuse in 85s',
+                      device.summary())
+        mock_time.return_value = 90
+        table.tick()
+        mock_dispatch.assert_called_once_with('ok_config')
+        table.tick()
+        self.assertEqual(mock_dispatch.call_count, 1)
+
+    @mock.patch('hbm.Heartbeat.dispatch')
+    def test_recovery_approval(self, mock_dispatch, mock_syslog):
+        """A failed path which requires approval recovers only once approved
+        """
+        device = Heartbeat('192.0.2.1', interface='Ethernet2')
+        device.require_approval = True
+        device.failed_probe_interval = 30
+        status = Status()
+        device.good_count = 3
+        status.runAll([device])
+        device.fail_count = 3
+        status.runAll([device])
+        self.assertEqual(device.state, 'failed')
+        self.assertFalse(device.probe_due())
+        self.assertTrue(device.probe_due(now=time.time() + 31))
+
+        device.good_count = 3
+        status.runAll([device])
+        status.runAll([device])
+        self.assertEqual(device.state, 'failed')
+        self.assertIn('awaiting approval', device.summary())
+
+        device.approve()
+        status.runAll([device])
+        self.assertEqual(device.state, 'up')
+        self.assertEqual(device.approved, 0)
+        self.assertTrue(device.probe_due())
+        self.assertEqual([args[0][0] for args in
+                          mock_dispatch.call_args_list],
+                         ['ok_config', 'fail_config', 'ok_config'])
+
+    @mock.patch('hbm.Heartbeat.dispatch')
+    def test_bfd_holds_recovery(self, mock_dispatch, mock_syslog):
+        """A path failed on a BFD Down stays failed through good heartbeats
+        until BFD reports the peer up again
+        """
+        device = Heartbeat('192.0.2.1', interface='Ethernet2')
+        device.engine = DecisionEngine()
+        status = Status()
+        device.good_count = 3
+        status.runAll([device])
+        device.engine.record('Ethernet2', 'bfd', True, source='log')
+        status.runAll([device])
+        self.assertEqual(device.state, 'failed')
+
+        for _ in range(3):
+            device.good_count = 3
+            status.runAll([device])
+        self.assertEqual(device.state, 'failed')
+        self.assertEqual(device.engine.faults('Ethernet2'), ['bfd'])
+
+        device.engine.record('Ethernet2', 'bfd', False, source='poll')
+        status.runAll([device])
+        self.assertEqual(device.state, 'up')
+        self.assertEqual([args[0][0] for args in
+                          mock_dispatch.call_args_list],
+                         ['ok_config', 'fail_config', 'ok_config'])
+
+    @mock.patch('hbm.Heartbeat.dispatch')
+    @mock.patch('hbm.log')
+    def test_recovery_held_by_bfd(self, mock_log, mock_dispatch,
+                                  mock_syslog):
+        """Neither automatic recovery nor an operator's approval restores a
+        path while BFD still reports it down, and no approval is asked for
+        """
+        for require_approval in (False, True):
+            mock_log.reset_mock()
+            device = Heartbeat('192.0.2.1', interface='Ethernet2')
+            device.engine = DecisionEngine()
+            device.require_approval = require_approval
+            status = Status()
+            device.good_count = 3
+            status.runAll([device])
+            device.engine.record('Ethernet2', 'bfd', True, source='log')
+            status.runAll([device])
+            self.assertEqual(device.state, 'failed')
+
+            device.approve()
+            for _ in range(3):
+                device.good_count = 3
+                status.runAll([device])
+            self.assertEqual(device.state, 'failed')
+            self.assertIn('held by bfd', device.summary())
+            messages = [args[0][0] for args in mock_log.call_args_list]
+            self.assertEqual(len([message for message in messages
+                                  if 'still down on bfd' in message]), 1)
+            self.assertFalse([message for message in messages
+                              if 'hbm_service approve' in message])
+
+            device.engine.record('Ethernet2', 'bfd', False, source='poll')
+            status.runAll([device])
+            self.assertEqual(device.state, 'up')
+            self.assertNotIn('held', device.summary())
+
+    def test_shared_ok_config(self, mock_syslog):
+        """A path which recovers does not apply the ok_config it shares
+        with a path which is still failed
+        """
+        local = mock.MagicMock()
+        dispatcher = Dispatcher({'eapi': {'switch': local,
+                                          'ok_config': ['ok'],
+                                          'fail_config': ['fail']}})
+        table = PathTable()
+        (first, second) = [Heartbeat(address, interface=interface,
+                                     table=table)
+                           for (address, interface) in
+                           (('192.0.2.1', 'Ethernet2'),
+                            ('192.0.3.1', 'Ethernet3'))]
+        for device in (first, second):
+            device.dispatcher = dispatcher
+            device.state = 'failed'
+            device.on_fail()
+
+        def pushed():
+            return [args[0][1] for args in local.runCmds.call_args_list]
+
+        first.state = 'up'
+        first.on_up()
+        self.assertEqual(pushed(), [['fail']])
+        second.state = 'up'
+        second.on_up()
+        self.assertEqual(pushed(), [['fail'], ['ok']])
+
+        # Nor while the other path holds ok_config back for dampening
+        first.state = 'failed'
+        first.on_fail()
+        table.columns['ok_pending'][first.row] = 1
+        first.state = 'up'
+        second.on_up()
+        self.assertEqual(pushed(), [['fail'], ['ok'], ['fail']])
+        first.reuse()
+        self.assertEqual(pushed(), [['fail'], ['ok'], ['fail'], ['ok']])
+
+        # Paths with their own config sets are not held back
+        second.commands = {'eapi': {'ok_config': ['ok second']},
+                           'peer': {}}
+        first.state = 'failed'
+        self.assertEqual(second.holding_shared_sets(), [])
+
+    @mock.patch('hbm.log')
+    def test_failure_reminders(self, mock_log, mock_syslog):
+        """The failure alert repeats every alert_holddown seconds
+        """
+        device = Heartbeat('192.0.2.1', interface='Ethernet2')
+        device.alert_holddown = 300
+        with mock.patch('hbm.Heartbeat.dispatch'):
+            device.on_fail()
+        self.assertEqual(mock_log.call_count, 2)
+        device.remind(now=time.time() + 1)
+        self.assertEqual(mock_log.call_count, 2)
+        device.remind(now=time.time() + 301)
+        self.assertEqual(mock_log.call_count, 3)
+
+    def test_adopt(self, mock_syslog):
+        """Moving a path between tables keeps its state and counters
+        """
+        device = Heartbeat('192.0.2.1')
+        device.resize_window(12)
+        for outcome in (ProbeWindow.FAIL, ProbeWindow.WARN):
+            device.record(outcome)
+        device.good_count = 2
+        device.state = 'up'
+        other = Heartbeat('192.0.2.2')
+        table = PathTable()
+        table.adopt(device)
+        self.assertIs(device.table, table)
+        self.assertEqual((device.state, device.good_count), ('up', 2))
+        self.assertEqual((table.width, device.window.size), (12, 12))
+        self.assertEqual(device.window.outcomes(),
+                         [ProbeWindow.FAIL, ProbeWindow.WARN])
+
+        # Released rows are reused
+        PathTable().adopt(device)
+        self.assertEqual(len(table), 0)
+        table.adopt(other)
+        self.assertEqual(other.row, 0)
+        self.assertEqual(other.state, 'not started')
+
+    def test_rtt_history(self, mock_syslog):
+        """The RTTs of recent replies are kept in a fixed size ring
+        """
+        device = Heartbeat('192.0.2.1')
+        device.table.resize_history(4)
+        for rtt in (1.0, 2.0, None, 3.0):
+            device.evaluate(0 if rtt else 1, rtt)
+        self.assertEqual(device.rtts(), [1.0, 2.0, 3.0])
+        for rtt in range(10, 20):
+            device.evaluate(0, float(rtt))
+        self.assertEqual(device.rtts(), [16.0, 17.0, 18.0, 19.0])
+        self.assertEqual(len(device.table.rtts), 4)
+        self.assertIn('rtt avg 17.5ms', device.summary())
+
+        table = PathTable()
+        table.resize_history(2)
+        table.adopt(device)
+        self.assertEqual(device.rtts(), [18.0, 19.0])
+        table.resize_history(0)
+        self.assertEqual(device.rtts(), [])
+
+        # Paths are slotted records
+        self.assertRaises(AttributeError, setattr, device, 'extra', 1)
+
+
+@mock.patch('syslog.syslog')
+@mock.patch('hbm.Heartbeat.dispatch')
+class TestBatchEvaluator(unittest.TestCase):
+
+    def build(self, vectorize, count=60):
+        """Return an evaluator for count paths sharing an engine.  Every
+        tenth path uses quantile statistics so it is evaluated on its own.
+        """
+        table = PathTable()
+        engine = DecisionEngine()
+        for index in range(count):
+            device = Heartbeat('192.0.2.{}'.format(index),
+                               interface='Ethernet{}'.format(index),
+                               table=table)
+            device.engine = engine
+            device.resize_window(4 + index % 3)
+            if index % 10 == 9:
+                device.rtt_quantiles = RttQuantiles()
+                device.fail_statistic = 'p50'
+        return BatchEvaluator(table, vectorize=vectorize)
+
+    def snapshot(self, evaluator):
+        return [(device.state, device.good_count, device.warn_count,
+                 device.fail_count, device.window.outcomes(), device.rtts())
+                for device in evaluator.table.devices]
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_matches_per_path(self, mock_dispatch, mock_syslog):
+        """Vectorized evaluation gives the same results as evaluating each
+        path in turn
+        """
+        evaluators = [self.build(True), self.build(False)]
+        self.assertIsNotNone(evaluators[0].numpy)
+        self.assertIsNone(evaluators[1].numpy)
+        rand = random.Random(7)
+        for _ in range(100):
+            # Some paths are not probed every round
+            rows = [row for row in range(60) if rand.random() < 0.9]
+            retcodes = [int(rand.random() < 0.15) for _ in rows]
+            rtts = [None if retcode else rand.uniform(1, 10)
+                    for retcode in retcodes]
+            changes = []
+            for evaluator in evaluators:
+                evaluator.record(rows, retcodes, rtts)
+                changes.append([(device.row, old, new) for
+                                (device, old, new) in evaluator.tick()])
+            self.assertEqual(changes[0], changes[1])
+            self.assertEqual(self.snapshot(evaluators[0]),
+                             self.snapshot(evaluators[1]))
+        states = set(device.state for device in evaluators[0].table.devices)
+        self.assertTrue(set(['up', 'warn', 'failed']) <= states)
+        engines = [evaluator.engine for evaluator in evaluators]
+        engines[1] = evaluators[1].table.devices[0].engine
+        self.assertEqual(engines[0].signals, engines[1].signals)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_engine_failure(self, mock_dispatch, mock_syslog):
+        """A path failed by the engine is evaluated without heartbeat
+        failures
+        """
+        evaluator = self.build(True, count=5)
+        for _ in range(3):
+            evaluator.record(range(5), [0] * 5, [1.0] * 5)
+        evaluator.tick()
+        devices = evaluator.table.devices
+        self.assertEqual(set(device.state for device in devices),
+                         set(['up']))
+        devices[3].engine.record('Ethernet3', 'bfd', 1)
+        changes = evaluator.tick()
+        self.assertEqual([(device.interface, new) for device, _, new in
+                          changes], [('Ethernet3', PathTable.FAILED)])
+        mock_dispatch.assert_called_with('fail_config')
+
 if __name__ == '__main__':
     unittest.main(module=__name__, buffer=True, exit=False)
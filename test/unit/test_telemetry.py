@@ -0,0 +1,151 @@
+"""Validate the streaming telemetry subscriber against a replay server
+"""
+
+import os
+import sys
+import time
+import unittest
+from mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+from ibypass_common import TelemetrySubscriber  # noqa
+from telemetry_server import TelemetryReplayServer  # noqa
+
+SNAPSHOT = [
+    {'type': 'interface', 'name': 'Ethernet2', 'linkStatus': 'connected',
+     'lineProtocolStatus': 'up'},
+    {'type': 'interface', 'name': 'Ethernet3', 'linkStatus': 'notconnect',
+     'lineProtocolStatus': 'down'},
+    {'type': 'bfd', 'peer': '192.0.3.1', 'status': 'up'},
+]
+
+CHANGES = [
+    {'type': 'interface', 'name': 'Ethernet3', 'linkStatus': 'connected',
+     'lineProtocolStatus': 'up', 'delay': 0.05},
+    {'type': 'bfd', 'peer': '192.0.3.1', 'status': 'down', 'delay': 0.05},
+]
+
+
+def wait_until(condition, timeout=2):
+    """Poll condition() until it is true or timeout seconds pass"""
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@patch('syslog.syslog')
+class TestTelemetry(unittest.TestCase):
+
+    def setUp(self):
+        self.server = None
+        self.subscriber = None
+
+    def tearDown(self):
+        if self.subscriber:
+            self.subscriber.stop()
+        if self.server:
+            self.server.stop()
+
+    def test_snapshot_and_changes(self, mock_syslog):
+        """Verify the snapshot fills the state tables and only changes
+        reach the callbacks
+        """
+        self.server = TelemetryReplayServer(SNAPSHOT, CHANGES).start()
+        events = []
+        self.subscriber = TelemetrySubscriber('127.0.0.1', self.server.port)
+        self.subscriber.add_callback(events.append)
+        self.subscriber.start()
+
+        self.assertTrue(self.subscriber.synced.wait(2))
+        self.assertEqual(self.server.subscriptions,
+                         [{'subscribe': ['interface', 'bfd']}])
+        self.assertEqual(
+            self.subscriber.interface_status('Ethernet2')['lineProtocolStatus'],
+            'up')
+
+        self.assertTrue(wait_until(lambda: len(events) == 2))
+        self.assertEqual([event['type'] for event in events],
+                         ['interface', 'bfd'])
+        self.assertEqual(
+            self.subscriber.interface_status('Ethernet3')['linkStatus'],
+            'connected')
+        self.assertEqual(self.subscriber.bfd_peers['192.0.3.1']['status'],
+                         'down')
+
+    def test_malformed_events(self, mock_syslog):
+        """Verify malformed events and failing callbacks are skipped without
+        losing the feed
+        """
+        changes = ['not json', '[1, 2]', {'type': 'interface'},
+                   {'type': 'bfd', 'status': 'down'}] + CHANGES
+        self.server = TelemetryReplayServer(SNAPSHOT, changes).start()
+        events = []
+
+        def fail(event):
+            raise KeyError('peer')
+        self.subscriber = TelemetrySubscriber('127.0.0.1', self.server.port)
+        self.subscriber.add_callback(fail)
+        self.subscriber.add_callback(events.append)
+        self.subscriber.start()
+
+        self.assertTrue(wait_until(lambda: len(events) == 2))
+        self.assertEqual([event['type'] for event in events],
+                         ['interface', 'bfd'])
+        self.assertTrue(self.subscriber.synced.is_set())
+        self.assertEqual(len(self.server.subscriptions), 1)
+
+    def test_failure_clears_synced(self, mock_syslog):
+        """Verify the feed is no longer trusted once following it fails for
+        any reason
+        """
+        self.subscriber = TelemetrySubscriber('127.0.0.1', 0)
+        attempts = []
+
+        def follow():
+            attempts.append(self.subscriber.synced.is_set())
+            self.subscriber.synced.set()
+            raise RuntimeError('bug')
+        self.subscriber._follow = follow
+        self.subscriber.start()
+        self.assertTrue(wait_until(lambda: len(attempts) >= 2))
+        self.assertEqual(attempts[:2], [False, False])
+
+    def test_wait_for_change(self, mock_syslog):
+        """Verify wait_for_change() returns as soon as an event arrives
+        """
+        self.server = TelemetryReplayServer(SNAPSHOT, CHANGES[:1]).start()
+        self.subscriber = TelemetrySubscriber('127.0.0.1', self.server.port)
+        self.subscriber.start()
+        self.assertTrue(self.subscriber.synced.wait(2))
+        begin = time.time()
+        self.assertTrue(self.subscriber.wait_for_change(2))
+        self.assertLess(time.time() - begin, 1)
+
+    def test_reconnect(self, mock_syslog):
+        """Verify the subscriber falls back and reconnects when the feed
+        is lost
+        """
+        self.server = TelemetryReplayServer(SNAPSHOT, hold_open=False)
+        self.server.start()
+        self.subscriber = TelemetrySubscriber('127.0.0.1', self.server.port)
+        self.subscriber.start()
+        self.assertTrue(wait_until(
+            lambda: len(self.server.subscriptions) >= 2))
+
+    def test_unavailable(self, mock_syslog):
+        """Verify an unreachable feed leaves the subscriber unsynchronized
+        """
+        self.server = TelemetryReplayServer()
+        port = self.server.port
+        self.server.stop()
+        self.server = None
+        self.subscriber = TelemetrySubscriber('127.0.0.1', port).start()
+        time.sleep(0.2)
+        self.assertFalse(self.subscriber.synced.is_set())
+        self.assertIsNone(self.subscriber.interface_status('Ethernet2'))
+
+if __name__ == '__main__':
+    unittest.main(module=__name__, buffer=True, exit=False)
@@ -0,0 +1,189 @@
+"""Validate the timing of both monitors on virtual time
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+from virtual_time import ScenarioClock, FakeSwitch, FakePings, AlertSink, \
+    write_config, pushed, run_hbm, run_bfd_int_sync  # noqa
+
+PROBES = {'probe_dst_address1': '192.0.3.1',
+          'probe_dst_address2': '192.0.4.1'}
+
+
+class TestHbmTiming(unittest.TestCase):
+    """interval 5, failed_probe_interval 30 and alert_holddown 300 from the
+    sample config
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = write_config(self.tmpdir, General=PROBES)
+        self.clock = ScenarioClock(1000, until=2000)
+        self.local = FakeSwitch(self.clock)
+        self.peer = FakeSwitch(self.clock)
+        self.pings = FakePings(self.clock)
+        self.alerts = AlertSink(self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_hbm(self):
+        run_hbm(self.config, self.clock, self.local, self.peer, self.pings,
+                self.alerts, self.tmpdir)
+
+    def probes(self, address, start=0):
+        return [when for (when, sent) in self.pings.sent
+                if sent == address and when >= start]
+
+    def test_startup(self):
+        """Local eAPI comes up after 3s: retries back off from 0.1s, then
+        three good heartbeats 5s apart bring the paths up
+        """
+        self.local.reachable = False
+        self.clock.at(1003, setattr, self.local, 'reachable', True)
+        self.run_hbm()
+        self.assertAlmostEqual(self.probes('192.0.3.1')[0], 1003.1)
+        self.assertEqual([name for (_, name) in pushed(self.local,
+                                                       self.config)],
+                         ['ok_config'])
+        self.assertAlmostEqual(self.local.pushes[0][0], 1013.1)
+        self.assertEqual(self.local.pushes, self.peer.pushes)
+        self.assertEqual(len(self.alerts.times('Heartbeats up')), 2)
+
+    def test_startup_timeout(self):
+        """startup_timeout bounds the wait for eAPI exactly"""
+        self.config = write_config(self.tmpdir, General=dict(
+            PROBES, startup_timeout='10'))
+        self.local.reachable = False
+        self.assertRaises(RuntimeError, self.run_hbm)
+        self.assertAlmostEqual(self.clock.now, 1010)
+        self.assertEqual(self.pings.sent, [])
+
+    def test_failover_and_recovery(self):
+        """Three lost heartbeats fail the path over, the alert repeats every
+        alert_holddown, and the failed path recovers after three good
+        heartbeats at failed_probe_interval
+        """
+        self.clock.at(1100, self.pings.set, '192.0.3.1', None)
+        self.clock.at(1500, self.pings.set, '192.0.3.1', 2.0)
+        self.run_hbm()
+
+        self.assertEqual(self.probes('192.0.3.1', 1100)[:3],
+                         [1100, 1105, 1110])
+        self.assertEqual(pushed(self.local, self.config),
+                         [(1010, 'ok_config'), (1110, 'fail_config'),
+                          (1560, 'ok_config')])
+        self.assertEqual(self.local.pushes, self.peer.pushes)
+        self.assertEqual(self.alerts.times('Heartbeats down'), [1110])
+        self.assertEqual(self.alerts.times('Heartbeats triggered shutdown'),
+                         [1110, 1410])
+
+        # Probed every failed_probe_interval while failed
+        probes = self.probes('192.0.3.1', 1110)
+        self.assertEqual(probes[:4], [1110, 1140, 1170, 1200])
+        self.assertEqual(probes[probes.index(1560) + 1], 1565)
+        # The healthy path is never held back
+        self.assertEqual(len(self.probes('192.0.4.1')), 201)
+
+    def test_holddown_disabled(self):
+        """alert_holddown = 0 turns the repeated shutdown alert off"""
+        self.config = write_config(self.tmpdir, General=dict(
+            PROBES, alert_holddown='0'))
+        self.clock.at(1100, self.pings.set, '192.0.3.1', None)
+        self.run_hbm()
+        self.assertEqual(self.alerts.times('Heartbeats down'), [1110])
+        self.assertEqual(self.alerts.times('Heartbeats triggered shutdown'),
+                         [])
+
+
+class TestBfdTiming(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.tmpdir, 'eos')
+        open(self.logfile, 'w').close()
+        self.config = write_config(
+            self.tmpdir, General={'bfd_sources': 'log',
+                                  'alert_holddown': '60'},
+            email={'enabled': 'no'})
+        self.clock = ScenarioClock(1000, until=2000)
+        self.local = FakeSwitch(self.clock)
+        self.local.routes = {'Ethernet2': '192.0.3.1',
+                             'Ethernet3': '192.0.4.1'}
+        self.peer = FakeSwitch(self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def bfd_down(self, peer):
+        with open(self.logfile, 'a') as fileh:
+            fileh.write('Rib: %BGP-BFD-STATE-CHANGE: peer {} (AS 10000) Up '
+                        'to Down\n'.format(peer))
+
+    def test_failover(self):
+        """Links are checked every RETRY_INTERVAL until one is up, the log
+        is read every LOG_INTERVAL, and the watcher stops alert_holddown
+        after the failure
+        """
+        self.clock.at(1012, self.local.set_interface, 'Ethernet2')
+        self.clock.at(1040.3, self.bfd_down, '192.0.3.1')
+        run_bfd_int_sync(self.config, self.clock, self.local, self.peer,
+                         self.logfile)
+
+        pushes = pushed(self.local, self.config)
+        self.assertEqual([name for (_, name) in pushes],
+                         ['starting_config', 'ok_config', 'fail_config'])
+        self.assertEqual(pushes[0][0], 1000)
+        self.assertEqual(pushes[1][0], 1015)
+        self.assertGreater(pushes[2][0], 1040.3)
+        self.assertLessEqual(pushes[2][0], 1040.35 + 1e-6)
+        self.assertEqual(self.local.pushes, self.peer.pushes)
+        # main() returned once the holddown passed
+        self.assertLess(self.clock.now, 2000)
+        self.assertGreaterEqual(self.clock.now, pushes[2][0] + 60)
+
+    def test_routes(self):
+        """The watcher waits RETRY_INTERVAL between route lookups"""
+        self.local.set_interface('Ethernet2')
+        self.local.routes = {}
+        self.clock.at(1007, self.local.routes.update,
+                      {'Ethernet2': '192.0.3.1', 'Ethernet3': '192.0.4.1'})
+        run_bfd_int_sync(self.config, self.clock, self.local, self.peer,
+                         self.logfile)
+        self.assertEqual(pushed(self.local, self.config),
+                         [(1000, 'starting_config'), (1010, 'ok_config')])
+        self.assertEqual(self.clock.now, 2000)
+
+    def test_path_sets(self):
+        """A BFD Down on a path with its own config sets pushes that path's
+        fail_config rather than the shared one
+        """
+        shutdown = 'enable,configure,interface Ethernet6,shutdown'
+        self.config = write_config(
+            self.tmpdir, General={'bfd_sources': 'log',
+                                  'alert_holddown': '60'},
+            email={'enabled': 'no'},
+            **{'path:a': {'interface': 'Ethernet2'},
+               'path:b': {'interface': 'Ethernet3',
+                          'fail_config': shutdown,
+                          'peer_fail_config': shutdown}})
+        self.local.set_interface('Ethernet2')
+        self.clock.at(1020, self.bfd_down, '192.0.4.1')
+        run_bfd_int_sync(self.config, self.clock, self.local, self.peer,
+                         self.logfile)
+
+        commands = shutdown.split(',')
+        self.assertEqual([name for (_, name) in pushed(self.local,
+                                                       self.config)],
+                         ['starting_config', 'ok_config', commands])
+        self.assertEqual(self.peer.pushes[-1][1], commands)
+
+if __name__ == '__main__':
+    unittest.main()